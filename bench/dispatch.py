@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+# Micro-benchmark for DeviceManager dispatch: compares the old per-call
+# __getattr__ closure with the precompiled routing table, for vol and send
+# dispatch across 3 and 10 registered devices.
+#
+# Run from the top-level directory with
+#   $ python bench/dispatch.py
+
+import os
+import sys
+import timeit
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from oscar.devicemanager import DeviceManager
+
+class OldDeviceManager(object):
+    # The DeviceManager as it was before the routing table
+    def __init__(self):
+        self.log = logging.getLogger(__name__)
+        self.ds = {}
+
+    def add_device(self, device):
+        self.ds[device.name] = device
+
+    def __getattr__(self, method_name):
+        def catchall_method(*args, **kwargs):
+            ignore = None
+            if kwargs.has_key('ignore'):
+                ignore = kwargs['ignore']
+                del kwargs['ignore']
+            for name,device in self.ds.iteritems():
+                if name == ignore:
+                    continue
+                if hasattr(device, method_name):
+                    self.log.debug('Calling {} for {}'.format(method_name, name))
+                    f = getattr(device, method_name)
+                    f(*args, **kwargs)
+        return catchall_method
+
+class FakeDevice(object):
+    def __init__(self, name):
+        self.name = name
+        self.n = 0
+
+    def vol(self, i, v):
+        self.n += 1
+
+    def send(self, i, j, v):
+        self.n += 1
+
+def run(dm_class, n_devices, method, number):
+    dm = dm_class()
+    for k in range(n_devices):
+        dm.add_device(FakeDevice('device{}'.format(k)))
+    if method == 'vol':
+        f = lambda: dm.vol(1, 0.5, ignore='device0')
+    else:
+        f = lambda: dm.send(1, 1, 0.5, ignore='device0')
+    return min(timeit.repeat(f, number=number, repeat=5)) / number
+
+def main():
+    number = 100000
+    print('{:<8} {:>8} {:>12} {:>12} {:>8}'.format(
+          'method', 'devices', 'old (us)', 'new (us)', 'speedup'))
+    for method in ['vol', 'send']:
+        for n_devices in [3, 10]:
+            t_old = run(OldDeviceManager, n_devices, method, number)
+            t_new = run(DeviceManager, n_devices, method, number)
+            print('{:<8} {:>8} {:>12.3f} {:>12.3f} {:>7.1f}x'.format(
+                  method, n_devices, t_old*1e6, t_new*1e6, t_old/t_new))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+# Loopback benchmark: runs an OscarServer against a fake Ardour and a fake
+# TouchOSC on 127.0.0.1 and measures
+#   - startup: time until Ardour and TouchOSC are ready, and how long the
+#     restore of a full state file takes, both for a fresh Ardour and for a
+#     restart of Oscar against an Ardour that already has the state,
+#   - recovery: how long it takes from a restart of Ardour until Oscar has
+#     subscribed to its feedback again and restored the state to it,
+#   - latency: TouchOSC -> Oscar -> Ardour for fader sweeps on the tablet and
+#     Ardour -> Oscar -> TouchOSC for fader sweeps in Ardour, at increasing
+#     rates,
+#   - how many of Ardour's echoes of the tablet's sweeps made it back to the
+#     tablet (none, unless the value cache is off),
+#   - the highest sweep rate that gets through without loss in both
+#     directions.
+# The results are printed as JSON, so that runs of different versions can be
+# compared; progress goes to stderr.
+#
+# Run from the top-level directory with
+#   $ python bench/loopback.py > results.json
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import platform
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import liblo
+import oscar
+from oscar import OscarServer
+from oscar.devicemanager import DeviceManager
+from oscar.persiststate import PersistState
+from oscar.routemap import RouteMap
+from oscar.loopback import FakeArdour, FakeTouchOSC
+
+RESOLUTION = 4096
+
+def write_state_file(state_file, n_tracks):
+    # A state where every control of every track differs from the defaults,
+    # so that the restore has to send all of it
+    p = PersistState(DeviceManager(), state_file, reconcile_window=0)
+    p.set_routes(RouteMap.default(n_tracks))
+    for i in range(n_tracks+1):
+        p.vol(i, 0.5)
+        p.mute(i, 1.0)
+        p.solo(i, 1.0)
+        p.record(i, 1.0)
+        p.pan(i, 0.25)
+        p.send(i, 1, 0.5)
+    p.save()
+
+def percentiles(ls):
+    # In milliseconds
+    if len(ls) == 0:
+        return None
+    ls = sorted(ls)
+    def at(q):
+        return ls[min(int(q * len(ls)), len(ls)-1)] * 1e3
+    return {'n': len(ls), 'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99),
+            'max': ls[-1] * 1e3}
+
+def match(sent, received, key):
+    # Latencies of the sent (time, track, step) messages that were received;
+    # key turns a received (path, args) into (track, step) or None
+    t_sent = dict(((i, step), t) for t,i,step in sent)
+    latencies = []
+    for t,path,args in received:
+        k = key(path, args)
+        t0 = t_sent.pop(k, None) if k is not None else None
+        if t0 is not None:
+            latencies.append(t - t0)
+    return latencies
+
+def ardour_key(path, args):
+    if path != '/ardour/routes/gainabs':
+        return None
+    return (int(args[0]), int(round(args[1] * RESOLUTION)))
+
+def touchosc_key(path, args):
+    control = path.rsplit('/', 1)[-1]
+    if not control.startswith('vol_'):
+        return None
+    return (int(control[4:]), int(round(args[0] * RESOLUTION)))
+
+def run_direction(source, sink, key, tracks, rate, duration, settle):
+    source.take()
+    sink.take()
+    sent = source.sweep(tracks, rate, duration, RESOLUTION)
+    time.sleep(settle)
+    received = sink.take()
+    latencies = match(sent, received, key)
+    elapsed = max(sent[-1][0] - sent[0][0], 1e-6)
+    return {'sent': len(sent),
+            'achieved_rate': (len(sent) - 1) / elapsed,
+            'received': len(latencies),
+            'loss': 1.0 - float(len(latencies)) / len(sent),
+            'latency_ms': percentiles(latencies)}, sent, source.take()
+
+def run_step(touchosc, ardour, tracks, rate, duration, settle):
+    to_ardour,sent,echoes = run_direction(touchosc, ardour, ardour_key,
+                                          tracks, rate, duration, settle)
+    to_ardour['echoes_passed_on'] = len(match(sent, echoes, touchosc_key))
+    to_touchosc,_,_ = run_direction(ardour, touchosc, touchosc_key,
+                                    tracks, rate, duration, settle)
+    return {'rate': rate,
+            'touchosc_to_ardour': to_ardour,
+            'ardour_to_touchosc': to_touchosc,
+            'loss': max(to_ardour['loss'], to_touchosc['loss'])}
+
+def start_oscar(args, state_file):
+    s = OscarServer(oscar_port=args.oscar_port,
+                    ardour_ip='127.0.0.1', ardour_port=args.ardour_port,
+                    touchosc_ip='127.0.0.1', touchosc_port=args.touchosc_port,
+                    state_file=state_file, autosave=False,
+                    restore_rate=args.restore_rate, stats_interval=0,
+                    value_cache=not args.no_value_cache,
+                    reconcile_window=args.reconcile_window,
+                    transport=args.transport)
+    s.start()
+    s.persist.restored.wait(60)
+    timeline = dict(s.timeline)
+    return s, {'ready_s': timeline.get('ready'),
+               'restored_s': timeline.get('restored'),
+               'restore_s': (timeline['restored'] - timeline['ready']
+                             if 'restored' in timeline else None),
+               'timeline': timeline}
+
+def restart_ardour(s, ardour, args, timeout=30):
+    # Replaces the fake Ardour with a fresh one (which has lost the state)
+    # once Oscar noticed that the old one is gone
+    n = s.ardour.n_reconnects
+    ardour.stop()
+    ardour.free()
+    t_stop = time.time()
+    while s.ardour.ready() and time.time() - t_stop < timeout:
+        time.sleep(0.01)
+    t_lost = time.time() - t_stop
+    ardour = FakeArdour(args.ardour_port, ardour.reply_to, args.tracks)
+    ardour.start()
+    t_start = time.time()
+    while s.ardour.n_reconnects == n and time.time() - t_start < timeout:
+        time.sleep(0.01)
+    t_reconnected = time.time() - t_start
+    # Until the state has been restored
+    n_controls = 0
+    while time.time() - t_start < timeout:
+        received = [m for m in ardour.received if m[1].startswith('/ardour/routes/')]
+        if len(received) > 0 and len(received) == n_controls:
+            break
+        n_controls = len(received)
+        time.sleep(0.2)
+    return ardour, {'detect_s': t_lost,
+                    'reconnect_s': t_reconnected,
+                    'oscar_recovery_s': s.ardour.recovery_time,
+                    'restored_controls': n_controls}
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--oscar-port', type=int, default=18000)
+    p.add_argument('--ardour-port', type=int, default=13819)
+    p.add_argument('--touchosc-port', type=int, default=19000)
+    p.add_argument('--tracks', type=int, default=12,
+                   help='Number of tracks of the fake Ardour')
+    p.add_argument('--sweep-tracks', type=int, default=4,
+                   help='Number of faders to sweep at the same time')
+    p.add_argument('--rates', default='100,200,500,1000,2000,5000',
+                   help='Sweep rates to step through, in messages per second')
+    p.add_argument('--step-duration', type=float, default=2.0)
+    p.add_argument('--settle', type=float, default=0.5,
+                   help='How long to wait for stragglers after each step')
+    p.add_argument('--max-loss', type=float, default=0.0,
+                   help='Loss above which a rate counts as not sustained')
+    p.add_argument('--restore-rate', type=float, default=100)
+    p.add_argument('--reconcile-window', type=float, default=0.5)
+    p.add_argument('--no-value-cache', action='store_true')
+    p.add_argument('--transport', default='liblo', choices=['liblo', 'udp'],
+                   help='Transport Oscar sends and receives with')
+    p.add_argument('--keep-going', action='store_true',
+                   help='Run all rates, even after one was not sustained')
+    args = p.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    log = logging.getLogger('bench')
+    log.setLevel(logging.INFO)
+
+    tmp = tempfile.mkdtemp()
+    state_file = os.path.join(tmp, 'oscar.state')
+    write_state_file(state_file, args.tracks)
+
+    oscar_address = liblo.Address('127.0.0.1', args.oscar_port)
+    ardour = FakeArdour(args.ardour_port, oscar_address, args.tracks)
+    touchosc = FakeTouchOSC(args.touchosc_port, oscar_address)
+    ardour.start()
+    touchosc.start()
+    results = {'version': oscar.__version__,
+               'python': platform.python_version(),
+               'config': vars(args)}
+    s = None
+    try:
+        log.info('Starting Oscar')
+        s,results['startup'] = start_oscar(args, state_file)
+        s.stop()
+        s.free()
+        s = None
+        log.info('Restarting Oscar')
+        s,results['restart'] = start_oscar(args, state_file)
+        log.info('Restarting Ardour')
+        ardour,results['ardour_restart'] = restart_ardour(s, ardour, args)
+
+        tracks = range(1, min(args.sweep_tracks, args.tracks) + 1)
+        # The sustained rate is the highest rate before the first loss
+        steps = []
+        sustained = None
+        lossy = False
+        for rate in [float(r) for r in args.rates.split(',')]:
+            log.info('Sweeping at {:.0f} messages per second'.format(rate))
+            step = run_step(touchosc, ardour, tracks, rate,
+                            args.step_duration, args.settle)
+            steps.append(step)
+            if step['loss'] > args.max_loss:
+                lossy = True
+                if not args.keep_going:
+                    break
+            elif not lossy:
+                sustained = min(step['touchosc_to_ardour']['achieved_rate'],
+                                step['ardour_to_touchosc']['achieved_rate'])
+        results['steps'] = steps
+        results['sustained_rate'] = sustained
+        results['oscar'] = {'in': s.metrics.total('in'),
+                            'out': s.metrics.total('out'),
+                            'dropped': s.touchosc.n_dropped()}
+    finally:
+        if s is not None:
+            s.stop()
+            s.free()
+        ardour.stop()
+        touchosc.stop()
+        shutil.rmtree(tmp)
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+# Replays a capture (oscar --capture FILE) against a fresh OscarServer with a
+# fake Ardour and a fake TouchOSC on 127.0.0.1: the messages that came in from
+# Ardour are sent by the fake Ardour, the ones from TouchOSC by the fake
+# TouchOSC, either with their original timing or as fast as possible. What
+# Oscar sends to the fakes is then compared with what it sent in the capture.
+# Both start once Oscar restored its state (the capture has a marker for
+# that; the startup traffic before it is not replayed). The differences are
+# printed as a unified diff, one per destination, and a summary goes to
+# stderr. The exit status is 1 if there were differences.
+#
+# For the outbound streams to match, Oscar has to start from the same state
+# as in the captured run, so pass the state file it started with. Paths that
+# depend on timing rather than on the messages (health probes, feedback
+# subscriptions) are ignored.
+#
+# Run from the top-level directory with
+#   $ python bench/replay.py capture.bin --state-file oscar.state
+
+import os
+import sys
+import time
+import shutil
+import struct
+import difflib
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import liblo
+from oscar import OscarServer
+from oscar.capture import read_capture
+from oscar.loopback import FakeArdour, FakeTouchOSC
+
+IGNORE = '/ardour/transport_frame,/routes/'
+
+def format_message(path, args):
+    # Floats go over the wire as 32 bit floats, so compare them as such
+    def fmt(a):
+        if isinstance(a, float):
+            return '{:.6g}'.format(struct.unpack('<f', struct.pack('<f', a))[0])
+        return repr(a)
+    return ' '.join([path] + [fmt(a) for a in args])
+
+def feed(records, ardour, touchosc, oscar_address, fast):
+    t0 = records[0][0]
+    t_start = time.time()
+    for t,origin,endpoint,path,args in records:
+        if not fast:
+            delay = t_start + (t - t0) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        source = ardour if origin == 'in.ardour' else touchosc
+        source.send(oscar_address, path, *args)
+    return time.time() - t_start
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('capture')
+    p.add_argument('--state-file', default=None,
+                   help='State file Oscar started with in the captured run '
+                        '(default: start from the defaults)')
+    p.add_argument('--fast', action='store_true',
+                   help='Replay as fast as possible instead of with the '
+                        'original timing')
+    p.add_argument('--tracks', type=int, default=12,
+                   help='Number of tracks of the fake Ardour')
+    p.add_argument('--settle', type=float, default=1.0,
+                   help='How long to wait for stragglers after replaying')
+    p.add_argument('--ignore', default=IGNORE,
+                   help='Comma separated path prefixes not to compare '
+                        '(default: {})'.format(IGNORE))
+    p.add_argument('--oscar-port', type=int, default=18000)
+    p.add_argument('--ardour-port', type=int, default=13819)
+    p.add_argument('--touchosc-port', type=int, default=19000)
+    args = p.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    log = logging.getLogger('replay')
+    log.setLevel(logging.INFO)
+    ignore = tuple(s for s in args.ignore.split(',') if s)
+
+    records = read_capture(args.capture)
+    for n,r in enumerate(records):
+        if r[1] == 'oscar' and r[3] == '/oscar/restored':
+            records = records[n+1:]
+            break
+    else:
+        log.warning('Oscar did not finish restoring in the capture, '
+                    'replaying all of it')
+    inbound = [r for r in records if r[1].startswith('in.')]
+    if len(inbound) == 0:
+        log.error('No inbound messages in capture "{}"'.format(args.capture))
+        return 2
+    expected = {'ardour': [], 'touchosc': []}
+    for t,origin,endpoint,path,msg_args in records:
+        device = origin[4:]
+        if (origin.startswith('out.') and device in expected and
+            not path.startswith(ignore)):
+            expected[device].append(format_message(path, msg_args))
+
+    tmp = tempfile.mkdtemp()
+    state_file = os.path.join(tmp, 'oscar.state')
+    if args.state_file is not None:
+        shutil.copy(args.state_file, state_file)
+    oscar_address = liblo.Address('127.0.0.1', args.oscar_port)
+    ardour = FakeArdour(args.ardour_port, oscar_address, args.tracks,
+                        echo=False)
+    touchosc = FakeTouchOSC(args.touchosc_port, oscar_address)
+    ardour.start()
+    touchosc.start()
+    s = OscarServer(oscar_port=args.oscar_port,
+                    ardour_ip='127.0.0.1', ardour_port=args.ardour_port,
+                    touchosc_ip='127.0.0.1', touchosc_port=args.touchosc_port,
+                    state_file=state_file, autosave=False, stats_interval=0)
+    try:
+        s.start()
+        s.persist.restored.wait(60)
+        ardour.take()
+        touchosc.take()
+        log.info('Replaying {} messages{}'.format(
+                 len(inbound), ' as fast as possible' if args.fast else ''))
+        duration = feed(inbound, ardour, touchosc, oscar_address, args.fast)
+        time.sleep(args.settle)
+        got = {'ardour': ardour.take(), 'touchosc': touchosc.take()}
+    finally:
+        s.stop()
+        s.free()
+        ardour.stop()
+        touchosc.stop()
+        shutil.rmtree(tmp)
+
+    n_diffs = 0
+    for device in ('ardour', 'touchosc'):
+        received = [format_message(path, msg_args)
+                    for t,path,msg_args in got[device]
+                    if not path.startswith(ignore)]
+        diff = list(difflib.unified_diff(expected[device], received,
+                                         'captured/' + device,
+                                         'replayed/' + device, lineterm=''))
+        n = sum(1 for l in diff if l[:1] in '+-' and l[:3] not in ('+++', '---'))
+        n_diffs += n
+        for l in diff:
+            sys.stdout.write(l + '\n')
+        log.info('{}: {} messages captured, {} replayed, {} lines '
+                 'differ'.format(device, len(expected[device]), len(received),
+                                 n))
+    log.info('Replayed {} messages in {:.2f} seconds'.format(len(inbound),
+                                                            duration))
+    return 1 if n_diffs > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+# Resync check: a tablet that shows up gets every page of the layout, the
+# one it shows right away and the others from the resync thread. The same
+# tablet is resynced twice for every layout, one after the other, first
+# with one page and then with several, so that a resync thread that died on
+# an earlier resync shows. Oscar's TouchOSC
+# sends with the udp transport to a udp transport standing in for the
+# tablet on 127.0.0.1. The results are printed as JSON; the exit status is 1
+# if a tablet did not get all pages.
+#
+# Run from the top-level directory with
+#   $ python bench/resync.py
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from oscar.devicemanager import DeviceManager
+from oscar.routemap import RouteMap
+from oscar.touchosc import TouchOSC
+from oscar.transport import UdpTransport
+
+class Tablet(object):
+    # Records the pages it got messages for
+    def __init__(self, port):
+        self.transport = UdpTransport(port)
+        self.pages = set()
+        self.lock = threading.Lock()
+        self.transport.add_method(None, None, self.record)
+        self.transport.start()
+
+    def record(self, path, args):
+        with self.lock:
+            self.pages.add(path.split('/')[1])
+
+    def take(self):
+        with self.lock:
+            pages = self.pages
+            self.pages = set()
+        return pages
+
+def check(touchosc, tablet, c, n_tracks, rounds, timeout):
+    touchosc.set_routes(RouteMap.default(n_tracks))
+    expected = set(p.lstrip('/') for p in touchosc.pages)
+    problems = []
+    durations = []
+    for k in range(rounds):
+        t_start = time.time()
+        touchosc.resync(c)
+        while tablet.pages != expected and time.time() - t_start < timeout:
+            time.sleep(0.01)
+        durations.append(time.time() - t_start)
+        missing = expected - tablet.take()
+        if missing:
+            problems.append('resync {}: no {}'.format(
+                            k+1, ', '.join(sorted(missing))))
+    t = touchosc.resync_thread
+    if t is not None and not t.is_alive():
+        problems.append('the resync thread died')
+    return {'tracks': n_tracks, 'pages': len(expected),
+            'resync_s': durations, 'problems': problems}
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--port', type=int, default=19100)
+    p.add_argument('--tracks', default='4,12',
+                   help='Layouts to check, by number of tracks (default: '
+                        '4,12, i.e. one and three pages)')
+    p.add_argument('--rounds', type=int, default=2)
+    p.add_argument('--timeout', type=float, default=2.0,
+                   help='How long to wait for all pages')
+    args = p.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    tablet = Tablet(args.port)
+    touchosc = TouchOSC(DeviceManager(), '127.0.0.1', args.port,
+                        resync_rate=10000, transport=UdpTransport())
+    try:
+        c = touchosc.add_client('127.0.0.1', args.port)
+        runs = [check(touchosc, tablet, c, int(n), args.rounds, args.timeout)
+                for n in args.tracks.split(',')]
+    finally:
+        touchosc.stop()
+        touchosc.sender.close()
+        tablet.transport.stop()
+        tablet.transport.free()
+    json.dump({'runs': runs}, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+    return 1 if any(r['problems'] for r in runs) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
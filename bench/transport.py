@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+# Transport benchmark: checks that the transports (see oscar.transport)
+# behave the same, then measures them on 127.0.0.1. For every transport, and
+# with --cross also for every pair of transports, one sends to the other
+#   - conformance: messages of every argument type, bundles, and the
+#     dispatch rules (type tags, the order of the methods, passing a message
+#     on to the next method), which must all arrive as sent,
+#   - throughput: how many messages per second get through when sent as fast
+#     as possible, one per packet and in bundles,
+#   - latency: the time from send to dispatch at a fixed rate, as
+#     percentiles.
+# The results are printed as JSON; progress goes to stderr. The exit status
+# is 1 if a transport failed a check.
+#
+# Run from the top-level directory with
+#   $ python bench/transport.py > results.json
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import oscar
+from oscar.metrics import monotonic
+from oscar.osc import Address
+from oscar.transport import make_transport, TRANSPORTS
+
+def percentiles(ls):
+    # In milliseconds
+    if len(ls) == 0:
+        return None
+    ls = sorted(ls)
+    def at(q):
+        return ls[min(int(q * len(ls)), len(ls)-1)] * 1e3
+    return {'n': len(ls), 'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99),
+            'p999': at(0.999), 'max': ls[-1] * 1e3}
+
+class Receiver(object):
+    # Records (time, path, types, args) of everything dispatched to it
+    def __init__(self, transport):
+        self.transport = transport
+        self.received = []
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+
+    def record(self, path, args, types):
+        t = monotonic()
+        with self.cond:
+            self.received.append((t, path, types, args))
+            self.cond.notify_all()
+
+    def wait_for(self, n, timeout):
+        # Waits until n messages arrived or nothing arrived for timeout seconds
+        with self.cond:
+            while len(self.received) < n:
+                k = len(self.received)
+                self.cond.wait(timeout)
+                if len(self.received) == k:
+                    break
+            return len(self.received)
+
+    def take(self):
+        with self.lock:
+            received = self.received
+            self.received = []
+        return received
+
+# (path, args, type tags as they should arrive)
+MESSAGES = [
+    ('/test/int', [0, 1, -1, 2**31-1, -2**31], 'iiiii'),
+    ('/test/float', [0.0, 0.5, -0.25, 1e10], 'ffff'),
+    ('/test/string', ['', 'a', 'abc', 'abcd', 'x' * 300], 'sssss'),
+    ('/test/long', [2**31, -2**31-1, 2**62], 'hhh'),
+    ('/test/special', [True, False, None], 'TFN'),
+    ('/test/mixed', [1, 0.5, 'track', 7], 'ifsi'),
+    ('/test/noargs', [], ''),
+    ('/oscar_page1/vol_1', [0.75], 'f'),
+]
+
+def f32(v):
+    import struct
+    return struct.unpack('<f', struct.pack('<f', v))[0]
+
+def check_conformance(sender, receiver, settle):
+    # Returns a list of problems
+    problems = []
+    rt = receiver.transport
+    r = Receiver(rt)
+    dispatched = []
+    def typed(path, args, types):
+        dispatched.append(('typed', path))
+    def first(path, args, types, src, user_data):
+        dispatched.append(('first', user_data))
+        # Pass the message on to the next matching method
+        return 1
+    rt.add_method('/dispatch/typed', 'i', typed)
+    rt.add_method('/dispatch/chain', None, first, 'data')
+    rt.add_method(None, None, r.record)
+    rt.start()
+    try:
+        address = Address('127.0.0.1', rt.port)
+        for path,args,types in MESSAGES:
+            sender.send(address, [(path, args)])
+        sender.send(address, [(path, args) for path,args,types in MESSAGES])
+        sender.send(address, [('/dispatch/typed', [1])])
+        sender.send(address, [('/dispatch/typed', [1.0])])
+        sender.send(address, [('/dispatch/chain', [])])
+        n = 2 * len(MESSAGES) + 2
+        r.wait_for(n, settle)
+        got = [(path, types, args) for t,path,types,args in r.take()]
+        expected = [(path, types,
+                     [f32(a) if isinstance(a, float) else a for a in args])
+                    for path,args,types in MESSAGES] * 2
+        expected += [('/dispatch/typed', 'f', [1.0]),
+                     ('/dispatch/chain', '', [])]
+        if got != expected:
+            for k in range(max(len(got), len(expected))):
+                g = got[k] if k < len(got) else None
+                e = expected[k] if k < len(expected) else None
+                if g != e:
+                    problems.append('message {}: expected {!r}, got {!r}'.format(
+                                    k, e, g))
+        if dispatched != [('typed', '/dispatch/typed'), ('first', 'data')]:
+            problems.append('dispatch: got {!r}'.format(dispatched))
+    finally:
+        rt.stop()
+    return problems
+
+def run_throughput(sender, receiver, n, bundle_size, settle):
+    r = Receiver(receiver.transport)
+    receiver.transport.add_method('/bench/tp', None, r.record)
+    receiver.transport.start()
+    try:
+        address = Address('127.0.0.1', receiver.transport.port)
+        ms = [('/bench/tp', [k, 0.5]) for k in range(n)]
+        t_start = monotonic()
+        for k in range(0, n, bundle_size):
+            sender.send(address, ms[k:k+bundle_size])
+        t_sent = monotonic()
+        r.wait_for(n, settle)
+        received = r.take()
+    finally:
+        receiver.transport.stop()
+    t_end = received[-1][0] if len(received) > 0 else t_sent
+    duration = max(t_end - t_start, 1e-6)
+    return {'bundle_size': bundle_size, 'sent': n, 'received': len(received),
+            'loss': 1.0 - float(len(received)) / n,
+            'send_rate': n / max(t_sent - t_start, 1e-6),
+            'rate': len(received) / duration}
+
+def run_latency(sender, receiver, rate, duration, settle):
+    r = Receiver(receiver.transport)
+    receiver.transport.add_method('/bench/lat', None, r.record)
+    receiver.transport.start()
+    try:
+        address = Address('127.0.0.1', receiver.transport.port)
+        n = int(rate * duration)
+        t_sent = []
+        t_start = monotonic()
+        for k in range(n):
+            delay = t_start + k / rate - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            t_sent.append(monotonic())
+            sender.send(address, [('/bench/lat', [k])])
+        r.wait_for(n, settle)
+        received = r.take()
+    finally:
+        receiver.transport.stop()
+    latencies = [t - t_sent[args[0]] for t,path,types,args in received]
+    return {'rate': rate, 'sent': n, 'received': len(received),
+            'latency_ms': percentiles(latencies)}
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--transports', default=','.join(TRANSPORTS),
+                   help='Transports to compare (default: {})'.format(
+                        ','.join(TRANSPORTS)))
+    p.add_argument('--cross', action='store_true',
+                   help='Also run every pair of different transports')
+    p.add_argument('--port', type=int, default=18100)
+    p.add_argument('--messages', type=int, default=20000,
+                   help='Messages per throughput run')
+    p.add_argument('--bundle-size', type=int, default=10)
+    p.add_argument('--latency-rate', type=float, default=2000)
+    p.add_argument('--latency-duration', type=float, default=3.0)
+    p.add_argument('--rcvbuf', type=int, default=0)
+    p.add_argument('--sndbuf', type=int, default=0)
+    p.add_argument('--settle', type=float, default=0.5,
+                   help='How long to wait for stragglers')
+    args = p.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    log = logging.getLogger('bench')
+    log.setLevel(logging.INFO)
+
+    names = [s for s in args.transports.split(',') if s]
+    pairs = [(a, b) for a in names for b in names if args.cross or a == b]
+    results = {'version': oscar.__version__,
+               'python': platform.python_version(),
+               'config': vars(args),
+               'runs': []}
+    failed = False
+    for k,(a,b) in enumerate(pairs):
+        log.info('{} -> {}'.format(a, b))
+        port = args.port + k
+        run = {'sender': a, 'receiver': b}
+        sender = make_transport(a, sndbuf=args.sndbuf)
+        def receiver():
+            # A fresh receiver per measurement, so that methods do not pile up
+            return Receiver(make_transport(b, port, args.rcvbuf))
+        def measure(f, *f_args):
+            rec = receiver()
+            try:
+                return f(sender, rec, *f_args)
+            finally:
+                rec.transport.free()
+        run['problems'] = measure(check_conformance, args.settle)
+        if run['problems']:
+            failed = True
+            for problem in run['problems']:
+                log.error('{} -> {}: {}'.format(a, b, problem))
+        run['throughput'] = [measure(run_throughput, args.messages, 1,
+                                     args.settle),
+                             measure(run_throughput, args.messages,
+                                     args.bundle_size, args.settle)]
+        run['latency'] = measure(run_latency, args.latency_rate,
+                                 args.latency_duration, args.settle)
+        results['runs'].append(run)
+        sender.free()
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,65 @@
+import json
 import logging
 import argparse
 from oscar import OscarServer
 from oscar import __version__
 
+def rate(v):
+    # Rates below one per second would take forever
+    return max(float(v), 1.0)
+
+def milliseconds(v):
+    # In seconds
+    return float(v) / 1000.0
+
+def fsync_policy(v):
+    if v not in ('always', 'interval', 'never'):
+        raise ValueError(v)
+    return v
+
+def flag(v):
+    if not isinstance(v, bool):
+        raise ValueError(v)
+    return v
+
+# How to turn the group options in a config file into the arguments of
+# OscarServer, the same way as the corresponding command line options; the
+# other options are taken as they are
+GROUP_CONVERSIONS = {'ardour_action_delay': milliseconds,
+                     'coalesce_interval': milliseconds,
+                     'restore_rate': rate, 'scene_rate': rate,
+                     'resync_rate': rate, 'resync_idle': float,
+                     'touchosc_queue_size': int, 'inbound_queue_size': int,
+                     'reconcile_window': float, 'journal_fsync_interval': float,
+                     'journal_fsync': fsync_policy, 'ardour_bundles': flag,
+                     'touchosc_bundles': flag, 'touchosc_page_filter': flag,
+                     'persist_state': flag, 'restore_bundles': flag,
+                     'journal': flag, 'value_cache': flag}
+
+def read_config(filename):
+    # The groups in the config file, with their options converted; raises
+    # ValueError for an invalid config
+    try:
+        with open(filename) as f:
+            groups = json.load(f)['groups']
+    except IOError, e:
+        raise ValueError('Cannot read config file "{}": {}'.format(
+                         filename, e.strerror))
+    except (KeyError, TypeError):
+        raise ValueError('Config file "{}" has no groups'.format(filename))
+    options = []
+    for k,group in enumerate(groups):
+        o = {}
+        for key,v in group.iteritems():
+            convert = GROUP_CONVERSIONS.get(key)
+            try:
+                o[str(key)] = v if convert is None else convert(v)
+            except (TypeError, ValueError):
+                raise ValueError('Invalid {} for group {}: {}'.format(
+                                 key, k+1, json.dumps(v)))
+        options.append(o)
+    return options
+
 def main():
     # Command line arguments
     p = argparse.ArgumentParser(prog='oscar')
@@ -16,15 +73,59 @@ def main():
     p.add_argument('--touchosc-port',
                    default='9000',
                    help='Port of TouchOSC (default: 9000)')
+    p.add_argument('--touchosc-match',
+                   default=None,
+                   help='Only use the TouchOSC discovered via Zeroconf whose '
+                        'name contains this (default: all of them)')
+    p.add_argument('--touchosc-page-filter',
+                   action='store_true',
+                   help='Only send each TouchOSC the updates for the page it '
+                        'is showing')
+    p.add_argument('--touchosc-queue-size',
+                   default=256,
+                   help='How many packets to queue for each TouchOSC before '
+                        'dropping them (default: 256)')
+    p.add_argument('--touchosc-resync-rate',
+                   default=200,
+                   help='When a TouchOSC shows up or comes back, send it the '
+                        'page it shows right away and the other pages at this '
+                        'many controls per second (default: 200)')
+    p.add_argument('--touchosc-resync-idle',
+                   default=60,
+                   help='Resync a TouchOSC that did not send anything for this '
+                        'many seconds when it does again (default: 60)')
     p.add_argument('--ardour-ip',
                    default='127.0.0.1',
                    help='IP address of Ardour (default: 127.0.0.1)')
     p.add_argument('--ardour-port',
                    default='3819',
                    help='Port of Ardour (default: 3819)')
+    p.add_argument('--ardour-session',
+                   default=None,
+                   help='Ardour session file to read the tracks from '
+                        '(default: ask Ardour for its tracks on startup)')
+    p.add_argument('--ardour-action-delay',
+                   default=20,
+                   help='Milliseconds between the steps of multi-step Ardour '
+                        'actions, e.g. removing all regions on a track '
+                        '(default: 20)')
     p.add_argument('--oscar-port',
                    default='8000',
                    help='Port we are listening on (default: 8000)')
+    p.add_argument('--transport',
+                   default='liblo',
+                   choices=['liblo', 'udp'],
+                   help='How to send and receive OSC: with liblo, or in pure '
+                        'Python on a UDP socket, which can set the socket '
+                        'buffer sizes (default: liblo)')
+    p.add_argument('--rcvbuf',
+                   default=0,
+                   help='Socket receive buffer size in bytes (default: 0, '
+                        'the system default)')
+    p.add_argument('--sndbuf',
+                   default=0,
+                   help='Socket send buffer size in bytes, only with '
+                        '--transport udp (default: 0, the system default)')
     p.add_argument('--no-persist-state',
                    action='store_true',
                    help='Do not persist the state to the state file')
@@ -36,7 +137,94 @@ def main():
                    help='Do not periodically save state to the state file')
     p.add_argument('--autosave-interval',
                    default=60,
-                   help='How often to save state to the state file, in seconds (default: 60)')
+                   help='Save changes to the state file at the latest this many '
+                        'seconds after they happened (default: 60)')
+    p.add_argument('--autosave-delay',
+                   default=2,
+                   help='Save changes to the state file once there were no '
+                        'further changes for this many seconds (default: 2)')
+    p.add_argument('--no-journal',
+                   action='store_true',
+                   help='Do not journal every change next to the state file, '
+                        'only save the state periodically')
+    p.add_argument('--journal-fsync',
+                   default='interval',
+                   choices=['always', 'interval', 'never'],
+                   help='When to fsync the journal: after every change, at '
+                        'most every --journal-fsync-interval seconds, or never '
+                        '(default: interval)')
+    p.add_argument('--journal-fsync-interval',
+                   default=1.0,
+                   help='Write out and fsync the journal at most this many '
+                        'seconds after a change (default: 1.0)')
+    p.add_argument('--coalesce-interval',
+                   default=0,
+                   help='Only forward the latest value of continuous controls '
+                        '(volume, pan, send) every so many milliseconds '
+                        '(default: 0, forward every value)')
+    p.add_argument('--no-ardour-bundles',
+                   action='store_true',
+                   help='Send every message to Ardour separately instead of '
+                        'in OSC bundles')
+    p.add_argument('--no-touchosc-bundles',
+                   action='store_true',
+                   help='Send every message to TouchOSC separately instead of '
+                        'in OSC bundles')
+    p.add_argument('--restore-rate',
+                   default=100,
+                   help='How many controls per second to send when restoring '
+                        'the state (default: 100)')
+    p.add_argument('--no-restore-bundles',
+                   action='store_true',
+                   help='When restoring the state, do not send each track as '
+                        'one bundle')
+    p.add_argument('--reconcile-window',
+                   default=0.5,
+                   help='On startup, collect what Ardour reports for up to '
+                        'this many seconds and only restore the settings that '
+                        'differ; 0 to always restore all settings (default: '
+                        '0.5)')
+    p.add_argument('--scene-rate',
+                   default=1000,
+                   help='How many controls per second to send when recalling '
+                        'a scene; only the controls that differ from the '
+                        'current state are sent (default: 1000)')
+    p.add_argument('--startup-timeout',
+                   default=60,
+                   help='How long to wait for Ardour and TouchOSC on startup, '
+                        'in seconds (default: 60)')
+    p.add_argument('--no-value-cache',
+                   action='store_true',
+                   help='Send every value, even if the destination already '
+                        'has it, and pass on Ardour\'s echoes of what we sent')
+    p.add_argument('--stats-interval',
+                   default=60,
+                   help='Log a summary of message rates, latencies and queue '
+                        'depths every so many seconds; 0 to turn it off '
+                        '(default: 60)')
+    p.add_argument('--trace-size',
+                   default=4096,
+                   help='How many of the most recent messages to keep in '
+                        'memory for tracing; 0 to turn it off (default: 4096)')
+    p.add_argument('--trace-file',
+                   default='oscar.trace',
+                   help='File to write the trace to when handling a message '
+                        'fails or when asked to with /oscar/trace (default: '
+                        'oscar.trace)')
+    p.add_argument('--capture',
+                   default=None,
+                   metavar='FILE',
+                   help='Record all messages in and out to FILE, for '
+                        'replaying them with bench/replay.py')
+    p.add_argument('--config',
+                   default=None,
+                   metavar='FILE',
+                   help='Serve several device groups (Ardour, TouchOSC and '
+                        'state file) from one process, as listed in the JSON '
+                        'FILE as {"groups": [{"name": ..., "ardour_port": ..., '
+                        '"state_file": ..., ...}, ...]}, with the values in '
+                        'the units of the command line options; the options '
+                        'not set for a group are taken from the command line')
     p.add_argument('--version',
                    action='version',
                    version='%(prog)s {}'.format(__version__),
@@ -58,15 +246,57 @@ def main():
     autosave_interval = float(args.autosave_interval)
     if autosave_interval < 1.0:
         autosave_interval = 1.0
-    s = OscarServer(touchosc_ip=args.touchosc_ip,
-                    touchosc_port=args.touchosc_port,
-                    ardour_ip=args.ardour_ip,
-                    ardour_port=args.ardour_port,
-                    oscar_port=args.oscar_port,
-                    persist_state=not args.no_persist_state,
-                    state_file=args.state_file,
-                    autosave=not args.no_autosave,
-                    autosave_interval=autosave_interval)
+    autosave_delay = min(float(args.autosave_delay), autosave_interval)
+    startup_timeout = float(args.startup_timeout)
+    groups = None
+    if args.config is not None:
+        try:
+            groups = read_config(args.config)
+        except ValueError, e:
+            p.error(str(e))
+    try:
+        s = OscarServer(touchosc_ip=args.touchosc_ip,
+                        touchosc_port=args.touchosc_port,
+                        ardour_ip=args.ardour_ip,
+                        ardour_port=args.ardour_port,
+                        oscar_port=args.oscar_port,
+                        persist_state=not args.no_persist_state,
+                        state_file=args.state_file,
+                        autosave=not args.no_autosave,
+                        autosave_interval=autosave_interval,
+                        autosave_delay=autosave_delay,
+                        coalesce_interval=milliseconds(args.coalesce_interval),
+                        ardour_bundles=not args.no_ardour_bundles,
+                        touchosc_bundles=not args.no_touchosc_bundles,
+                        restore_rate=rate(args.restore_rate),
+                        restore_bundles=not args.no_restore_bundles,
+                        startup_timeout=startup_timeout,
+                        touchosc_page_filter=args.touchosc_page_filter,
+                        touchosc_queue_size=int(args.touchosc_queue_size),
+                        ardour_session=args.ardour_session,
+                        stats_interval=float(args.stats_interval),
+                        value_cache=not args.no_value_cache,
+                        trace_size=int(args.trace_size),
+                        trace_file=args.trace_file,
+                        journal=not args.no_journal,
+                        journal_fsync=args.journal_fsync,
+                        journal_fsync_interval=float(
+                            args.journal_fsync_interval),
+                        scene_rate=rate(args.scene_rate),
+                        reconcile_window=float(args.reconcile_window),
+                        resync_rate=rate(args.touchosc_resync_rate),
+                        resync_idle=float(args.touchosc_resync_idle),
+                        capture_file=args.capture,
+                        ardour_action_delay=milliseconds(
+                            args.ardour_action_delay),
+                        transport=args.transport,
+                        rcvbuf=int(args.rcvbuf),
+                        sndbuf=int(args.sndbuf),
+                        touchosc_match=args.touchosc_match,
+                        groups=groups)
+    except ValueError, e:
+        # Invalid groups
+        p.error(str(e))
     s.start()
     while True:
         k = raw_input('Press q to quit.\n')
@@ -1,6 +1,13 @@
-import liblo
 import logging
 import time
+import threading
+from .metrics import monotonic
+from .osc import Address, AddressError
+from .oscsender import OscSender
+from .routing import RouteTable
+from .routemap import RouteMap
+from .scheduler import Scheduler
+from .valuecache import ValueCache
 
 # At least at the moment, with Ardour 3.5.403, controlling plugin parameters via
 # OSC seems to crash Ardour. E.g.
@@ -9,83 +16,293 @@ import time
 # s.ardour.sendosc('/ardour/routes/plugin/parameter', 5, 1, 1, 0.1)
 
 class Ardour(object):
-    def __init__(self, dm, ip='127.0.0.1', port=3819):
+    def __init__(self, dm, ip='127.0.0.1', port=3819, bundle=True,
+                 routemap=None, metrics=None, value_cache=True, trace=None,
+                 probe_interval=1.0, probe_timeout=1.0, max_backoff=2.0,
+                 capture=None, scheduler=None, action_delay=0.02,
+                 transport=None):
         self.log = logging.getLogger(__name__)
         self.name = 'ardour'
-        self.master_id = 318
-        self.n_tracks = 12
-        # The Ardour bus ids. This is hardcoded for now. 318 is the master bus.
-        self.ids = range(1,self.n_tracks+1) + [self.master_id]
+        # The Ardour remote control ids of our tracks. Unless we were given a
+        # route map (e.g. read from the session file) we ask Ardour for its
+        # tracks on startup; until then we assume the default twelve tracks.
+        self.discover_routes = routemap is None
+        self.routemap = routemap or RouteMap.default()
+        self.n_tracks = self.routemap.n_tracks
+        # Subscribe to feedback for at most this many routes per message
+        self.listen_chunk_size = 32
+        self.route_list = {}
+        self.route_list_done = threading.Event()
         self.dm = dm
         self.ip = ip
         self.port = port
         self.c = None
+        self.sender = OscSender(bundle, metrics=metrics, name=self.name,
+                                trace=trace, key=self.continuous_key,
+                                capture=capture, transport=transport)
         self.is_ready = False
+        self.replied = threading.Event()
 
-    def __del__(self):
-        self.stop_listening_to_feedback()
+        # Health monitor: once Ardour has been quiet for probe_interval
+        # seconds, we ask it for the transport position, which it answers with
+        # a #reply. No answer within probe_timeout seconds means Ardour is
+        # gone (or restarting); we keep asking, backing off to max_backoff
+        # seconds, and when it is back, subscribe to feedback again and have
+        # the devices reconcile their state with it. A restart of Ardour takes
+        # longer than probing, so it always shows up as a gap.
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.max_backoff = max_backoff
+        self.last_heard = 0.0
+        self.t_lost = None
+        self.monitor_thread = None
+        self.exit_monitor = threading.Event()
+        self.n_reconnects = 0
+        self.recovery_time = None
+
+        # Multi-step actions (macros) run from the scheduler, with
+        # action_delay seconds between the steps so that Ardour has done one
+        # before the next comes in, instead of as one bundle that Ardour works
+        # through faster than its editor updates. A macro started again while
+        # it is still running is cancelled and starts over.
+        self.own_scheduler = scheduler is None
+        self.scheduler = Scheduler('ardour') if scheduler is None else scheduler
+        self.action_delay = action_delay
+        self.macros = {}
+        self.macros_lock = threading.Lock()
+
+        self.continuous_paths = frozenset(['/ardour/routes/gainabs',
+                                           '/ardour/routes/pan_stereo_position'])
+
+        # Feedback paths from Ardour and the corresponding device methods.
+        # Note: I do not know how to get feedback for changes in ardour to
+        # sends and pan; so this only works in one direction (TouchOSC ->
+        # Ardour) for now
+        self.feedback_controls = {'gain': 'vol', 'mute': 'mute',
+                                  'solo': 'solo', 'rec': 'record'}
+        self.compile_routes()
+
+        # What Ardour's tracks are set to, so that we neither send values
+        # Ardour already has nor pass on Ardour's echoes of what we sent
+        self.cache = ValueCache(value_cache,
+                                echo_controls=self.feedback_controls.values())
 
     def sendosc(self, path, *args):
         if self.c is not None:
-            liblo.send(self.c, path, *args)
+            self.sender.send(self.c, path, *args)
 
-    def handle_osc(self, path, args):
+    def begin_batch(self):
+        self.sender.begin()
+
+    def end_batch(self):
+        self.sender.end()
+
+    def continuous_key(self, path, args):
+        # Continuous values are keyed by path and track (and send)
+        if path == '/ardour/routes/send/gainabs':
+            return (path, args[0], args[1])
+        if path in self.continuous_paths:
+            return (path, args[0])
+        return None
+
+    def inbound_key(self, route, path, args):
+        # Inbound gain feedback may be superseded by newer feedback for the
+        # same track
+        if route[1] == 'vol' and len(args) > 0:
+            return (path, args[0])
+        return None
+
+    def compile_routes(self):
+        # Ardour reports the track id as the first argument, so there is one
+        # route per control
+        self.routes = RouteTable(self.parse_path)
+        self.routes.add('#reply', (self.on_reply, None))
+        for control,method in self.feedback_controls.iteritems():
+            self.routes.add('/route/' + control, (self.on_feedback, method))
+
+    def parse_path(self, path):
         if path.startswith('#reply'):
-            self.is_ready = True
-            return
+            return (self.on_reply, None)
         if not path.startswith('/route/'):
-            return
+            return None
         segments = path.strip(' /').split('/')
         if len(segments) != 2:
-            return
-        control = segments[1]
+            return None
+        method = self.feedback_controls.get(segments[1])
+        if method is None:
+            return None
+        return (self.on_feedback, method)
+
+    def handle_osc(self, path, args):
+        route = self.routes.lookup(path)
+        if route is not None:
+            self.handle_route(route, args)
 
+    def handle_route(self, route, args):
+        f,method = route
+        f(method, args)
+
+    def on_reply(self, method, args):
+        # Replies to /routes/list are one message per route --- type, name,
+        # inputs, outputs, muted, soloed, remote id --- and an end marker
+        if len(args) >= 7 and args[0] in ('AT', 'MT', 'B'):
+            self.route_list[int(args[6])] = (args[0], args[1])
+        elif len(args) >= 1 and args[0] == 'end_route_list':
+            self.route_list_done.set()
+        self.last_heard = monotonic()
+        self.replied.set()
+
+    def on_feedback(self, method, args):
+        self.last_heard = monotonic()
         if len(args) != 2:
             return
-        i = int(args[0])
+        i = self.routemap.from_ardour(int(args[0]))
         v = float(args[1])
+        if i is None or self.cache.echo(method, i, v):
+            return
+        self.cache.seen(method, i, v)
 
-        i = self._convert_from_ardour_id(i)
-
-        if control == 'gain':
-            self.log.debug('got {} {} {:.2f}'.format('gain', i, v))
-            self.dm.vol(i, v, ignore=self.name)
-        elif control == 'mute':
-            self.log.debug('got {} {} {}'.format('mute', i, v))
-            self.dm.mute(i, v, ignore=self.name)
-        elif control == 'solo':
-            self.log.debug('got {} {} {}'.format('solo', i, v))
-            self.dm.solo(i, v, ignore=self.name)
-        elif control == 'rec':
-            self.log.debug('got {} {} {}'.format('rec', i, v))
-            self.dm.record(i, v, ignore=self.name)
-        # Note: I do not know how to get feedback for changes in ardour to sends
-        # and pan; so this only works in one direction (TouchOSC -> Ardour) for
-        # now
-
-    def start(self):
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('got {} {} {:.2f}'.format(method, i, v))
+        self.dm.report(method, i, v, ignore=self.name)
+
+    def start(self, timeout=60):
         self.is_ready = False
+        self.cache.clear()
         try:
-            self.c = liblo.Address(self.ip, self.port)
-        except liblo.AddressError, e:
+            self.c = Address(self.ip, self.port)
+        except AddressError, e:
             self.log.error('Could not connect to Ardour.')
             return
+        self.log.info('Waiting for feedback from Ardour')
+        if not self.connect(timeout):
+            self.log.error('I did not hear back from Ardour for {} seconds, '
+                           'giving up for now'.format(timeout))
+        else:
+            self.log.info('Ardour is ready')
+        # The monitor takes over, also if Ardour is not there yet
+        self.exit_monitor.clear()
+        self.monitor_thread = threading.Thread(target=self.monitor_run)
+        self.monitor_thread.daemon = True
+        self.monitor_thread.start()
 
-        timeout = 60
-        t = 0
-        while not self.is_ready:
-            self.sendosc('/routes/listen', *self.ids)
-            self.log.info('Waiting for feedback from Ardour')
-            time.sleep(1)
-            t += 1
-            if t>timeout:
-                self.log.error('I did not hear back from Ardour for {} '
-                               'seconds, giving up'.format(timeout))
+    def connect(self, timeout):
+        # Ask for feedback (and the routes) until Ardour replies; retry
+        # quickly at first, then back off to once per second. Returns whether
+        # Ardour replied within timeout seconds.
+        self.replied.clear()
+        self.route_list = {}
+        self.route_list_done.clear()
+        t_start = time.time()
+        interval = 0.05
+        while True:
+            self.listen()
+            if self.discover_routes:
+                self.sendosc('/routes/list')
+            remaining = t_start + timeout - time.time()
+            if remaining <= 0:
+                return False
+            if self.replied.wait(min(interval, remaining)):
+                break
+            if self.exit_monitor.is_set():
+                return False
+            interval = min(2*interval, 1.0)
+            self.log.debug('Still waiting for feedback from Ardour')
+        if self.discover_routes:
+            self.route_list_done.wait(min(1.0, max(t_start + timeout - time.time(), 0)))
+            self.use_route_list()
+        self.is_ready = True
+        return True
+
+    def monitor_run(self):
+        # Sleeps until Ardour has been quiet for probe_interval seconds; never
+        # polls
+        while not self.exit_monitor.is_set():
+            if not self.is_ready:
+                self.reconnect()
+                continue
+            idle = monotonic() - self.last_heard
+            if idle < self.probe_interval:
+                self.exit_monitor.wait(self.probe_interval - idle)
+                continue
+            t_probe = monotonic()
+            self.sendosc('/ardour/transport_frame')
+            if self.exit_monitor.wait(self.probe_timeout):
+                return
+            if self.last_heard < t_probe:
+                self.is_ready = False
+                self.t_lost = t_probe
+                self.log.warning('Lost Ardour: no reply for {:.1f} '
+                                 'seconds'.format(monotonic() - t_probe))
+
+    def reconnect(self):
+        # Probe with backoff until Ardour answers, then subscribe again and
+        # reconcile
+        t_lost = self.t_lost if self.t_lost is not None else monotonic()
+        interval = 0.05
+        while True:
+            t_probe = monotonic()
+            self.replied.clear()
+            self.sendosc('/ardour/transport_frame')
+            if self.replied.wait(interval) and self.last_heard >= t_probe:
+                break
+            if self.exit_monitor.wait(0):
                 return
-        self.log.info('Ardour is ready')
+            interval = min(2*interval, self.max_backoff)
+        self.log.info('Ardour is back, subscribing to feedback again')
+        self.cache.clear()
+        # The devices start collecting what Ardour reports before we ask it to
+        self.dm.reconcile(ignore=self.name)
+        if not self.connect(self.probe_timeout + self.max_backoff):
+            return
+        self.n_reconnects += 1
+        self.t_lost = None
+        self.recovery_time = monotonic() - t_lost
+        self.log.info('Reconnected to Ardour {:.2f} seconds after losing it '
+                      '({:.2f} seconds after it was back)'.format(
+                      self.recovery_time, monotonic() - t_probe))
+
+    def use_route_list(self):
+        # Our tracks are Ardour's audio and midi tracks, in the order of their
+        # remote ids; the master bus is not in the route list
+        ids = sorted(rid for rid,(t,name) in self.route_list.iteritems()
+                     if t in ('AT', 'MT'))
+        if len(ids) == 0:
+            self.log.warning('Ardour did not list its routes, assuming {} '
+                             'tracks'.format(self.n_tracks))
+            return
+        routemap = RouteMap(ids)
+        self.log.info('Ardour has {} tracks'.format(routemap.n_tracks))
+        if routemap != self.routemap:
+            self.set_routes(routemap)
+            self.dm.set_routes(routemap, ignore=self.name)
+            self.listen()
+
+    def set_routes(self, routemap):
+        self.routemap = routemap
+        self.n_tracks = routemap.n_tracks
+
+    def listen(self):
+        self.begin_batch()
+        for ids in self.routemap.chunks(self.listen_chunk_size):
+            self.sendosc('/routes/listen', *ids)
+        self.end_batch()
 
     def stop(self):
-        self.sendosc('/routes/ignore', *self.ids)
+        self.exit_monitor.set()
+        if self.monitor_thread is not None:
+            self.monitor_thread.join()
+            self.monitor_thread = None
+        with self.macros_lock:
+            for m in self.macros.values():
+                m.cancel()
+            self.macros = {}
+        if self.own_scheduler:
+            self.scheduler.stop()
+        self.begin_batch()
+        for ids in self.routemap.chunks(self.listen_chunk_size):
+            self.sendosc('/routes/ignore', *ids)
+        self.end_batch()
         self.is_ready = False
         self.c = None
 
@@ -93,33 +310,36 @@ class Ardour(object):
         return self.is_ready
 
     def vol(self, i, v):
-        i = self._convert_to_ardour_id(i)
-        self.sendosc('/ardour/routes/gainabs', i, v)
+        self._send_track('vol', '/ardour/routes/gainabs', i, v)
 
     def mute(self, i, v):
-        i = self._convert_to_ardour_id(i)
-        self.sendosc('/ardour/routes/mute', i, v)
+        self._send_track('mute', '/ardour/routes/mute', i, v)
 
     def solo(self, i, v):
-        i = self._convert_to_ardour_id(i)
-        self.sendosc('/ardour/routes/solo', i, v)
+        self._send_track('solo', '/ardour/routes/solo', i, v)
 
     def record(self, i, v):
-        i = self._convert_to_ardour_id(i)
-        self.sendosc('/ardour/routes/recenable', i, v)
+        self._send_track('record', '/ardour/routes/recenable', i, v)
 
     def pan(self, i, v):
-        i = self._convert_to_ardour_id(i)
-        self.sendosc('/ardour/routes/pan_stereo_position', i, v)
+        self._send_track('pan', '/ardour/routes/pan_stereo_position', i, v)
 
     def send(self, i, j, v):
-        i = self._convert_to_ardour_id(i)
-        self.sendosc('/ardour/routes/send/gainabs', i, j, v)
+        rid = self.routemap.to_ardour(i)
+        if rid is None or self.cache.unchanged('send', (i, j), v):
+            return
+        self.sendosc('/ardour/routes/send/gainabs', rid, j, v)
+
+    def _send_track(self, control, path, i, v):
+        rid = self.routemap.to_ardour(i)
+        if rid is None or self.cache.unchanged(control, i, v):
+            return
+        self.sendosc(path, rid, v)
 
     def play(self):
         self.sendosc('/ardour/transport_play')
 
-    def stop(self):
+    def transport_stop(self):
         self.sendosc('/ardour/transport_stop')
 
     def recordglobal(self):
@@ -140,26 +360,28 @@ class Ardour(object):
     def redo(self):
         self.sendosc('/ardour/redo')
 
-    def remove_all_regions_on_track(self, i):
+    def run_macro(self, name, actions):
+        # Runs the editor actions one after the other, action_delay seconds
+        # apart
+        steps = [(0 if k == 0 else self.action_delay, self.sendosc,
+                  ('/ardour/access_action', a))
+                 for k,a in enumerate(actions)]
+        with self.macros_lock:
+            m = self.macros.pop(name, None)
+            if m is not None and not m.finished():
+                self.log.info('Restarting macro "{}"'.format(name))
+                m.cancel()
+            self.macros[name] = self.scheduler.run_sequence(steps)
+
+    def region_removal_actions(self, i):
         # This might be pretty fragile and at any rate is very tightly coupled
         # to the Ardour template / layout of tracks
+        return (['Editor/deselect-all'] +
+                ['Editor/select-next-route'] * (i+1) +
+                ['Editor/select-all', 'Region/remove-region',
+                 'Editor/deselect-all'])
+
+    def remove_all_regions_on_track(self, i):
         if i<1 or i>self.n_tracks:
             return
-        self.sendosc('/ardour/access_action', 'Editor/deselect-all')
-        for j in range(i+1):
-            self.sendosc('/ardour/access_action', 'Editor/select-next-route')
-        self.sendosc('/ardour/access_action', 'Editor/select-all')
-        self.sendosc('/ardour/access_action', 'Region/remove-region')
-        self.sendosc('/ardour/access_action', 'Editor/deselect-all')
-
-    def _convert_to_ardour_id(self, i):
-        if i==0:
-            return self.master_id
-        else:
-            return i
-
-    def _convert_from_ardour_id(self, i):
-        if i==self.master_id:
-            return 0
-        else:
-            return i
+        self.run_macro('remove_regions', self.region_removal_actions(i))
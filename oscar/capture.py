@@ -0,0 +1,137 @@
+import logging
+import struct
+import threading
+import time
+
+# A capture file is a header followed by records of two kinds: a string
+# definition (id, length, bytes), which comes before the first message that
+# uses the string, and a message: time, origin (e.g. "in.ardour"), endpoint
+# (where it came from or went to), path and the number of arguments, followed
+# by every argument as its type ('i', 'f' or 's') and eight bytes of value. A
+# string argument's value is its string id. Origins, endpoints and paths are
+# strings, too.
+HEADER = 'OSCC\x01\x00\x00\x00'
+STRING = struct.Struct('<BII')
+MESSAGE = struct.Struct('<BdIIIB')
+INT_ARG = struct.Struct('<cq')
+FLOAT_ARG = struct.Struct('<cd')
+_STRING = 0
+_MESSAGE = 1
+
+class Capture(object):
+    # Records all messages in and out to a file, for reproducing production
+    # load and bugs with the replay tool (bench/replay.py). Records are packed
+    # into a buffer, which is written out whenever it exceeds buffer_size
+    # bytes and on close(). Recording takes a lock, since messages come in on
+    # the liblo thread and go out on the send queue workers.
+    def __init__(self, filename, buffer_size=65536):
+        self.log = logging.getLogger(__name__)
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+        self.buf = bytearray()
+        self.string_ids = {}
+        self.f = open(filename, 'wb')
+        self.f.write(HEADER)
+        self.n_messages = 0
+
+    def _string_id(self, s):
+        # Must be called with the lock held
+        k = self.string_ids.get(s)
+        if k is None:
+            if isinstance(s, unicode):
+                b = s.encode('utf-8')
+            else:
+                b = str(s)
+            k = self.string_ids[s] = len(self.string_ids)
+            self.buf += STRING.pack(_STRING, k, len(b))
+            self.buf += b
+        return k
+
+    def record(self, origin, endpoint, path, args):
+        t = time.time()
+        with self.lock:
+            if self.f is None:
+                return
+            header = MESSAGE.pack(_MESSAGE, t, self._string_id(origin),
+                                  self._string_id(endpoint),
+                                  self._string_id(path), min(len(args), 255))
+            packed = []
+            for a in args[:255]:
+                if isinstance(a, float):
+                    packed.append(FLOAT_ARG.pack('f', a))
+                elif isinstance(a, (int, long)) and -2**63 <= a < 2**63:
+                    packed.append(INT_ARG.pack('i', a))
+                else:
+                    if not isinstance(a, basestring):
+                        a = repr(a)
+                    packed.append(INT_ARG.pack('s', self._string_id(a)))
+            self.buf += header
+            for p in packed:
+                self.buf += p
+            self.n_messages += 1
+            if len(self.buf) >= self.buffer_size:
+                self._write()
+
+    def _write(self):
+        # Must be called with the lock held
+        try:
+            self.f.write(self.buf)
+        except IOError:
+            self.log.exception('Could not write capture file '
+                               '"{}"'.format(self.filename))
+        self.buf = bytearray()
+
+    def close(self):
+        with self.lock:
+            if self.f is None:
+                return
+            self._write()
+            self.f.close()
+            self.f = None
+        self.log.info('Captured {} messages to file "{}"'.format(
+                      self.n_messages, self.filename))
+
+def read_capture(filename):
+    # All messages in the capture file as (time, origin, endpoint, path,
+    # args); a truncated last record (e.g. after a crash) is ignored
+    log = logging.getLogger(__name__)
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if not data.startswith(HEADER):
+        raise ValueError('Not a capture file: "{}"'.format(filename))
+    strings = {}
+    messages = []
+    n = len(HEADER)
+    try:
+        while n < len(data):
+            kind = ord(data[n])
+            if kind == _STRING:
+                kind,k,length = STRING.unpack_from(data, n)
+                n += STRING.size
+                if n + length > len(data):
+                    raise struct.error('truncated string')
+                strings[k] = data[n:n+length]
+                n += length
+            elif kind == _MESSAGE:
+                kind,t,origin,endpoint,path,nargs = MESSAGE.unpack_from(data, n)
+                m = n + MESSAGE.size
+                args = []
+                for j in range(nargs):
+                    c = data[m]
+                    if c == 'f':
+                        args.append(FLOAT_ARG.unpack_from(data, m)[1])
+                    elif c == 'i':
+                        args.append(INT_ARG.unpack_from(data, m)[1])
+                    else:
+                        args.append(strings[INT_ARG.unpack_from(data, m)[1]])
+                    m += INT_ARG.size
+                messages.append((t, strings[origin], strings[endpoint],
+                                 strings[path], args))
+                n = m
+            else:
+                raise ValueError('Invalid record at offset {}'.format(n))
+    except (struct.error, IndexError):
+        log.warning('Ignoring truncated record at the end of capture file '
+                    '"{}"'.format(filename))
+    return messages
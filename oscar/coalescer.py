@@ -0,0 +1,71 @@
+import logging
+import threading
+import time
+
+class Coalescer(object):
+    # Sits between the DeviceManager and a device. Continuous controls (vol,
+    # pan and send) are held back for up to interval seconds and only the
+    # newest value per control and track is forwarded to the device. Everything
+    # else (mute, solo, record, transport commands, ...) is passed straight
+    # through.
+    def __init__(self, device, interval=0.005):
+        self.device = device
+        self.log = logging.getLogger(__name__)
+        self.name = device.name
+        self.interval = interval
+        # (control, track[, send]) -> (method, args)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.has_pending = threading.Event()
+        self.exit = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __getattr__(self, name):
+        return getattr(self.device, name)
+
+    def vol(self, i, v):
+        self.hold(('vol', i), self.device.vol, (i, v))
+
+    def pan(self, i, v):
+        self.hold(('pan', i), self.device.pan, (i, v))
+
+    def send(self, i, j, v):
+        self.hold(('send', i, j), self.device.send, (i, j, v))
+
+    def hold(self, key, f, args):
+        with self.lock:
+            self.pending[key] = (f, args)
+        self.has_pending.set()
+
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            self.has_pending.clear()
+        if len(pending) == 0:
+            return
+        self.device.begin_batch()
+        try:
+            for f,args in pending.itervalues():
+                f(*args)
+        finally:
+            self.device.end_batch()
+
+    def run(self):
+        while True:
+            self.has_pending.wait()
+            if self.exit:
+                break
+            # Give the gesture interval seconds to produce more values, then
+            # forward only the latest ones
+            time.sleep(self.interval)
+            self.flush()
+
+    def shutdown(self):
+        self.exit = True
+        self.has_pending.set()
+        self.thread.join()
+        # Make sure the final values still reach the device
+        self.flush()
@@ -0,0 +1,296 @@
+import logging
+import socket
+import threading
+import time
+from .devicemanager import DeviceManager
+from .metrics import monotonic
+from .coalescer import Coalescer
+from .sendqueue import LatestQueue
+from .ardour import Ardour
+from .routemap import RouteMap
+from .persiststate import PersistState
+from .touchosc import TouchOSC
+
+# The options that can be set for every group separately (see OscarServer);
+# the others are shared by all groups in the process
+GROUP_OPTIONS = ('name', 'oscar_port', 'ardour_ip', 'ardour_port',
+                 'ardour_session', 'ardour_bundles', 'ardour_action_delay',
+                 'touchosc_ip', 'touchosc_port', 'touchosc_match',
+                 'touchosc_bundles', 'touchosc_page_filter',
+                 'touchosc_queue_size', 'resync_rate', 'resync_idle',
+                 'persist_state', 'state_file', 'restore_rate',
+                 'restore_bundles', 'journal', 'journal_fsync',
+                 'journal_fsync_interval', 'scene_rate', 'reconcile_window',
+                 'coalesce_interval', 'value_cache', 'inbound_queue_size')
+
+class DeviceGroup(object):
+    # One mixer: an Ardour, the TouchOSC clients that control it and the
+    # PersistState that keeps its state, with a DeviceManager of their own,
+    # so that groups never see each other's messages. Each group queues its
+    # inbound messages for a dispatch thread of its own, so that a busy room
+    # does not hold up the others. The metrics, trace, capture, scheduler and
+    # transport are shared with the other groups; changed is the event that
+    # wakes up the saver thread, timeline(name, duration) records the startup
+    # phases, and on_restored(group) is called once the state is restored.
+    def __init__(self, name=None, transport=None, metrics=None, trace=None,
+                 capture=None, scheduler=None, changed=None, timeline=None,
+                 on_restored=None, dump_trace=None, oscar_port=8000,
+                 ardour_ip='127.0.0.1', ardour_port='3819',
+                 ardour_session=None, ardour_bundles=True,
+                 ardour_action_delay=0.02, touchosc_ip='127.0.0.1',
+                 touchosc_port='9000', touchosc_match=None,
+                 touchosc_bundles=True, touchosc_page_filter=False,
+                 touchosc_queue_size=256, resync_rate=200, resync_idle=60,
+                 persist_state=True, state_file='oscar.state',
+                 restore_rate=100, restore_bundles=True, journal=True,
+                 journal_fsync='interval', journal_fsync_interval=1.0,
+                 scene_rate=1000, reconcile_window=0.5,
+                 coalesce_interval=0.0, value_cache=True,
+                 inbound_queue_size=1024):
+        self.log = logging.getLogger(__name__)
+        self.name = name
+        # Gauges and startup phases of named groups are prefixed with the name
+        self.prefix = '' if name is None else name + '.'
+        self.oscar_port = oscar_port
+        self.metrics = metrics
+        self.trace = trace
+        self.capture = capture
+        self.timeline = timeline
+        self.on_restored = on_restored
+        self.t_start = None
+        self.dump_trace = dump_trace
+        # Whether the group keeps its state at all, and whether it saves it
+        # now, i.e. once it read its state file: until then, saving would
+        # overwrite the file with the defaults
+        self.persistent = persist_state
+        self.persist_state = False
+
+        # Set up all devices: Ardour, PersistState and TouchOSC. If
+        # coalesce_interval is set, the outbound continuous controls for
+        # Ardour and TouchOSC are coalesced over that interval (in seconds).
+        # The tracks come from the Ardour session file if we have one;
+        # otherwise Ardour lists them for us on startup.
+        self.dm = DeviceManager()
+        self.coalescers = []
+        routemap = None
+        if ardour_session is not None:
+            routemap = RouteMap.from_session_file(ardour_session)
+        self.ardour = Ardour(self.dm, ardour_ip, ardour_port, ardour_bundles,
+                             routemap, metrics, value_cache, trace,
+                             capture=capture, scheduler=scheduler,
+                             action_delay=ardour_action_delay,
+                             transport=transport)
+        self.dm.add_device(self.coalesce(self.ardour, coalesce_interval))
+        self.persist = PersistState(self.dm, state_file, restore_rate,
+                                    restore_bundles,
+                                    persist_state and journal,
+                                    journal_fsync, journal_fsync_interval,
+                                    scene_rate, reconcile_window,
+                                    scheduler, changed)
+        self.dm.add_device(self.persist)
+        self.touchosc = TouchOSC(self.dm, touchosc_ip, touchosc_port,
+                                 touchosc_bundles, touchosc_page_filter,
+                                 touchosc_queue_size, metrics,
+                                 value_cache, trace, resync_rate,
+                                 resync_idle, capture, transport,
+                                 touchosc_match)
+        self.dm.add_device(self.coalesce(self.touchosc, coalesce_interval))
+        if routemap is not None:
+            self.persist.set_routes(routemap)
+            self.touchosc.set_routes(routemap)
+
+        # Where Ardour and the configured TouchOSC send from, to tell their
+        # messages from those of the other groups when groups share a port
+        try:
+            self.ardour_source = (socket.gethostbyname(ardour_ip),
+                                  int(ardour_port))
+        except (socket.error, ValueError):
+            self.ardour_source = None
+        self.touchosc_source = None
+        if touchosc_ip != 'zeroconf':
+            try:
+                self.touchosc_source = socket.gethostbyname(touchosc_ip)
+            except socket.error:
+                pass
+
+        # Inbound pipeline: the receive thread only looks up the route of a
+        # message and queues it; the dispatch thread hands it to the devices,
+        # whose sends are queued per destination in turn. If dispatching falls
+        # behind, older values of continuous controls are dropped in favour of
+        # newer ones.
+        self.inbox = LatestQueue(self.prefix + 'inbound messages',
+                                 inbound_queue_size)
+        self.dispatch_thread = threading.Thread(target=self.dispatch_thread_run)
+        self.dispatch_thread.daemon = True
+
+        self.add_gauges(metrics)
+
+    def add_gauges(self, metrics):
+        p = self.prefix
+        metrics.add_gauge(p + 'ardour.packets',
+                          lambda: self.ardour.sender.n_packets)
+        metrics.add_gauge(p + 'touchosc.packets',
+                          lambda: self.touchosc.sender.n_packets)
+        metrics.add_gauge(p + 'touchosc.clients',
+                          lambda: len(self.touchosc.client_list))
+        metrics.add_gauge(p + 'touchosc.queue_depth', self.touchosc.queue_depth)
+        metrics.add_gauge(p + 'touchosc.dropped', self.touchosc.n_dropped)
+        metrics.add_gauge(p + 'ardour.queue_depth',
+                          self.ardour.sender.queue_depth)
+        metrics.add_gauge(p + 'ardour.dropped', self.ardour.sender.n_dropped)
+        metrics.add_gauge(p + 'inbound.queue_depth', self.inbox.depth)
+        metrics.add_gauge(p + 'inbound.max_queue_depth',
+                          lambda: self.inbox.max_depth)
+        metrics.add_gauge(p + 'inbound.dropped', lambda: self.inbox.n_dropped)
+        metrics.add_gauge(p + 'ardour.suppressed',
+                          lambda: self.ardour.cache.n_suppressed)
+        metrics.add_gauge(p + 'ardour.echoes',
+                          lambda: self.ardour.cache.n_echoes)
+        metrics.add_gauge(p + 'ardour.reconnects',
+                          lambda: self.ardour.n_reconnects)
+        metrics.add_gauge(p + 'ardour.recovery_s',
+                          lambda: self.ardour.recovery_time or 0.0)
+        metrics.add_gauge(p + 'touchosc.suppressed', self.touchosc.n_suppressed)
+
+    def coalesce(self, device, interval):
+        if interval <= 0.0:
+            return device
+        c = Coalescer(device, interval)
+        self.coalescers.append(c)
+        return c
+
+    def start(self, t_start, deadline):
+        # Discover TouchOSC and wait for Ardour at the same time, both bounded
+        # by the startup deadline, then restore the state. Returns whether
+        # both are ready. Ready and restored go on the timeline as the time
+        # since t_start, when the server started.
+        self.t_start = t_start
+        self.dispatch_thread.start()
+        timeout = max(deadline - time.time(), 0)
+        threads = [threading.Thread(target=self.run_phase,
+                                    args=('touchosc', self.touchosc.start,
+                                          min(timeout, 10))),
+                   threading.Thread(target=self.run_phase,
+                                    args=('ardour', self.ardour.start, timeout))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join(max(deadline - time.time(), 0))
+        self.add_to_timeline('ready', time.time() - self.t_start)
+
+        if self.touchosc.ready() and self.ardour.ready():
+            try:
+                self.persist.restore(self.restored)
+            except (IOError, ValueError):
+                # PersistState logged why; the file stays as it is
+                self.persistent = False
+                self.log.error('{}Could not read the state: Not restoring or '
+                               'saving state'.format(self.label()))
+                return False
+            self.persist_state = self.persistent
+            return True
+        if self.touchosc.ready():
+            # The Ardour monitor keeps looking for Ardour; once it is there,
+            # the state is restored and saved from then on. Ardour may have
+            # shown up just now, without the monitor noticing it.
+            self.log.warning('{}Ardour is not ready: Not restoring or saving '
+                             'state until it is'.format(self.label()))
+            self.persist.defer_restore(self.restored)
+            if self.ardour.ready():
+                self.persist.reconcile()
+            return False
+        self.log.warning('{}Ardour and TouchOSC are not ready: Not restoring '
+                         'or saving state'.format(self.label()))
+        return False
+
+    def restored(self):
+        self.persist_state = self.persistent
+        self.add_to_timeline('restored', time.time() - self.t_start)
+        # Replaying a capture starts here, where the startup traffic ends
+        if self.capture is not None:
+            self.capture.record('oscar', self.name or 'oscar',
+                                '/oscar/restored', ())
+        if self.on_restored is not None:
+            self.on_restored(self)
+
+    def label(self):
+        # For log messages
+        return '' if self.name is None else '{}: '.format(self.name)
+
+    def run_phase(self, name, f, *args):
+        t = time.time()
+        try:
+            f(*args)
+        finally:
+            self.add_to_timeline(name, time.time() - t)
+
+    def add_to_timeline(self, name, duration):
+        if self.timeline is not None:
+            self.timeline(self.prefix + name, duration)
+
+    def stop(self):
+        # Stops receiving and dispatching; the devices are stopped by stop_devices()
+        self.inbox.close()
+        if self.dispatch_thread.is_alive():
+            self.dispatch_thread.join()
+        for c in self.coalescers:
+            c.shutdown()
+
+    def stop_devices(self):
+        self.ardour.stop()
+        self.touchosc.stop()
+        self.ardour.sender.close()
+
+    def close(self):
+        # Saves the state one last time
+        if self.persist_state:
+            self.persist.save()
+        self.persist.close()
+
+    def owns_ardour(self, src):
+        return self.ardour_source == (src.hostname, src.get_port())
+
+    def owns_touchosc(self, src):
+        return (src.hostname in self.touchosc.clients or
+                src.hostname == self.touchosc_source)
+
+    def receive(self, device, route, path, args, src):
+        # Runs on the receive thread: queue the message for the dispatch thread
+        if device == 'ardour':
+            key = self.ardour.inbound_key(route, path, args)
+        else:
+            key = self.touchosc.inbound_key(route, path, args)
+        self.inbox.put((device, route, path, args, src, monotonic()), key)
+
+    def dispatch_thread_run(self):
+        # Everything the devices send in response to the messages taken from
+        # the queue at once goes out as one bundle per destination
+        while True:
+            items = self.inbox.get_all()
+            if items is None:
+                return
+            self.dm.begin_batch()
+            try:
+                for item in items:
+                    self.dispatch_message(*item)
+            finally:
+                self.dm.end_batch()
+            t = monotonic()
+            for device,route,path,args,src,t_in in items:
+                self.metrics.record('in', device, path, t - t_in)
+
+    def dispatch_message(self, device, route, path, args, src, t_in):
+        try:
+            if device == 'ardour':
+                self.ardour.handle_route(route, args)
+            else:
+                self.touchosc.handle_route(route, args, src)
+        except Exception:
+            self.failed(path, args)
+
+    def failed(self, path, args):
+        self.log.exception('{}Could not handle message "{}" with arguments '
+                           '{}'.format(self.label(), path, args))
+        if self.dump_trace is not None:
+            self.dump_trace()
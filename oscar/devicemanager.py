@@ -1,24 +1,105 @@
+import functools
 import logging
 
 class DeviceManager(object):
     def __init__(self):
         self.log = logging.getLogger(__name__)
         self.ds = {}
+        # Routing table: method name -> {ignore: tuple of bound methods}. An
+        # entry is compiled the first time a method is dispatched and all
+        # entries are compiled again whenever the devices change: when one is
+        # added, and when set_routes changes their tracks.
+        self.routes = {}
 
     def add_device(self, device):
         self.ds[device.name] = device
+        self.recompile()
+
+    def set_routes(self, routemap, ignore=None):
+        # The devices may set up other handlers for the new tracks
+        route = self.routes.get('set_routes')
+        if route is None:
+            route = self.compile_route('set_routes')
+        for f in route.get(ignore, route[None]):
+            f(routemap)
+        self.recompile()
+
+    def recompile(self):
+        # Compile every entry of the routing table against the devices as
+        # they are now, and point the cached dispatchers at the new entries
+        for key in self.routes.keys():
+            if isinstance(key, tuple):
+                self.compile_report_route(key[1])
+            else:
+                self.compile_route(key)
+        for k,d in self.__dict__.items():
+            if isinstance(d, Dispatcher):
+                d.route = self.routes[k]
+
+    def compile_route(self, method_name):
+        # Collect the bound methods once; then precompute one variant of the
+        # call list for each device that might be passed as the ignore argument
+        fs = []
+        for name,device in self.ds.iteritems():
+            f = getattr(device, method_name, None)
+            if callable(f):
+                fs.append((name,f))
+        route = {None: tuple(f for name,f in fs)}
+        for ignore in self.ds.iterkeys():
+            route[ignore] = tuple(f for name,f in fs if name != ignore)
+        self.routes[method_name] = route
+        self.log.debug('Compiled route for {}: {}'.format(
+                       method_name, ', '.join(name for name,f in fs)))
+        return route
+
+    def report(self, method_name, *args, **kwargs):
+        # Like self.<method_name>(*args), for the values a device reports
+        # about itself (Ardour's feedback) rather than changes it asks for:
+        # devices with a report method get report(method_name, *args)
+        # instead, so that they can tell the two apart
+        ignore = kwargs.pop('ignore', None)
+        key = ('report', method_name)
+        route = self.routes.get(key)
+        if route is None:
+            route = self.compile_report_route(method_name)
+        for f in route.get(ignore, route[None]):
+            f(*args)
+
+    def compile_report_route(self, method_name):
+        fs = []
+        for name,device in self.ds.iteritems():
+            report = getattr(device, 'report', None)
+            if callable(report):
+                fs.append((name, functools.partial(report, method_name)))
+                continue
+            f = getattr(device, method_name, None)
+            if callable(f):
+                fs.append((name,f))
+        route = {None: tuple(f for name,f in fs)}
+        for ignore in self.ds.iterkeys():
+            route[ignore] = tuple(f for name,f in fs if name != ignore)
+        self.routes[('report', method_name)] = route
+        return route
 
     def __getattr__(self, method_name):
-        def catchall_method(*args, **kwargs):
-            ignore = None
-            if kwargs.has_key('ignore'):
-                ignore = kwargs['ignore']
-                del kwargs['ignore']
-            for name,device in self.ds.iteritems():
-                if name == ignore:
-                    continue
-                if hasattr(device, method_name):
-                    self.log.debug('Calling {} for {}'.format(method_name, name))
-                    f = getattr(device, method_name)
-                    f(*args, **kwargs)
-        return catchall_method
+        if method_name.startswith('_'):
+            raise AttributeError(method_name)
+        route = self.routes.get(method_name)
+        if route is None:
+            route = self.compile_route(method_name)
+        # Cache the dispatcher on the instance, so that subsequent lookups do
+        # not even hit __getattr__
+        d = Dispatcher(route)
+        self.__dict__[method_name] = d
+        return d
+
+class Dispatcher(object):
+    __slots__ = ['route']
+
+    def __init__(self, route):
+        self.route = route
+
+    def __call__(self, *args, **kwargs):
+        ignore = kwargs.pop('ignore', None)
+        for f in self.route.get(ignore, self.route[None]):
+            f(*args, **kwargs)
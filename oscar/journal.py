@@ -0,0 +1,192 @@
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+# Every record is one change of the mixer state: sequence number, track,
+# parameter, send, value and time, followed by a CRC32 of all that. A torn
+# final record (from a crash in the middle of a write) is recognized by its
+# size or its checksum and ignored.
+HEADER = 'OSCJ\x01\x00\x00\x00'
+RECORD = struct.Struct('<IHBBdd')
+CRC = struct.Struct('<I')
+RECORD_SIZE = RECORD.size + CRC.size
+
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+class Journal(object):
+    # An append-only file of state changes, so that a crash loses (next to)
+    # nothing between two snapshots of the state. Appends go to a buffer in
+    # memory; with fsync policy 'interval' a background thread writes the
+    # buffer out and fsyncs at most fsync_interval seconds after an append,
+    # with 'always' every append is written and fsynced right away (slow!),
+    # and with 'never' the buffer is written out after fsync_interval seconds
+    # but it is up to the OS when it reaches the disk.
+    #
+    # Compacting the journal into a snapshot is a rotate() (the journal so
+    # far becomes the old journal and a new one is started), writing the
+    # snapshot, and remove_old(). Until the old journal is removed, both are
+    # replayed on top of the snapshot; the sequence numbers make sure that no
+    # change is applied twice.
+    def __init__(self, filename, fsync='interval', fsync_interval=1.0, seq=0):
+        self.log = logging.getLogger(__name__)
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('Invalid fsync policy "{}"'.format(fsync))
+        self.filename = filename
+        self.old_filename = filename + '.old'
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.seq = seq
+        # lock guards the buffer, file_lock the file, so that appending does
+        # not have to wait for a write or fsync to finish
+        self.buf = bytearray()
+        self.lock = threading.Lock()
+        self.file_lock = threading.Lock()
+        self.f = None
+        self.dirty = threading.Event()
+        self.exit = threading.Event()
+        self.thread = None
+        self.n_records = 0
+
+    def open(self):
+        self.f = self._open(self.filename)
+        if self.fsync != 'always':
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _open(self, filename):
+        f = open(filename, 'ab')
+        if f.tell() == 0:
+            f.write(HEADER)
+            f.flush()
+        return f
+
+    def append(self, track, param, send, value):
+        # Callers serialize appends (PersistState holds its lock), so that
+        # sequence numbers are in order
+        self.seq += 1
+        r = RECORD.pack(self.seq, track, param, send, value, time.time())
+        with self.lock:
+            self.buf += r
+            self.buf += CRC.pack(zlib.crc32(r) & 0xffffffff)
+            self.n_records += 1
+        if self.fsync == 'always':
+            self.flush()
+        else:
+            self.dirty.set()
+
+    def flush(self):
+        # The fsync happens outside the file lock, on a descriptor of our
+        # own, so that rotating does not have to wait for it
+        with self.file_lock:
+            self._write()
+            fd = None
+            if self.f is not None and self.fsync != 'never':
+                fd = os.dup(self.f.fileno())
+        if fd is not None:
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _write(self):
+        # Hands the buffer to the OS; must be called with the file lock held
+        with self.lock:
+            buf = self.buf
+            self.buf = bytearray()
+        if self.f is None:
+            return
+        if len(buf) > 0:
+            self.f.write(buf)
+        self.f.flush()
+
+    def run(self):
+        while True:
+            self.dirty.wait()
+            if self.exit.wait(self.fsync_interval):
+                return
+            self.dirty.clear()
+            try:
+                self.flush()
+            except (IOError, OSError):
+                self.log.exception('Could not write journal "{}"'.format(
+                                   self.filename))
+
+    def rotate(self):
+        # Start a new journal; returns the sequence number of the last change
+        # in the old one. If there still is an old journal (because writing
+        # the last snapshot failed), the current one is appended to it.
+        # Nothing is fsynced here, so that the caller can rotate while it
+        # holds a lock; sync_old() makes the old journal durable.
+        with self.file_lock:
+            self._write()
+            self.f.close()
+            if os.path.exists(self.old_filename):
+                with open(self.filename, 'rb') as f:
+                    data = f.read()[len(HEADER):]
+                with open(self.old_filename, 'ab') as f:
+                    f.write(data)
+                os.remove(self.filename)
+            else:
+                os.rename(self.filename, self.old_filename)
+            self.f = self._open(self.filename)
+            self.n_records = 0
+            return self.seq
+
+    def sync_old(self):
+        try:
+            fd = os.open(self.old_filename, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def remove_old(self):
+        try:
+            os.remove(self.old_filename)
+        except OSError:
+            pass
+
+    def close(self):
+        self.exit.set()
+        self.dirty.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+        with self.file_lock:
+            self.f.close()
+            self.f = None
+
+    def replay(self):
+        # All changes in the old and the current journal, oldest first, as
+        # (seq, track, param, send, value, time)
+        return (read_journal(self.old_filename) +
+                read_journal(self.filename))
+
+def read_journal(filename):
+    log = logging.getLogger(__name__)
+    if not os.path.exists(filename):
+        return []
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if not data.startswith(HEADER):
+        log.error('Ignoring invalid journal "{}"'.format(filename))
+        return []
+    records = []
+    n = len(HEADER)
+    while n + RECORD_SIZE <= len(data):
+        r = data[n:n+RECORD.size]
+        crc, = CRC.unpack_from(data, n + RECORD.size)
+        if zlib.crc32(r) & 0xffffffff != crc:
+            break
+        records.append(RECORD.unpack(r))
+        n += RECORD_SIZE
+    if n < len(data):
+        log.warning('Ignoring {} bytes of torn or corrupt records at the end '
+                    'of journal "{}"'.format(len(data) - n, filename))
+    return records
@@ -0,0 +1,143 @@
+import liblo
+import logging
+import threading
+import time
+from .metrics import monotonic
+
+# Stand-ins for Ardour and TouchOSC on the loopback interface, for
+# benchmarking and replaying traffic without a real mixer or tablet. Both
+# record every message they get, with the time it arrived.
+
+class FakeEndpoint(liblo.ServerThread):
+    # Records all messages as (time, path, args). Replies go to reply_to if
+    # given, since liblo sends from its own socket and the source address of
+    # a message is not necessarily where its sender listens.
+    def __init__(self, port, reply_to=None):
+        liblo.ServerThread.__init__(self, port)
+        self.log = logging.getLogger(__name__)
+        self.reply_to = reply_to
+        self.received = []
+        self.lock = threading.Lock()
+
+    def record(self, path, args):
+        t = monotonic()
+        with self.lock:
+            self.received.append((t, path, args))
+
+    def take(self):
+        # All messages received so far; the record starts afresh
+        with self.lock:
+            received = self.received
+            self.received = []
+        return received
+
+    def reply(self, src, path, *args):
+        self.send(self.reply_to or src, path, *args)
+
+    def play(self, target, rate, duration, message):
+        # Sends rate messages per second for duration seconds on an absolute
+        # schedule; message(k) gives the path and arguments of the k-th
+        # message. Returns the send times.
+        n = int(rate * duration)
+        sent = []
+        t_start = monotonic()
+        for k in range(n):
+            t_due = t_start + float(k) / rate
+            while True:
+                t = monotonic()
+                if t >= t_due:
+                    break
+                time.sleep(min(t_due - t, 0.001))
+            path,args = message(k)
+            self.send(target, path, *args)
+            sent.append(t)
+        return sent
+
+    def sweep(self, target, tracks, rate, duration, resolution, message):
+        # Fader sweeps: moves a fader on each of the tracks from 0 to 1 over
+        # and over, round robin. Values are multiples of 1/resolution, which
+        # are exact in OSC's 32 bit floats, so that what comes back can be
+        # matched. Returns the sent values as (time, track, step).
+        def sweep_message(k):
+            i = tracks[k % len(tracks)]
+            step = (k // len(tracks)) % resolution
+            return message(i, float(step) / resolution)
+        sent = self.play(target, rate, duration, sweep_message)
+        return [(t, tracks[k % len(tracks)], (k // len(tracks)) % resolution)
+                for k,t in enumerate(sent)]
+
+class FakeArdour(FakeEndpoint):
+    # Answers /routes/listen and /routes/list with #reply like Ardour does and
+    # echoes every change to a route as feedback, i.e. /ardour/routes/gainabs
+    # comes back as /route/gain. Like Ardour, it remembers the values and
+    # reports them for every route it is asked to listen to. Gain sweeps stand
+    # in for somebody moving faders in the Ardour GUI.
+    echoes = {'/ardour/routes/gainabs': '/route/gain',
+              '/ardour/routes/mute': '/route/mute',
+              '/ardour/routes/solo': '/route/solo',
+              '/ardour/routes/recenable': '/route/rec'}
+    defaults = {'/route/gain': 1.0, '/route/mute': 0.0, '/route/solo': 0.0,
+                '/route/rec': 0.0}
+
+    def __init__(self, port=3819, reply_to=None, n_tracks=12, echo=True):
+        FakeEndpoint.__init__(self, port, reply_to)
+        # Without echo, changes are not reported back, e.g. when replaying a
+        # capture that has the real Ardour's feedback in it already
+        self.echo = echo
+        self.ids = range(1, n_tracks+1)
+        # (feedback path, remote id) -> value
+        self.values = {}
+        self.add_method('/routes/listen', None, self.on_listen)
+        self.add_method('/routes/list', None, self.on_list)
+        self.add_method('/ardour/transport_frame', None, self.on_transport_frame)
+        self.add_method(None, None, self.on_message)
+
+    def on_listen(self, path, args, types, src):
+        self.record(path, args)
+        self.reply(src, '#reply', 'listening')
+        for rid in args:
+            for echo,v in self.defaults.iteritems():
+                self.reply(src, echo, rid, self.values.get((echo, rid), v))
+
+    def on_list(self, path, args, types, src):
+        self.record(path, args)
+        for rid in self.ids:
+            self.reply(src, '#reply', 'AT', 'Audio {}'.format(rid), 2, 2, 0, 0,
+                       rid)
+        self.reply(src, '#reply', 'end_route_list', 48000, 0)
+
+    def on_transport_frame(self, path, args, types, src):
+        self.record(path, args)
+        self.reply(src, '#reply', 0)
+
+    def on_message(self, path, args, types, src):
+        self.record(path, args)
+        echo = self.echoes.get(path)
+        if echo is not None and len(args) == 2:
+            self.values[(echo, args[0])] = args[1]
+            if self.echo:
+                self.reply(src, echo, *args)
+
+    def sweep(self, tracks, rate, duration, resolution=4096):
+        return FakeEndpoint.sweep(self, self.reply_to, tracks, rate, duration,
+                                  resolution,
+                                  lambda i, v: ('/route/gain', (i, v)))
+
+class FakeTouchOSC(FakeEndpoint):
+    # Records what Oscar sends to the tablet and plays volume fader sweeps
+    def __init__(self, port=9000, oscar=None, tracks_per_page=4):
+        FakeEndpoint.__init__(self, port)
+        self.oscar = oscar
+        self.tracks_per_page = tracks_per_page
+        self.add_method(None, None, self.on_message)
+
+    def on_message(self, path, args, types, src):
+        self.record(path, args)
+
+    def vol_path(self, i):
+        return '/oscar_page_{}/vol_{}'.format((i-1) // self.tracks_per_page + 1, i)
+
+    def sweep(self, tracks, rate, duration, resolution=4096):
+        return FakeEndpoint.sweep(self, self.oscar, tracks, rate, duration,
+                                  resolution,
+                                  lambda i, v: (self.vol_path(i), (v,)))
@@ -0,0 +1,184 @@
+import bisect
+import logging
+import threading
+import time
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2 has no monotonic clock in the time module; ask the C library
+    # for CLOCK_MONOTONIC directly and fall back to the wall clock
+    import ctypes
+    import ctypes.util
+
+    class _timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    try:
+        _librt = ctypes.CDLL(ctypes.util.find_library('rt') or
+                             ctypes.util.find_library('c'), use_errno=True)
+        _clock_gettime = _librt.clock_gettime
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        _CLOCK_MONOTONIC = 1
+        _ts = _timespec()
+        _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(_ts))
+    except (OSError, AttributeError, TypeError):
+        _clock_gettime = None
+
+    if _clock_gettime is not None:
+        def monotonic():
+            ts = _timespec()
+            _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(ts))
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+    else:
+        monotonic = time.time
+
+# Upper bounds of the latency buckets, in seconds; the last bucket takes
+# everything above 100 ms
+LATENCY_BUCKETS = (10e-6, 20e-6, 50e-6, 100e-6, 200e-6, 500e-6,
+                   1e-3, 2e-3, 5e-3, 10e-3, 20e-3, 50e-3, 100e-3)
+
+def control_name(path):
+    # The control an OSC path is about, without page and track numbers:
+    # /oscar_page_1/send_3_1 -> send, /route/gain -> gain
+    name = path.rsplit('/', 1)[-1]
+    while '_' in name:
+        head,tail = name.rsplit('_', 1)
+        if not tail.isdigit():
+            break
+        name = head
+    return name
+
+class Histogram(object):
+    # Counts of observations in fixed buckets; percentiles are reported as
+    # the upper bound of the bucket they fall into (or the maximum, if that is
+    # smaller)
+    __slots__ = ['bounds', 'counts', 'n', 'total', 'max']
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, v):
+        self.counts[bisect.bisect_left(self.bounds, v)] += 1
+        self.n += 1
+        self.total += v
+        if v > self.max:
+            self.max = v
+
+    def percentile(self, q):
+        if self.n == 0:
+            return 0.0
+        k = q * self.n
+        seen = 0
+        for i,c in enumerate(self.counts):
+            seen += c
+            if seen >= k:
+                if i < len(self.bounds):
+                    return min(self.bounds[i], self.max)
+                return self.max
+        return self.max
+
+    def since(self, earlier):
+        # The observations made after the earlier copy of this histogram was
+        # taken; max stays the overall maximum
+        h = Histogram(self.bounds)
+        h.counts = [a - b for a,b in zip(self.counts, earlier.counts)]
+        h.n = self.n - earlier.n
+        h.total = self.total - earlier.total
+        h.max = self.max
+        return h
+
+    def mean(self):
+        if self.n == 0:
+            return 0.0
+        return self.total / self.n
+
+class Metrics(object):
+    # Message counters and latency histograms keyed by (direction, device,
+    # control), plus gauges, i.e. functions that are asked for their value
+    # when the statistics are read. Recording is a dict lookup and an
+    # increment under an uncontended lock, so it stays on in production.
+    def __init__(self):
+        self.log = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        # path -> control, so that we do not parse paths over and over
+        self.controls = {}
+        self.t_start = monotonic()
+
+    def control(self, path):
+        try:
+            return self.controls[path]
+        except KeyError:
+            c = control_name(path)
+            if len(self.controls) < 4096:
+                self.controls[path] = c
+            return c
+
+    def count(self, direction, device, path, n=1):
+        key = (direction, device, self.control(path))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, direction, device, path, seconds):
+        key = (direction, device, self.control(path))
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = Histogram()
+            h.add(seconds)
+
+    def record(self, direction, device, path, seconds):
+        # Count a message and observe how long it took
+        key = (direction, device, self.control(path))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = Histogram()
+            h.add(seconds)
+
+    def add_gauge(self, name, f):
+        self.gauges[name] = f
+
+    def gauge(self, name):
+        try:
+            return self.gauges[name]()
+        except Exception:
+            self.log.exception('Could not read gauge {}'.format(name))
+            return 0
+
+    def total(self, direction):
+        with self.lock:
+            return sum(n for (d,dev,c),n in self.counters.iteritems()
+                       if d == direction)
+
+    def merged_histogram(self, direction):
+        # All histograms of one direction in one
+        h = Histogram()
+        with self.lock:
+            for (d,dev,c),hc in self.histograms.iteritems():
+                if d != direction:
+                    continue
+                for i,n in enumerate(hc.counts):
+                    h.counts[i] += n
+                h.n += hc.n
+                h.total += hc.total
+                h.max = max(h.max, hc.max)
+        return h
+
+    def snapshot(self):
+        # Lists of (key, count), (key, histogram) and (name, value), sorted
+        # by key; key is "direction.device.control"
+        with self.lock:
+            counters = [('.'.join(k), n) for k,n in self.counters.iteritems()]
+            histograms = [('.'.join(k), h) for k,h in
+                          self.histograms.iteritems()]
+        gauges = [(name, self.gauge(name)) for name in self.gauges]
+        return sorted(counters), sorted(histograms), sorted(gauges)
@@ -0,0 +1,130 @@
+from array import array
+
+class MixerState(object):
+    # The mixer state of n_tracks tracks plus the master bus (track 0). Every
+    # parameter is stored in one array of doubles, indexed by track; the sends
+    # are a n_tracks+1 by n_sends matrix stored row by row. Sends are numbered
+    # from 1, like in Ardour and TouchOSC.
+    __slots__ = ['n_tracks', 'n_sends', 'vol', 'mute', 'solo', 'record', 'pan',
+                 'send']
+
+    params = ('vol', 'mute', 'solo', 'record', 'pan')
+    defaults = {'vol': 1.0, 'mute': 0.0, 'solo': 0.0, 'record': 0.0, 'pan': 0.5,
+                'send': 1.0}
+
+    def __init__(self, n_tracks=12, n_sends=1):
+        self.n_tracks = n_tracks
+        self.n_sends = n_sends
+        n = n_tracks + 1
+        for p in self.params:
+            setattr(self, p, array('d', [self.defaults[p]]) * n)
+        self.send = array('d', [self.defaults['send']]) * (n * n_sends)
+
+    def get(self, param, i):
+        return getattr(self, param)[i]
+
+    def set(self, param, i, v):
+        # Returns whether the value actually changed
+        a = getattr(self, param)
+        if a[i] == v:
+            return False
+        a[i] = v
+        return True
+
+    def get_send(self, i, j):
+        return self.send[i*self.n_sends + j-1]
+
+    def set_send(self, i, j, v):
+        k = i*self.n_sends + j-1
+        if self.send[k] == v:
+            return False
+        self.send[k] = v
+        return True
+
+    def valid(self, i, j=1):
+        return i>=0 and i<=self.n_tracks and j>=1 and j<=self.n_sends
+
+    def copy(self):
+        # Slicing an array is a plain buffer copy
+        s = MixerState.__new__(MixerState)
+        s.n_tracks = self.n_tracks
+        s.n_sends = self.n_sends
+        for p in self.params:
+            setattr(s, p, getattr(self, p)[:])
+        s.send = self.send[:]
+        return s
+
+    def resized(self, n_tracks):
+        # A copy with n_tracks tracks; tracks beyond the old size get the
+        # defaults
+        s = MixerState(n_tracks, self.n_sends)
+        n = min(n_tracks, self.n_tracks) + 1
+        for p in self.params:
+            getattr(s, p)[:n] = getattr(self, p)[:n]
+        s.send[:n*self.n_sends] = self.send[:n*self.n_sends]
+        return s
+
+    def controls(self, i):
+        # All controls of track i as (method name, arguments) pairs, i.e. in
+        # the form the devices expect them
+        cs = [(p, (i, getattr(self, p)[i])) for p in self.params]
+        for j in range(1, self.n_sends+1):
+            cs.append(('send', (i, j, self.get_send(i, j))))
+        return cs
+
+    def diff(self, other):
+        # The controls that differ between self and other (of the same size),
+        # with other's values, in the form controls() returns them
+        cs = []
+        for i in range(self.n_tracks+1):
+            for p in self.params:
+                v = getattr(other, p)[i]
+                if getattr(self, p)[i] != v:
+                    cs.append((p, (i, v)))
+            for j in range(1, self.n_sends+1):
+                v = other.get_send(i, j)
+                if self.get_send(i, j) != v:
+                    cs.append(('send', (i, j, v)))
+        return cs
+
+    def to_json(self):
+        tracks = []
+        for i in range(self.n_tracks+1):
+            t = dict((p, getattr(self, p)[i]) for p in self.params)
+            t['send'] = list(self.send[i*self.n_sends:(i+1)*self.n_sends])
+            tracks.append(t)
+        return tracks
+
+    def update_from_json(self, tracks):
+        # Tracks missing from the JSON state keep their current values; every
+        # track that is there must have all parameters. Raises ValueError for
+        # invalid data.
+        for i,t in enumerate(tracks[:self.n_tracks+1]):
+            try:
+                for p in self.params:
+                    getattr(self, p)[i] = float(t[p])
+                for j,v in enumerate(t['send'][:self.n_sends]):
+                    self.send[i*self.n_sends + j] = float(v)
+            except (KeyError, TypeError):
+                raise ValueError('Invalid state for track {}'.format(i))
+
+    def __eq__(self, other):
+        if not isinstance(other, MixerState):
+            return NotImplemented
+        return (self.n_tracks == other.n_tracks and
+                self.n_sends == other.n_sends and
+                all(getattr(self, p) == getattr(other, p) for p in self.params) and
+                self.send == other.send)
+
+    def __ne__(self, other):
+        r = self.__eq__(other)
+        return r if r is NotImplemented else not r
+
+    def __str__(self):
+        s = []
+        for i in range(self.n_tracks+1):
+            ss = ['{}: {:.2f}'.format(p, getattr(self, p)[i]) for p in self.params]
+            ss += ['send_{}: {:.2f}'.format(j, self.get_send(i, j))
+                   for j in range(1, self.n_sends+1)]
+            s.append('Track {}. '.format(i) + ' '.join(ss))
+        return '\n'.join(s)
@@ -0,0 +1,239 @@
+import socket
+import struct
+
+# Pure Python OSC 1.0 encoding and decoding for the UDP transport, and the
+# addresses of OSC endpoints. Arguments are encoded the way pyliblo does it:
+# floats as 32 bit floats, ints as 32 bit ints unless they do not fit (then
+# as 64 bit ints), strings as strings, True, False and None as T, F and N.
+
+class AddressError(Exception):
+    pass
+
+class Address(object):
+    # A UDP endpoint; the host name is resolved once, here
+    def __init__(self, host, port):
+        try:
+            port = int(port)
+            ip = socket.gethostbyname(host)
+        except (ValueError, TypeError, socket.error), e:
+            raise AddressError('Invalid address {}:{}: {}'.format(host, port, e))
+        if not 0 <= port < 65536:
+            raise AddressError('Invalid port {}'.format(port))
+        self.hostname = host
+        self.port = port
+        self.sockaddr = (ip, port)
+        self.url = 'osc.udp://{}:{}/'.format(host, port)
+
+    def get_hostname(self):
+        return self.hostname
+
+    def get_port(self):
+        return self.port
+
+    def __eq__(self, other):
+        return isinstance(other, Address) and self.sockaddr == other.sockaddr
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.sockaddr)
+
+    def __repr__(self):
+        return 'Address({!r}, {})'.format(self.hostname, self.port)
+
+def _padded(n):
+    return (n + 3) & ~3
+
+def osc_size(path, args):
+    # Size in bytes of the encoded OSC message
+    n = _padded(len(path) + 1) + _padded(len(args) + 2)
+    for a in args:
+        if isinstance(a, unicode):
+            n += _padded(len(a.encode('utf-8')) + 1)
+        elif isinstance(a, str):
+            n += _padded(len(a) + 1)
+        elif a is True or a is False or a is None:
+            pass
+        elif isinstance(a, (int, long)) and not -2**31 <= a < 2**31:
+            n += 8
+        else:
+            n += 4
+    return n
+
+BUNDLE = '#bundle\x00'
+# Time tag 1 means "immediately"
+TIMETAG_NOW = struct.pack('>II', 0, 1)
+_INT = struct.Struct('>i')
+_FLOAT = struct.Struct('>f')
+_LONG = struct.Struct('>q')
+_DOUBLE = struct.Struct('>d')
+_TIMETAG = struct.Struct('>II')
+_MIDI = struct.Struct('>BBBB')
+
+class Encoder(object):
+    # Encodes messages and bundles into one buffer that is allocated once and
+    # only grows when a packet does not fit. The returned memoryview is only
+    # valid until the next call, so an encoder must not be shared between
+    # threads.
+    def __init__(self, size=65536):
+        self.buf = bytearray(size)
+
+    def _reserve(self, n):
+        if n > len(self.buf):
+            self.buf = bytearray(max(n, 2 * len(self.buf)))
+
+    def message(self, path, args):
+        n = osc_size(path, args)
+        self._reserve(n)
+        end = self._encode(path, args, 0)
+        return memoryview(self.buf)[:end]
+
+    def bundle(self, messages):
+        # [(path, args), ...] as one bundle to be dispatched immediately
+        n = 16 + sum(4 + osc_size(path, args) for path,args in messages)
+        self._reserve(n)
+        buf = self.buf
+        buf[0:16] = BUNDLE + TIMETAG_NOW
+        k = 16
+        for path,args in messages:
+            end = self._encode(path, args, k + 4)
+            _INT.pack_into(buf, k, end - k - 4)
+            k = end
+        return memoryview(buf)[:k]
+
+    def _string(self, s, k):
+        # Writes a padded string at k, returns where it ends
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        n = len(s)
+        end = k + _padded(n + 1)
+        self.buf[k:k+n] = s
+        self.buf[k+n:end] = '\x00' * (end - k - n)
+        return end
+
+    def _encode(self, path, args, k):
+        # Writes the message at k, returns where it ends
+        buf = self.buf
+        k = self._string(path, k)
+        tags = [',']
+        values = []
+        for a in args:
+            if a is True:
+                tags.append('T')
+            elif a is False:
+                tags.append('F')
+            elif a is None:
+                tags.append('N')
+            elif isinstance(a, float):
+                tags.append('f')
+                values.append((_FLOAT, a))
+            elif isinstance(a, (int, long)):
+                if -2**31 <= a < 2**31:
+                    tags.append('i')
+                    values.append((_INT, a))
+                else:
+                    tags.append('h')
+                    values.append((_LONG, a))
+            elif isinstance(a, basestring):
+                tags.append('s')
+                values.append((None, a))
+            else:
+                raise TypeError('Cannot send {!r} via OSC'.format(a))
+        k = self._string(''.join(tags), k)
+        for s,v in values:
+            if s is None:
+                k = self._string(v, k)
+            else:
+                s.pack_into(buf, k, v)
+                k += s.size
+        return k
+
+class DecodeError(Exception):
+    pass
+
+def _read_string(data, k, end):
+    z = data.find('\x00', k, end)
+    if z < 0:
+        raise DecodeError('Unterminated string at offset {}'.format(k))
+    return str(data[k:z]), _padded(z + 1)
+
+def decode(data, start=0, end=None):
+    # The messages in the packet data[start:end] (bundles are flattened) as
+    # [(path, typetags, args), ...], with arguments converted like pyliblo
+    # does it. data is a bytearray or a str.
+    if end is None:
+        end = len(data)
+    messages = []
+    _decode(data, start, end, messages)
+    return messages
+
+def _decode(data, k, end, messages):
+    try:
+        if data[k:k+8] == BUNDLE:
+            k += 16
+            while k < end:
+                n, = _INT.unpack_from(data, k)
+                k += 4
+                if n < 0 or k + n > end:
+                    raise DecodeError('Invalid bundle element size {}'.format(n))
+                _decode(data, k, k + n, messages)
+                k += n
+            return
+        path, k = _read_string(data, k, end)
+        if k >= end:
+            # Messages without type tags are allowed by OSC 1.0
+            messages.append((path, '', []))
+            return
+        tags, k = _read_string(data, k, end)
+        if not tags.startswith(','):
+            raise DecodeError('Invalid type tags "{}"'.format(tags))
+        tags = tags[1:]
+        args = []
+        for t in tags:
+            if t == 'i':
+                args.append(_INT.unpack_from(data, k)[0])
+                k += 4
+            elif t == 'f':
+                args.append(_FLOAT.unpack_from(data, k)[0])
+                k += 4
+            elif t == 's' or t == 'S':
+                s, k = _read_string(data, k, end)
+                args.append(s)
+            elif t == 'h':
+                args.append(_LONG.unpack_from(data, k)[0])
+                k += 8
+            elif t == 'd':
+                args.append(_DOUBLE.unpack_from(data, k)[0])
+                k += 8
+            elif t == 'T':
+                args.append(True)
+            elif t == 'F':
+                args.append(False)
+            elif t == 'N':
+                args.append(None)
+            elif t == 'I':
+                args.append(float('inf'))
+            elif t == 'c':
+                args.append(chr(_INT.unpack_from(data, k)[0] & 0xff))
+                k += 4
+            elif t == 'm':
+                args.append(_MIDI.unpack_from(data, k))
+                k += 4
+            elif t == 't':
+                sec, frac = _TIMETAG.unpack_from(data, k)
+                args.append(sec + frac / 2.0**32)
+                k += 8
+            elif t == 'b':
+                n, = _INT.unpack_from(data, k)
+                if n < 0 or k + 4 + n > end:
+                    raise DecodeError('Invalid blob size {}'.format(n))
+                args.append([ord(c) for c in str(data[k+4:k+4+n])])
+                k += 4 + _padded(n)
+            else:
+                raise DecodeError('Unknown type tag "{}"'.format(t))
+            if k > end:
+                raise DecodeError('Truncated message "{}"'.format(path))
+        messages.append((path, tags, args))
+    except struct.error, e:
+        raise DecodeError(str(e))
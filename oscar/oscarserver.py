@@ -1,85 +1,474 @@
-import liblo
+import collections
 import logging
 import threading
-from .devicemanager import DeviceManager
-from .ardour import Ardour
-from .persiststate import PersistState
-from .touchosc import TouchOSC
+import time
+from .metrics import Metrics, monotonic
+from .trace import TraceBuffer
+from .capture import Capture
+from .scheduler import Scheduler
+from .osc import Address
+from .oscsender import OscSender
+from .transport import make_transport
+from .devicegroup import DeviceGroup, GROUP_OPTIONS
 from .zeroconf import OscarService
 
-# TODO: It might be nice to interactively re-broadcast the current state
-#       (e.g. for the case when TouchOSC is restarted or started late).
-
-class OscarServer(liblo.ServerThread):
+class OscarServer(object):
+    # Serves one or more device groups (see DeviceGroup), e.g. one per studio
+    # room, each with its own Ardour, TouchOSC clients and state file. The
+    # keyword arguments are the settings of the one group we have by default;
+    # with groups, a list of dicts with the group options (GROUP_OPTIONS)
+    # that differ from them, there is a group for each dict. Every group has
+    # a name then, which prefixes its gauges and startup phases. Groups on
+    # the same oscar_port share the port; their messages are told apart by
+    # where they come from. Zeroconf, the metrics, trace and capture, the
+    # scheduler and the saver and stats threads are shared by all groups.
     def __init__(self, oscar_port=8000,
                  ardour_ip='127.0.0.1', ardour_port='3819',
                  touchosc_ip='127.0.0.1', touchosc_port='9000',
                  persist_state=True, state_file='oscar.state',
-                 autosave=True, autosave_interval=60):
-        liblo.ServerThread.__init__(self, oscar_port)
+                 autosave=True, autosave_interval=60, autosave_delay=2,
+                 coalesce_interval=0.0, ardour_bundles=True,
+                 touchosc_bundles=True, restore_rate=100,
+                 restore_bundles=True, startup_timeout=60,
+                 touchosc_page_filter=False, touchosc_queue_size=256,
+                 ardour_session=None, stats_interval=60, value_cache=True,
+                 trace_size=4096, trace_file='oscar.trace',
+                 inbound_queue_size=1024, journal=True,
+                 journal_fsync='interval', journal_fsync_interval=1.0,
+                 scene_rate=1000, reconcile_window=0.5, resync_rate=200,
+                 resync_idle=60, capture_file=None, ardour_action_delay=0.02,
+                 transport='liblo', rcvbuf=0, sndbuf=0, touchosc_match=None,
+                 groups=None):
         self.log = logging.getLogger(__name__)
-        self.os = OscarService(oscar_port)
-
-        # Set up all devices: Ardour, PersistState and TouchOSC
-        self.dm = DeviceManager()
-        self.ardour = Ardour(self.dm, ardour_ip, ardour_port)
-        self.dm.add_device(self.ardour)
-        self.persist = PersistState(self.dm, state_file)
-        self.dm.add_device(self.persist)
-        self.touchosc = TouchOSC(self.dm, touchosc_ip, touchosc_port)
-        self.dm.add_device(self.touchosc)
-
-        # Set up the saver thread
-        self.persist_state = persist_state
-        self.autosave = persist_state and autosave
+        self.startup_timeout = startup_timeout
+        self.timeline = []
+        self.timeline_lock = threading.Lock()
+        self.metrics = Metrics()
+        # The most recent messages, in and out, dumped to trace_file when
+        # handling a message fails or on request
+        self.trace = None
+        self.trace_file = trace_file
+        if trace_size > 0:
+            self.trace = TraceBuffer(trace_size)
+        # All messages in and out, to capture_file, for replaying them
+        self.capture = None
+        if capture_file is not None:
+            self.capture = Capture(capture_file)
+
+        # Paced and delayed sends (restoring the state, Ardour macros) run from
+        # one scheduler thread
+        self.scheduler = Scheduler()
+
+        # The device groups, and a transport (see oscar.transport) for every
+        # port they receive on, which also sends for the groups on that port
+        defaults = {'name': None, 'oscar_port': oscar_port,
+                    'ardour_ip': ardour_ip, 'ardour_port': ardour_port,
+                    'ardour_session': ardour_session,
+                    'ardour_bundles': ardour_bundles,
+                    'ardour_action_delay': ardour_action_delay,
+                    'touchosc_ip': touchosc_ip, 'touchosc_port': touchosc_port,
+                    'touchosc_match': touchosc_match,
+                    'touchosc_bundles': touchosc_bundles,
+                    'touchosc_page_filter': touchosc_page_filter,
+                    'touchosc_queue_size': touchosc_queue_size,
+                    'resync_rate': resync_rate, 'resync_idle': resync_idle,
+                    'persist_state': persist_state, 'state_file': state_file,
+                    'restore_rate': restore_rate,
+                    'restore_bundles': restore_bundles, 'journal': journal,
+                    'journal_fsync': journal_fsync,
+                    'journal_fsync_interval': journal_fsync_interval,
+                    'scene_rate': scene_rate,
+                    'reconcile_window': reconcile_window,
+                    'coalesce_interval': coalesce_interval,
+                    'value_cache': value_cache,
+                    'inbound_queue_size': inbound_queue_size}
+        options = self.group_options(defaults, groups)
+        # Changes to the state of any group wake up the saver thread
+        self.changed = threading.Event()
+        self.transports = collections.OrderedDict()
+        self.ports = collections.OrderedDict()
+        self.groups = []
+        for o in options:
+            port = int(o['oscar_port'])
+            if port not in self.transports:
+                self.transports[port] = make_transport(transport, port, rcvbuf,
+                                                       sndbuf)
+                self.ports[port] = []
+            g = DeviceGroup(transport=self.transports[port],
+                            metrics=self.metrics, trace=self.trace,
+                            capture=self.capture, scheduler=self.scheduler,
+                            changed=self.changed,
+                            timeline=self.add_to_timeline,
+                            on_restored=self.restored,
+                            dump_trace=self.dump_trace, **o)
+            self.groups.append(g)
+            self.ports[port].append(g)
+        self.n_restored = 0
+        # The first (usually the only) group's devices, for convenience
+        g = self.groups[0]
+        self.transport = self.transports[int(g.oscar_port)]
+        self.dm, self.ardour, self.persist, self.touchosc, self.inbox = (
+            g.dm, g.ardour, g.persist, g.touchosc, g.inbox)
+
+        # Announce every port via Zeroconf, with the names of its groups
+        self.services = []
+        for port,gs in self.ports.iteritems():
+            names = [g.name for g in gs if g.name is not None]
+            label = 'oscar' if len(names) == 0 else 'oscar ' + ', '.join(names)
+            self.services.append(OscarService(port, label))
+
+        # Inbound routing: the paths we know about get their own method, with
+        # the groups on the port and the precompiled route as user data;
+        # everything else goes to the catch-all got_message, which has to be
+        # registered last. Where several groups share a port, the route is
+        # looked up once we know whose message it is. TouchOSC's routes
+        # change with the number of tracks Ardour lists, after they were
+        # registered here, so its methods also get the route table the route
+        # came from: once TouchOSC compiled a new one, the route is looked up
+        # in that instead, and paths that are new go to got_message.
+        for port,gs in self.ports.iteritems():
+            t = self.transports[port]
+            gs = tuple(gs)
+            for g in gs:
+                for path,route in g.ardour.routes.iteritems():
+                    t.add_method(path, None, self.got_ardour_message,
+                                 (gs, route))
+                routes = g.touchosc.routes
+                for path,route in routes.iteritems():
+                    t.add_method(path, None, self.got_touchosc_message,
+                                 (gs, routes, route))
+            t.add_method('/oscar/stats', None, self.got_stats_query, t)
+            t.add_method('/oscar/trace', None, self.got_trace_request)
+            for action in ('recall', 'save', 'delete'):
+                t.add_method('/oscar/scene/' + action, None,
+                             self.got_scene_request, gs)
+            t.add_method(None, None, self.got_message, gs)
+
+        # Set up the saver thread, which saves all groups. With the journal,
+        # changes are safe as soon as they are journaled, so saving (i.e.
+        # compacting the journal) only needs to happen every
+        # autosave_interval seconds.
+        self.persist_state = any(g.persistent for g in self.groups)
+        self.autosave = self.persist_state and autosave
+        if all(g.persist.use_journal for g in self.groups if g.persistent):
+            autosave_delay = autosave_interval
         self.saver_thread = None
         self.exit_saver_thread = None
         if self.autosave:
             self.saver_thread = threading.Thread(target=self.saver_thread_run,
-                                                 args=(autosave_interval,))
+                                                 args=(autosave_interval,
+                                                       autosave_delay))
             self.exit_saver_thread = threading.Event()
 
+        # Log a summary of the metrics every stats_interval seconds
+        self.stats_interval = stats_interval
+        self.stats_thread = None
+        self.exit_stats_thread = threading.Event()
+        if stats_interval > 0:
+            self.stats_thread = threading.Thread(target=self.stats_thread_run)
+            self.stats_thread.daemon = True
+
+    def group_options(self, defaults, groups):
+        # The options of every group: the defaults, updated with what is set
+        # for the group. Raises ValueError for invalid groups.
+        if not groups:
+            return [defaults]
+        options = []
+        for k,group in enumerate(groups):
+            unknown = set(group) - set(GROUP_OPTIONS)
+            if unknown:
+                raise ValueError('Unknown option(s) for group {}: {}'.format(
+                                 k+1, ', '.join(sorted(unknown))))
+            o = dict(defaults)
+            o['name'] = 'group{}'.format(k+1)
+            o.update(group)
+            options.append(o)
+        for key in ('name', 'state_file'):
+            values = [o[key] for o in options if o[key] is not None]
+            if len(set(values)) != len(values):
+                raise ValueError('Every group needs a {} of its '
+                                 'own'.format(key.replace('_', ' ')))
+        ardours = [(o['ardour_ip'], str(o['ardour_port'])) for o in options]
+        if len(set(ardours)) != len(ardours):
+            raise ValueError('Every group needs an Ardour of its own')
+        return options
+
     def start(self):
-        # While the saver_thread is running, self.persist.save must only be
-        # called from the saver_thread.
-        # Calling self.persist.save from a different thread (the saver_thread)
-        # also assumes that updates to PersistState.state are atomic --- which
-        # right now should be true (plus there's the global interpreter lock);
-        # otherwise we might store an inconsistent state.
-        self.os.publish()
-        liblo.ServerThread.start(self)
-        self.touchosc.start()
-        self.ardour.start()
-        if self.touchosc.ready() and self.ardour.ready():
-            self.persist.restore()
-        else:
-            self.persist_state = False
-            self.autosave = False
-            self.log.warning('Ardour and TouchOSC are not ready: Not restoring '
-                             'or saving state')
+        # self.persist.save takes a snapshot of the state under the
+        # PersistState lock, so it is safe to call it from the saver_thread
+        # while the OSC thread keeps updating the state.
+        self.t_start = time.time()
+        self.timeline = []
+        self.run_phase('publish', self.publish)
+        self.run_phase('server', self.start_transports)
+
+        # Start all groups at the same time, all bounded by the startup
+        # deadline
+        deadline = self.t_start + self.startup_timeout
+        threads = [threading.Thread(target=self.start_group,
+                                    args=(g, deadline))
+                   for g in self.groups]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join(max(deadline - time.time(), 0))
+        if self.named_groups():
+            self.add_to_timeline('ready', time.time() - self.t_start)
+
+        # Groups whose Ardour is not there yet start saving once it is
         if self.autosave:
             self.saver_thread.start()
+        if self.stats_thread is not None:
+            self.stats_thread.start()
+
+    def publish(self):
+        for s in self.services:
+            s.publish()
+
+    def start_transports(self):
+        for t in self.transports.itervalues():
+            t.start()
+
+    def start_group(self, g, deadline):
+        if not g.start(self.t_start, deadline):
+            self.log_timeline()
+
+    def restored(self, group):
+        # Called by every group once it restored its state
+        with self.timeline_lock:
+            self.n_restored += 1
+            done = self.n_restored == len(self.groups)
+        if done:
+            if self.named_groups():
+                self.add_to_timeline('restored', time.time() - self.t_start)
+            self.log_timeline()
+
+    def named_groups(self):
+        # Unless the groups are named, the one group's ready and restored are
+        # those of the server
+        return self.groups[0].name is not None
+
+    def run_phase(self, name, f, *args):
+        t = time.time()
+        try:
+            f(*args)
+        finally:
+            self.add_to_timeline(name, time.time() - t)
+
+    def add_to_timeline(self, name, duration):
+        with self.timeline_lock:
+            self.timeline.append((name, duration))
+
+    def log_timeline(self):
+        # Phases are logged with their durations; ready and restored are the
+        # times since the start
+        with self.timeline_lock:
+            ts = ['{} {:.3f} s'.format(name, d) for name,d in self.timeline]
+        self.log.info('Startup timeline: ' + ', '.join(ts))
 
     def stop(self):
-        self.os.unpublish()
-        liblo.ServerThread.stop(self)
-        self.ardour.stop()
-        self.touchosc.stop()
+        for s in self.services:
+            s.unpublish()
+        for t in self.transports.itervalues():
+            t.stop()
+        for g in self.groups:
+            g.stop()
+        self.scheduler.stop()
+        for g in self.groups:
+            g.stop_devices()
+        if self.stats_thread is not None:
+            self.exit_stats_thread.set()
+            self.stats_thread.join()
         if self.autosave:
             self.exit_saver_thread.set()
+            self.changed.set()
             self.saver_thread.join()
-        if self.persist_state:
-            self.persist.save()
+        for g in self.groups:
+            g.close()
+        if self.capture is not None:
+            self.capture.close()
+
+    def free(self):
+        # Releases the ports; call after stop()
+        for t in self.transports.itervalues():
+            t.free()
+
+    def saver_thread_run(self, autosave_interval, autosave_delay):
+        # Save a group's state once it has not changed for autosave_delay
+        # seconds, but at the latest autosave_interval seconds after the first
+        # unsaved change; never save an unchanged state. Every change of any
+        # group sets the changed event; while a save is pending, we only wake
+        # up for it (or at least every autosave_delay seconds, for changes of
+        # other groups). Run until we get the exit event.
+        groups = [g for g in self.groups if g.persistent]
+        # Changes up to saved_until[g] are saved; first[g] is when we noticed
+        # the first unsaved change
+        saved_until = dict((g, 0.0) for g in groups)
+        first = {}
+        while not self.exit_saver_thread.is_set():
+            self.changed.clear()
+            t = time.time()
+            t_next = None
+            saved = False
+            for g in groups:
+                p = g.persist
+                last_change = p.last_change
+                if last_change <= saved_until[g] or not g.persist_state:
+                    continue
+                t_first = first.setdefault(g, t)
+                due = min(last_change + autosave_delay,
+                          t_first + autosave_interval)
+                if due <= t:
+                    saved_until[g] = last_change
+                    del first[g]
+                    p.save()
+                    saved = True
+                elif t_next is None or due < t_next:
+                    t_next = due
+            if saved:
+                # Saving clears the changed event, so look again right away
+                continue
+            if t_next is None:
+                self.changed.wait()
+            else:
+                self.exit_saver_thread.wait(min(t_next - t, autosave_delay))
+
+    def stats_thread_run(self):
+        last_in = last_out = 0
+        last_h = self.metrics.merged_histogram('in')
+        t_last = monotonic()
+        while not self.exit_stats_thread.wait(self.stats_interval):
+            t = monotonic()
+            n_in = self.metrics.total('in')
+            n_out = self.metrics.total('out')
+            h = self.metrics.merged_histogram('in')
+            self.log_stats(n_in - last_in, n_out - last_out, h.since(last_h),
+                           t - t_last)
+            last_in, last_out, last_h, t_last = n_in, n_out, h, t
+
+    def log_stats(self, n_in, n_out, h, dt):
+        # One line for the last interval: message rates, how long it took to
+        # dispatch inbound messages, and how the queues of all groups are
+        # doing
+        dt = max(dt, 1e-6)
+        def g(name):
+            return sum(self.metrics.gauge(group.prefix + name)
+                       for group in self.groups)
+        self.log.info('Stats: in {} ({:.1f}/s), out {} ({:.1f}/s), dispatch '
+                      'p50 {:.3f} ms p99 {:.3f} ms max {:.3f} ms, queue depth '
+                      'inbound {} ardour {} touchosc {}, dropped inbound {} '
+                      'ardour {} touchosc {}'.format(
+                          n_in, n_in / dt, n_out, n_out / dt,
+                          h.percentile(0.5) * 1e3, h.percentile(0.99) * 1e3,
+                          h.max * 1e3, g('inbound.queue_depth'),
+                          g('ardour.queue_depth'), g('touchosc.queue_depth'),
+                          g('inbound.dropped'), g('ardour.dropped'),
+                          g('touchosc.dropped')))
+
+    def got_stats_query(self, path, args, types, src, transport):
+        # Reply to whoever asked, or to the port given as argument, with one
+        # message per counter, latency histogram and gauge, and an end marker
+        address = src
+        if len(args) > 0 and types[0] == 'i':
+            address = Address(src.hostname, args[0])
+        counters, histograms, gauges = self.metrics.snapshot()
+        # A sender of its own, closed again once the reply is out, so that
+        # every address that ever asked does not keep a send queue thread
+        sender = OscSender(transport=transport)
+        sender.begin()
+        for key,n in counters:
+            sender.send(address, '/oscar/stats/counter', key, n)
+        for key,h in histograms:
+            sender.send(address, '/oscar/stats/latency', key, h.n,
+                        h.mean() * 1e3, h.percentile(0.5) * 1e3,
+                        h.percentile(0.99) * 1e3, h.max * 1e3)
+        for name,v in gauges:
+            sender.send(address, '/oscar/stats/gauge', name, float(v))
+        sender.send(address, '/oscar/stats/end',
+                    monotonic() - self.metrics.t_start)
+        sender.end()
+        sender.close()
 
-    def saver_thread_run(self, autosave_interval):
-        # Save every autosave_interval seconds, until we get the exit event
-        while self.persist_state and not self.exit_saver_thread.wait(autosave_interval):
-            self.persist.save()
+    def got_trace_request(self, path, args, types, src):
+        self.dump_trace()
 
-    @liblo.make_method(None, None)
-    def got_message(self, path, args):
-        self.log.debug('Got message "{}" with arguments {}'.format(path, args))
+    def got_scene_request(self, path, args, types, src, groups):
+        # Scenes by name, e.g. from a script; TouchOSC uses numbered scenes.
+        # Where groups share the port, the second argument says which group.
+        if len(args) == 0 or types[0] != 's':
+            return
+        gs = groups
+        if len(groups) > 1:
+            gs = [g for g in groups if len(args) > 1 and g.name == args[1]]
+            if len(gs) == 0:
+                self.log.warning('Ignoring "{}" without a valid group '
+                                 'name'.format(path))
+                return
+        action = path.rsplit('/', 1)[1]
+        getattr(gs[0].persist, action + '_scene')(args[0])
+
+    def dump_trace(self):
+        if self.trace is not None:
+            self.trace.dump_to_file(self.trace_file)
+
+    def ardour_group(self, groups, src):
+        # The group whose Ardour sent the message
+        if len(groups) == 1:
+            return groups[0]
+        for g in groups:
+            if g.owns_ardour(src):
+                return g
+        return None
+
+    def touchosc_group(self, groups, src):
+        # The group the sending tablet belongs to
+        if len(groups) == 1:
+            return groups[0]
+        for g in groups:
+            if g.owns_touchosc(src):
+                return g
+        return None
+
+    def got_ardour_message(self, path, args, types, src, data):
+        groups,route = data
+        g = self.ardour_group(groups, src)
+        if g is not None and len(groups) > 1:
+            route = g.ardour.routes.lookup(path)
+        self.receive(g, 'ardour', route, path, args, src)
+
+    def got_touchosc_message(self, path, args, types, src, data):
+        groups,routes,route = data
+        g = self.touchosc_group(groups, src)
+        if g is not None and (len(groups) > 1 or
+                              g.touchosc.routes is not routes):
+            route = g.touchosc.routes.lookup(path)
+        self.receive(g, 'touchosc', route, path, args, src)
+
+    def got_message(self, path, args, types, src, groups):
+        # Paths we do not have a method for are parsed by the devices
+        # (once, see RouteTable)
         if path.startswith('/route/') or path.startswith('#reply'):
-            self.ardour.handle_osc(path, args)
+            g = self.ardour_group(groups, src)
+            route = g.ardour.routes.lookup(path) if g is not None else None
+            self.receive(g, 'ardour', route, path, args, src)
         elif path.startswith('/oscar_page'):
-            self.touchosc.handle_osc(path, args)
+            g = self.touchosc_group(groups, src)
+            route = g.touchosc.routes.lookup(path) if g is not None else None
+            self.receive(g, 'touchosc', route, path, args, src)
+        else:
+            self.receive(None, 'unknown', None, path, args, src)
+
+    def receive(self, group, device, route, path, args, src):
+        # Runs on the receive thread: hand the message to its group, which
+        # queues it for its dispatch thread
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('Got message "{}" with arguments {}'.format(path, args))
+        if self.trace is not None:
+            self.trace.record('in.' + device, path, args)
+        if self.capture is not None:
+            self.capture.record('in.' + device, src.url, path, args)
+        if route is None or group is None:
+            self.metrics.count('in', device, path)
+            return
+        group.receive(device, route, path, args, src)
@@ -0,0 +1,122 @@
+import logging
+import threading
+from .sendqueue import SendQueue, MAX_DATAGRAM_SIZE
+from .transport import LibloTransport
+
+class OscSender(object):
+    # Sends OSC messages on behalf of a device. Messages are never sent on the
+    # calling thread: every destination has its own SendQueue with a worker
+    # that sends whatever has piled up as OSC bundles of at most max_size
+    # bytes, i.e. one datagram per destination instead of one per message.
+    # With bundle=False every message is sent separately, for devices that do
+    # not cope well with bundles. Between begin() and end() the messages are
+    # collected and queued all at once when the batch ends. Batches are kept
+    # per thread, so that one thread ending its batch neither flushes nor
+    # splits a batch another thread still has open.
+    #
+    # key(path, args) tells continuous values (volume, pan, ...) from
+    # discrete commands: for continuous values it returns which control of
+    # which track the message sets, so that the queue may drop the value in
+    # favour of a newer one when the destination cannot keep up; for discrete
+    # commands, which are never dropped, it returns None. Without key, every
+    # message counts as discrete.
+    #
+    # With metrics, every message is counted under the given device name;
+    # with a trace buffer or a capture, every message is recorded. The
+    # packets go out through transport (see oscar.transport); without one, a
+    # liblo transport that only sends.
+    def __init__(self, bundle=True, max_size=MAX_DATAGRAM_SIZE, metrics=None,
+                 name=None, trace=None, key=None, queue_size=256,
+                 capture=None, transport=None):
+        self.log = logging.getLogger(__name__)
+        if transport is None:
+            transport = LibloTransport()
+        self.transport = transport
+        self.metrics = metrics
+        self.name = name
+        self.trace = trace
+        self.capture = capture
+        self.origin = 'out.{}'.format(name)
+        self.key = key
+        self.bundle = bundle
+        self.max_size = max_size
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        # Per thread: depth, the batch nesting level, and queued,
+        # url -> (address, [((path, args), key), ...])
+        self.local = threading.local()
+        # url -> SendQueue
+        self.queues = {}
+        self.n_packets = 0
+
+    def send(self, address, path, *args):
+        if self.metrics is not None:
+            self.metrics.count('out', self.name, path)
+        if self.trace is not None:
+            self.trace.record(self.origin, path, args)
+        if self.capture is not None:
+            self.capture.record(self.origin, address.url, path, args)
+        item = ((path, args), self.key(path, args) if self.key else None)
+        if getattr(self.local, 'depth', 0) > 0:
+            queued = self.local.queued
+            q = queued.get(address.url)
+            if q is None:
+                q = queued[address.url] = (address, [])
+            q[1].append(item)
+            return
+        self.queue(address).put_many([item])
+
+    def queue(self, address):
+        q = self.queues.get(address.url)
+        if q is None:
+            q = self.add_queue(address)
+        return q
+
+    def add_queue(self, address, maxsize=None, name=None):
+        with self.lock:
+            q = self.queues.get(address.url)
+            if q is None:
+                q = SendQueue(address, self.transmit, name,
+                              maxsize or self.queue_size, self.bundle,
+                              self.max_size)
+                self.queues[address.url] = q
+        return q
+
+    def remove_queue(self, address):
+        # Sends what is still queued for address first
+        with self.lock:
+            q = self.queues.pop(address.url, None)
+        if q is not None:
+            q.close()
+
+    def close(self):
+        with self.lock:
+            qs = self.queues.values()
+            self.queues = {}
+        for q in qs:
+            q.close()
+
+    def transmit(self, address, messages):
+        self.n_packets += 1
+        self.transport.send(address, messages)
+
+    def queue_depth(self):
+        return sum(q.depth() for q in self.queues.values())
+
+    def n_dropped(self):
+        return sum(q.n_dropped for q in self.queues.values())
+
+    def begin(self):
+        depth = getattr(self.local, 'depth', 0)
+        if depth == 0:
+            self.local.queued = {}
+        self.local.depth = depth + 1
+
+    def end(self):
+        self.local.depth -= 1
+        if self.local.depth > 0 or len(self.local.queued) == 0:
+            return
+        queued = self.local.queued
+        self.local.queued = {}
+        for address,items in queued.itervalues():
+            self.queue(address).put_many(items)
@@ -1,55 +1,276 @@
+import collections
 import logging
-import copy
 import os
 import json
 import time
+import threading
+from .journal import Journal
+from .mixerstate import MixerState
+from .scheduler import Scheduler, Sequence
+from .routemap import DEFAULT_N_TRACKS
 
 class PersistState(object):
-    def __init__(self, dm, state_file='oscar.state'):
+    # Parameters are journaled by their index in MixerState.params; sends
+    # come after them
+    param_codes = dict((p, k) for k,p in
+                       enumerate(MixerState.params + ('send',)))
+
+    def __init__(self, dm, state_file='oscar.state', restore_rate=100,
+                 restore_bundle=True, journal=True, journal_fsync='interval',
+                 journal_fsync_interval=1.0, scene_rate=1000,
+                 reconcile_window=0.5, scheduler=None, changed=None):
         self.log = logging.getLogger(__name__)
         self.name = 'persiststate'
         self.dm = dm
         self.state_file = state_file
-        self.n_tracks = 12 # probably should be a global property
-        track_state = {'vol': 1.0, 'mute': 0.0, 'solo': 0.0, 'record': 0.0,
-                       'pan': 0.5, 'send': [1.0]}
-        self.state = [copy.deepcopy(track_state) for i in range(self.n_tracks + 1)]
+        self.n_tracks = DEFAULT_N_TRACKS
+        self.n_sends = 1
+        self.state = MixerState(self.n_tracks, self.n_sends)
+
+        # Restoring streams the state out from the scheduler, as a sequence
+        # paced to at most restore_rate controls per second; with
+        # restore_bundle each track goes out as one bundle per device. The
+        # restored event is set once the whole state has been sent.
+        self.restore_rate = restore_rate
+        self.restore_bundle = restore_bundle
+        self.own_scheduler = scheduler is None
+        self.scheduler = Scheduler('persiststate') if scheduler is None else scheduler
+        self.restore_sequence = None
+        self.restored = threading.Event()
+        # The callback of a restore that waits for Ardour to show up (see
+        # defer_restore)
+        self.deferred = None
+
+        # Unless reconcile_window is 0, restoring only sends the controls that
+        # differ from the live state, i.e. from what the devices (Ardour, as
+        # feedback to /routes/listen) reported since we started. Until then
+        # reported values go to live instead of the state; restoring waits up
+        # to reconcile_window seconds for the reports to stop coming in.
+        self.reconcile_window = reconcile_window
+        self.live = None
+        self.live_keys = None
+        self.last_live = 0.0
+        if reconcile_window > 0:
+            self.live = MixerState(self.n_tracks, self.n_sends)
+            self.live_keys = set()
+
+        # Every change to the state bumps the generation; save() only writes
+        # if the generation moved on since the last save. The lock is only
+        # held for single updates and for taking a snapshot of the state.
+        # Changes set the changed event, which may be shared with other
+        # PersistStates (then it says that any of them changed).
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.saved_generation = -1
+        self.last_change = 0.0
+        self.changed = changed if changed is not None else threading.Event()
+        # Saves may come from the saver thread and from saving or deleting a
+        # scene at the same time; they write the same files
+        self.save_lock = threading.Lock()
+
+        # With journal, every change is also appended to the journal file next
+        # to the state file, so that a crash loses next to nothing; save() then
+        # compacts the journal into the state file. The journal is opened by
+        # restore(), after what is in it has been read.
+        self.use_journal = journal and state_file is not None
+        self.journal_fsync = journal_fsync
+        self.journal_fsync_interval = journal_fsync_interval
+        self.journal = None
+        self.journal_seq = 0
+
+        # Named scenes: snapshots of the state, stored in the state file with
+        # it. Recalling a scene only sends the controls that differ from the
+        # current state, track by track as one batch each and paced to at most
+        # scene_rate controls per second, from the recall thread. Until they
+        # are sent, the values for a track can still be replaced by a newer
+        # recall. Scenes are replaced, never modified.
+        self.scenes = {}
+        self.scene_rate = scene_rate
+        # (track, method, [send]) -> (method, args)
+        self.recall_pending = collections.OrderedDict()
+        self.recall_cond = threading.Condition()
+        self.recall_thread = None
 
     def save(self):
         if self.state_file is None:
             return
+        with self.save_lock:
+            self._save()
+
+    def _save(self):
+        with self.lock:
+            self.changed.clear()
+            if self.generation == self.saved_generation:
+                return
+            generation = self.generation
+            state = self.state.copy()
+            scenes = dict(self.scenes)
+            # Everything up to seq is in the snapshot; the journal starts
+            # over. The old journal is only removed once the snapshot is safe.
+            # Rotating does not fsync, so that changes do not wait for the
+            # disk while we hold the lock.
+            seq = self.journal.rotate() if self.journal else self.journal_seq
+        if self.journal:
+            self.journal.sync_old()
+        # Write to a temporary file and rename it, so that a crash while
+        # writing never leaves us with a corrupted state file
+        tmp_file = self.state_file + '.tmp'
         try:
-            with open(self.state_file, 'w') as f:
+            with open(tmp_file, 'w') as f:
                 # TODO: should save oscar version as well
-                d = {'tracks': self.state, '__info__': 'Oscar state file'}
+                d = {'tracks': state.to_json(), 'journal_seq': seq,
+                     'scenes': dict((name, scene.to_json())
+                                    for name,scene in scenes.iteritems()),
+                     '__info__': 'Oscar state file'}
                 json.dump(d, f, indent=2)
-                self.log.info('Saved state to file "{}"'.format(self.state_file))
-        except IOError:
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_file, self.state_file)
+            self._fsync_dir()
+            self.log.info('Saved state to file "{}"'.format(self.state_file))
+        except (IOError, OSError):
             self.log.error('Could not save state: Cannot write to file '
                            '"{}"'.format(self.state_file))
             raise
+        self.saved_generation = generation
+        self.journal_seq = seq
+        if self.journal:
+            self.journal.remove_old()
 
-    def restore(self):
-        if self.read_state_from_state_file():
-            # "Broadcast" the read settings to all devices via the device manager,
-            # i.e. actually restore the settings to Ardour and TouchOSC
-            self.broadcast_state()
-            self.log.info('Restored settings from file "{}"'.format(self.state_file))
+    def _fsync_dir(self):
+        # Make the rename itself durable
+        try:
+            fd = os.open(os.path.dirname(self.state_file) or '.', os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def _changed(self):
+        # Must be called with the lock held
+        self.generation += 1
+        self.last_change = time.time()
+        self.changed.set()
+
+    def restore(self, callback=None):
+        # Reading the state file happens right away, so that errors still
+        # surface on startup; sending the state happens from the scheduler and
+        # callback is called once it is done
+        read = self.read_state_from_state_file()
+        if read:
+            self.log.info('Restoring settings from file "{}"'.format(self.state_file))
+        if self.use_journal and self.journal is None:
+            self.open_journal()
+        # "Broadcast" the settings to all devices via the device manager, i.e.
+        # actually restore the settings to Ardour and TouchOSC --- or, when
+        # reconciling, only the settings the devices do not have already. If
+        # there was nothing to read we broadcast our settings anyway --- so
+        # that Ardour and TouchOSC and we are in a consistent state ---, except
+        # that when reconciling we take over the live settings instead.
+        self.restored.clear()
+        if self.live is not None:
+            self.wait_for_reports(callback, not read)
         else:
-            # Broadcast our settings anyway --- so that Ardour and TouchOSC and
-            # we are in a consistent state; we might want to make this behaviour
-            # configurable
-            self.broadcast_state()
+            self.broadcast_state(callback)
+
+    def open_journal(self):
+        # Compact whatever the last run left in the journal (so that replaying
+        # it is never needed twice), then start a fresh one
+        self.journal = Journal(self.state_file + '.journal', self.journal_fsync,
+                               self.journal_fsync_interval, self.journal_seq)
+        if (os.path.exists(self.journal.filename) or
+            os.path.exists(self.journal.old_filename)):
+            with self.lock:
+                self.generation += 1
+            self.journal.open()
+            self.save()
+        else:
+            self.journal.open()
+
+    def close(self):
+        with self.lock:
+            if self.restore_sequence is not None:
+                self.restore_sequence.cancel()
+        if self.own_scheduler:
+            self.scheduler.stop()
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
 
     def read_state_from_state_file(self):
-        # Open file if it exists and parse json
+        # Open file if it exists and parse json, then replay the changes in the
+        # journal that are not in the file yet
         if self.state_file is None:
             return False
-        if not os.path.exists(self.state_file):
+        d = None
+        if os.path.exists(self.state_file):
+            d = self._read_state_file()
+        elif not self.use_journal:
             self.log.info('Oscar state file "{}" does not exist '
                           '--- no settings to restore'.format(self.state_file))
             return False
-        d = {}
+
+        # Read contents of file to self.state; basic validity check on the
+        # read data structure
+        state = self.state.copy()
+        seq = 0
+        scenes = {}
+        if d is not None:
+            try:
+                if not isinstance(d, dict) or not d.has_key('tracks'):
+                    raise ValueError('No tracks')
+                state.update_from_json(d['tracks'])
+                seq = int(d.get('journal_seq', 0))
+                for name,tracks in d.get('scenes', {}).iteritems():
+                    scene = MixerState(state.n_tracks, state.n_sends)
+                    scene.update_from_json(tracks)
+                    scenes[name] = scene
+            except (ValueError, TypeError):
+                self.log.error('Could not restore state: Invalid state file '
+                               '"{}"'.format(self.state_file))
+                raise ValueError('Invalid state file')
+        n, seq = self._replay_journal(state, seq)
+        if d is None and n == 0:
+            self.log.info('Oscar state file "{}" does not exist '
+                          '--- no settings to restore'.format(self.state_file))
+            return False
+        with self.lock:
+            self.state = state
+            self.scenes = scenes
+            self.journal_seq = seq
+            self.generation += 1
+            # The state file is up to date, unless the journal was not
+            self.saved_generation = self.generation if n == 0 else -1
+        return True
+
+    def _replay_journal(self, state, seq):
+        # Applies the journaled changes after seq to state; returns how many
+        # were applied and the last sequence number
+        if not self.use_journal:
+            return 0, seq
+        n = 0
+        journal = Journal(self.state_file + '.journal')
+        for s,i,param,j,v,t in journal.replay():
+            if s <= seq:
+                continue
+            seq = s
+            if param == len(MixerState.params):
+                if state.valid(i, j):
+                    state.set_send(i, j, v)
+                    n += 1
+            elif param < len(MixerState.params) and state.valid(i):
+                state.set(MixerState.params[param], i, v)
+                n += 1
+        if n > 0:
+            self.log.info('Replayed {} changes from journal "{}"'.format(
+                          n, journal.filename))
+        return n, seq
+
+    def _read_state_file(self):
         try:
             with open(self.state_file, 'r') as f:
                 d = json.load(f)
@@ -61,61 +282,335 @@ class PersistState(object):
             self.log.error('Could not restore state: Invalid state file '
                            '"{}"'.format(self.state_file))
             raise
+        return d
 
-        # Read contents of file to self.state; basic validity check on the
-        # read data structure
-        valid = True
-        state_copy = copy.deepcopy(self.state)
-        if not d.has_key('tracks'):
-            valid = False
+    def broadcast_state(self, callback=None):
+        # "Broadcast" our state to all devices via the device manager
+        t_start = time.time()
+        def done(n):
+            duration = time.time() - t_start
+            self.log.info('Restored {} controls in {:.2f} seconds ({:.0f} '
+                          'controls per second)'.format(
+                          n, duration, n / max(duration, 1e-6)))
+            if callback is not None:
+                callback()
+            self.restored.set()
+        with self.lock:
+            tracks = [[(k,) + args[:-1] for k,args in self.state.controls(i)]
+                      for i in range(self.state.n_tracks+1)]
+        self._send_tracks(tracks, done)
+
+    def wait_for_reports(self, callback=None, adopt=False, t_start=None):
+        # Wait (on the scheduler) until the devices stopped reporting for a
+        # moment, but at most reconcile_window seconds, then reconcile
+        if t_start is None:
+            t_start = time.time()
+        quiet = min(0.1, self.reconcile_window)
+        with self.lock:
+            last_live = max(self.last_live, t_start)
+        delay = min(t_start + self.reconcile_window,
+                    last_live + quiet) - time.time()
+        if delay > 0:
+            self.scheduler.call_later(delay, self.wait_for_reports, callback,
+                                      adopt, t_start)
         else:
-            for i,t in enumerate(state_copy):
-                if i<len(d['tracks']):
-                    t_ = d['tracks'][i]
-                    for k in t.keys():
-                        if not t_.has_key(k):
-                            valid = False
-                        else:
-                            t[k] = t_[k]
-        if not valid:
-            self.log.error('Could not restore state: Invalid state file '
-                           '"{}"'.format(self.state_file))
-            raise ValueError('Invalid state file')
-        self.state = state_copy
-        return True
+            self.reconcile_state(callback, adopt, t_start)
 
-    def broadcast_state(self):
-        # "Broadcast" our state to all devices via the device manager
-        for i,t in enumerate(self.state):
-            for k,v in t.iteritems():
-                f = getattr(self.dm, k)
-                if k == 'send':
-                    f(i,1,v[0],ignore=self.name)
-                else:
-                    f(i,v,ignore=self.name)
-                time.sleep(0.05)
-
-    def __getattr__(self, method_name):
-        def wrapper_method(i, v):
-            if i>=0 and i<=self.n_tracks and type(v) == float:
-                self.state[i][method_name] = v
+    def reconcile_state(self, callback=None, adopt=False, t_start=None):
+        # Send only the controls that differ from the live state, or that no
+        # device reported; with adopt, the reported values become our state
+        if t_start is None:
+            t_start = time.time()
+        with self.lock:
+            live, keys = self.live, self.live_keys
+            self.live = self.live_keys = None
+            if live.n_tracks != self.state.n_tracks:
+                live = live.resized(self.state.n_tracks)
+            if adopt:
+                changed = [self._apply(k, args)
+                           for k,args in self.state.diff(live)
+                           if (k,) + args[:-1] in keys]
+                if any(changed):
+                    self._changed()
+            state = self.state.copy()
+        differ = set((k,) + args[:-1] for k,args in live.diff(state))
+        t_send = time.time()
+        def done(n):
+            # Devices that missed the reports (e.g. a tablet that showed up
+            # late) catch up on the rest, as it is now, with whatever changed
+            # while we were sending
+            with self.lock:
+                current = self.state.copy()
+            self.dm.sync_state(current, ignore=self.name)
+            t_end = time.time()
+            self.log.info('Reconciled with the live state: sent {} of {} '
+                          'controls in {:.3f} seconds ({:.3f} seconds '
+                          'collecting)'.format(
+                          n, len(current.controls(0)) * (current.n_tracks+1),
+                          t_end - t_start, t_send - t_start))
+            if callback is not None:
+                callback()
+            self.restored.set()
+        tracks = [[key for key in ((k,) + args[:-1]
+                                   for k,args in state.controls(i))
+                   if key in differ or key not in keys]
+                  for i in range(state.n_tracks+1)]
+        self._send_tracks(tracks, done)
+
+    def defer_restore(self, callback=None):
+        # Ardour was not there on startup: restore once it shows up, i.e. on
+        # the first reconcile()
+        with self.lock:
+            self.deferred = (callback,)
+
+    def reconcile(self):
+        # A device lost its state (Ardour restarted): collect what it reports
+        # from now on and send it whatever differs from our state. Before we
+        # restored our state in the first place, this is the deferred
+        # restore, if any.
+        if not self.restored.is_set():
+            with self.lock:
+                deferred, self.deferred = self.deferred, None
+                if deferred is not None and self.reconcile_window > 0:
+                    # Whatever came in while Ardour was away is not its state
+                    self.live = MixerState(self.state.n_tracks, self.n_sends)
+                    self.live_keys = set()
+            if deferred is not None:
+                self.log.info('Ardour showed up, restoring the state')
+                try:
+                    self.restore(*deferred)
+                except (IOError, ValueError):
+                    pass
+            return
+        if self.reconcile_window <= 0:
+            self.broadcast_state()
+            return
+        with self.lock:
+            if self.live is not None:
+                return
+            self.live = MixerState(self.state.n_tracks, self.n_sends)
+            self.live_keys = set()
+        self.wait_for_reports()
+
+    def _send_tracks(self, tracks, done=None):
+        # Sends the controls of every track, given as (method, track[, send])
+        # keys, as a sequence on the scheduler, paced to at most restore_rate
+        # controls per second, and calls done(n) with how many were sent
+        # after the last. The values are taken from the state as each track
+        # goes out, so that changes made in the meantime are not undone. A
+        # sequence that is still running is cancelled, the new one sends the
+        # newer values.
+        steps = []
+        delay = 0.0
+        n = 0
+        for keys in tracks:
+            if len(keys) == 0:
+                continue
+            if self.restore_bundle:
+                steps.append((delay, self._send_batch, (keys,)))
+                delay = float(len(keys)) / self.restore_rate
             else:
-                self.log.warning('Invalid arguments for method {}: '
-                                 '{} {}'.format(method_name, i, v))
-            self.log.debug('State: \n{}'.format(str(self)))
-        methods = ['vol', 'mute', 'solo', 'record', 'pan']
-        if method_name in methods:
-            return wrapper_method
+                for key in keys:
+                    steps.append((delay, self._send_batch, ([key],)))
+                    delay = 1.0 / self.restore_rate
+            n += len(keys)
+        sequence = Sequence(self.scheduler, steps,
+                            None if done is None else lambda: done(n))
+        with self.lock:
+            if self.restore_sequence is not None:
+                self.restore_sequence.cancel()
+            self.restore_sequence = sequence
+        sequence.start()
+
+    def _send_batch(self, keys):
+        with self.lock:
+            cs = self._current(keys)
+        self.dm.begin_batch(ignore=self.name)
+        try:
+            for k,args in cs:
+                getattr(self.dm, k)(*args, ignore=self.name)
+        finally:
+            self.dm.end_batch(ignore=self.name)
+
+    def _current(self, keys):
+        # The current values of the controls as (method, arguments) pairs;
+        # must be called with the lock held. Controls of tracks that are gone
+        # are skipped.
+        cs = []
+        for key in keys:
+            k,i = key[0], key[1]
+            if k == 'send':
+                if self.state.valid(i, key[2]):
+                    cs.append((k, (i, key[2], self.state.get_send(i, key[2]))))
+            elif self.state.valid(i):
+                cs.append((k, (i, self.state.get(k, i))))
+        return cs
+
+    def _pace(self, t_next, n, rate=None):
+        # Sleep until the budget for another n controls has accumulated; t_next
+        # is absolute, so that time spent sending does not add up
+        t_next += float(n) / (rate or self.restore_rate)
+        delay = t_next - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        return t_next
+
+    def set_routes(self, routemap):
+        # Ardour told us how many tracks there are
+        with self.lock:
+            if routemap.n_tracks == self.n_tracks:
+                return
+            self.n_tracks = routemap.n_tracks
+            self.state = self.state.resized(self.n_tracks)
+            if self.live is not None:
+                self.live = self.live.resized(self.n_tracks)
+            self.scenes = dict((name, scene.resized(self.n_tracks))
+                               for name,scene in self.scenes.iteritems())
+
+    def save_scene(self, name):
+        with self.lock:
+            self.scenes[name] = self.state.copy()
+            self._changed()
+        self.log.info('Saved scene "{}"'.format(name))
+        self._save_scenes()
+
+    def delete_scene(self, name):
+        with self.lock:
+            if self.scenes.pop(name, None) is None:
+                return
+            self._changed()
+        self.log.info('Deleted scene "{}"'.format(name))
+        self._save_scenes()
+
+    def _save_scenes(self):
+        # The journal only has room for single controls, so with the journal
+        # a change to the scenes is saved right away rather than with the
+        # next compaction; scenes change rarely
+        if self.journal is None:
+            return
+        try:
+            self.save()
+        except (IOError, OSError):
+            pass
+
+    def recall_scene(self, name):
+        # Our own state changes right away; the devices get the difference
+        # from the recall thread
+        with self.lock:
+            scene = self.scenes.get(name)
+            if scene is None:
+                self.log.warning('Cannot recall scene "{}": No such '
+                                 'scene'.format(name))
+                return
+            cs = self.state.diff(scene)
+            for k,args in cs:
+                self._apply(k, args)
+            if len(cs) > 0:
+                self._changed()
+        self.log.info('Recalling scene "{}": {} controls differ'.format(
+                      name, len(cs)))
+        with self.recall_cond:
+            for k,args in cs:
+                self.recall_pending[(args[0], k) + args[1:-1]] = (k, args)
+            if self.recall_thread is None:
+                self.recall_thread = threading.Thread(target=self.recall_run)
+                self.recall_thread.daemon = True
+                self.recall_thread.start()
+            self.recall_cond.notify()
+
+    def recall_run(self):
+        t_next = None
+        while True:
+            with self.recall_cond:
+                if len(self.recall_pending) == 0 and t_next is not None:
+                    duration = time.time() - t_start
+                    self.log.info('Recalled {} controls in {:.1f} '
+                                  'milliseconds'.format(n, 1000 * duration))
+                    t_next = None
+                while len(self.recall_pending) == 0:
+                    self.recall_cond.wait()
+                i = next(iter(self.recall_pending))[0]
+                keys = [key for key in self.recall_pending if key[0] == i]
+                cs = [self.recall_pending.pop(key) for key in keys]
+            if t_next is None:
+                t_start = t_next = time.time()
+                n = 0
+            self.dm.begin_batch(ignore=self.name)
+            try:
+                for k,args in cs:
+                    getattr(self.dm, k)(*args, ignore=self.name)
+            except Exception:
+                self.log.exception('Could not recall track {}'.format(i))
+            finally:
+                self.dm.end_batch(ignore=self.name)
+            n += len(cs)
+            t_next = self._pace(t_next, len(cs), self.scene_rate)
+
+    def vol(self, i, v):
+        self._set('vol', (i,), v)
+
+    def mute(self, i, v):
+        self._set('mute', (i,), v)
+
+    def solo(self, i, v):
+        self._set('solo', (i,), v)
+
+    def record(self, i, v):
+        self._set('record', (i,), v)
+
+    def pan(self, i, v):
+        self._set('pan', (i,), v)
 
     def send(self, i, j, v):
-        if i>=0 and i<=self.n_tracks and j==1 and type(v) == float:
-            self.state[i]['send'][0] = v
-        self.log.debug('State: \n{}\n'.format(str(self)))
+        self._set('send', (i, j), v)
+
+    def report(self, k, *args):
+        # What Ardour reports: while reconciling, this is the live state;
+        # otherwise it is a change like any other
+        self._set(k, args[:-1], args[-1], True)
+
+    def _set(self, k, key, v, reported=False):
+        # key is (i,) or, for sends, (i, j)
+        args = key + (v,)
+        if self.state.valid(*key) and type(v) == float:
+            with self.lock:
+                if self.live is not None:
+                    self._collect(k, args, reported)
+                if (self.live is None or not reported) and self._apply(k, args):
+                    self._changed()
+        else:
+            self.log.warning('Invalid arguments for method {}: {}'.format(
+                             k, ' '.join(str(a) for a in args)))
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('State: \n{}'.format(str(self)))
+
+    def _collect(self, k, args, reported=True):
+        # A value while reconciling; must be called with the lock held.
+        # Changes from a tablet went to Ardour as well, so Ardour has them
+        # now, but they do not keep reconciling waiting.
+        if k == 'send':
+            self.live.set_send(*args)
+        else:
+            self.live.set(k, *args)
+        self.live_keys.add((k,) + args[:-1])
+        if reported:
+            self.last_live = time.time()
+
+    def _apply(self, k, args):
+        # Sets one control, journaling the change; must be called with the
+        # lock held. Returns whether the value actually changed.
+        if k == 'send':
+            i,j,v = args
+            if not self.state.set_send(i, j, v):
+                return False
+        else:
+            i,v = args
+            j = 0
+            if not self.state.set(k, i, v):
+                return False
+        if self.journal is not None:
+            self.journal.append(i, self.param_codes[k], j, v)
+        return True
 
     def __str__(self):
-        s = ''
-        for i,t in enumerate(self.state):
-            ss = ['{}: {:.2f}'.format(k,v) for k,v in t.iteritems() if type(v) == float]
-            ss.append('send_1: {:.2f}'.format(t['send'][0]))
-            s += 'Track {}. '.format(i) + ' '.join(ss) + '\n'
-        return s[:-1]
+        return str(self.state)
@@ -0,0 +1,60 @@
+import logging
+from xml.etree import ElementTree
+
+# Ardour's OSC interface addresses the master bus by this remote control id
+MASTER_ID = 318
+DEFAULT_N_TRACKS = 12
+
+class RouteMap(object):
+    # Maps between Ardour remote control ids and our track indices: track 0 is
+    # the master bus, tracks 1 to n_tracks are Ardour's tracks ordered by
+    # their remote control ids. Both directions are plain indexed lookups.
+    def __init__(self, ids, master_id=MASTER_ID):
+        self.ids = [master_id] + list(ids)
+        self.indices = dict((rid, i) for i,rid in enumerate(self.ids))
+        self.n_tracks = len(self.ids) - 1
+
+    @classmethod
+    def default(cls, n_tracks=DEFAULT_N_TRACKS):
+        return cls(range(1, n_tracks+1))
+
+    @classmethod
+    def from_session_file(cls, session_file):
+        # Read the tracks from an Ardour session or template file; buses
+        # (other than the master bus) are not tracks
+        log = logging.getLogger(__name__)
+        try:
+            root = ElementTree.parse(session_file).getroot()
+        except (IOError, ElementTree.ParseError):
+            log.error('Could not read routes from Ardour session file '
+                      '"{}"'.format(session_file))
+            raise
+        ids = []
+        for r in root.iter('Route'):
+            is_track = (r.find('Diskstream') is not None or
+                        r.get('audio-playlist') is not None or
+                        r.get('midi-playlist') is not None)
+            rc = r.find('RemoteControl')
+            if is_track and rc is not None:
+                ids.append(int(rc.get('id')))
+        log.info('Read {} tracks from Ardour session file '
+                 '"{}"'.format(len(ids), session_file))
+        return cls(sorted(ids))
+
+    def to_ardour(self, i):
+        if i<0 or i>self.n_tracks:
+            return None
+        return self.ids[i]
+
+    def from_ardour(self, rid):
+        return self.indices.get(rid)
+
+    def chunks(self, n):
+        # All remote ids, n at a time
+        return [self.ids[k:k+n] for k in range(0, len(self.ids), n)]
+
+    def __eq__(self, other):
+        return isinstance(other, RouteMap) and self.ids == other.ids
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
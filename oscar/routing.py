@@ -0,0 +1,37 @@
+import logging
+
+class RouteTable(object):
+    # Maps OSC paths to routes, i.e. tuples of a handler and its arguments.
+    # The routes for all paths we know about are compiled up front; any other
+    # path is handed to the parse function once and the result is cached ---
+    # including None for paths that cannot be routed. The cache for parsed
+    # paths is bounded, so that a misbehaving client sending random paths
+    # cannot make it grow without limit.
+    def __init__(self, parse=None, max_parsed=1024):
+        self.log = logging.getLogger(__name__)
+        self.routes = {}
+        self.parse = parse
+        self.max_parsed = max_parsed
+        self.n_parsed = 0
+
+    def add(self, path, route):
+        self.routes[path] = route
+
+    def lookup(self, path):
+        try:
+            return self.routes[path]
+        except KeyError:
+            pass
+        route = None
+        if self.parse is not None:
+            route = self.parse(path)
+        if self.n_parsed < self.max_parsed:
+            self.routes[path] = route
+            self.n_parsed += 1
+        return route
+
+    def iteritems(self):
+        return ((p,r) for p,r in self.routes.iteritems() if r is not None)
+
+    def __len__(self):
+        return len(self.routes)
@@ -0,0 +1,140 @@
+import heapq
+import itertools
+import logging
+import threading
+from .metrics import monotonic
+
+class Timer(object):
+    # A scheduled call; cancelling it only marks it, the scheduler skips it
+    # when it comes due
+    __slots__ = ['t', 'f', 'args', 'cancelled']
+
+    def __init__(self, t, f, args):
+        self.t = t
+        self.f = f
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class Scheduler(object):
+    # Runs calls at given times on a dedicated thread, from a heap of timers,
+    # so that nothing that has to wait (pacing, delays between the steps of a
+    # macro) ever blocks the threads that receive and dispatch messages. The
+    # calls run one after the other and should be quick; whatever they send
+    # goes to the send queues. The thread is started on first use.
+    def __init__(self, name='scheduler'):
+        self.log = logging.getLogger(__name__)
+        self.name = name
+        # (time, sequence number, timer); the sequence number keeps timers
+        # that are due at the same time in order
+        self.heap = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.exit = False
+
+    def call_at(self, t, f, *args):
+        # t is in terms of metrics.monotonic()
+        timer = Timer(t, f, args)
+        with self.cond:
+            if self.exit:
+                timer.cancel()
+                return timer
+            heapq.heappush(self.heap, (t, next(self.counter), timer))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name=self.name)
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+        return timer
+
+    def call_later(self, delay, f, *args):
+        return self.call_at(monotonic() + delay, f, *args)
+
+    def run_sequence(self, steps, done=None):
+        s = Sequence(self, steps, done)
+        s.start()
+        return s
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if self.exit:
+                        return
+                    if len(self.heap) == 0:
+                        self.cond.wait()
+                        continue
+                    delay = self.heap[0][0] - monotonic()
+                    if delay > 0:
+                        self.cond.wait(delay)
+                        continue
+                    timer = heapq.heappop(self.heap)[2]
+                    break
+            if timer.cancelled:
+                continue
+            try:
+                timer.f(*timer.args)
+            except Exception:
+                self.log.exception('Scheduled call failed')
+
+    def stop(self):
+        # Drops whatever is still scheduled
+        with self.cond:
+            self.exit = True
+            for t,k,timer in self.heap:
+                timer.cancel()
+            self.heap = []
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+class Sequence(object):
+    # Steps run one after the other, each as (delay, f, args): f(*args) runs
+    # delay seconds after the previous step was due (so that the time the
+    # steps take does not add up). done() is called after the last step, but
+    # not when the sequence is cancelled.
+    def __init__(self, scheduler, steps, done=None):
+        self.log = logging.getLogger(__name__)
+        self.scheduler = scheduler
+        self.steps = list(steps)
+        self.done = done
+        self.index = 0
+        self.t = None
+        self.timer = None
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.t = monotonic()
+        self._schedule()
+
+    def _schedule(self):
+        with self.lock:
+            if self.cancelled:
+                return
+            if self.index < len(self.steps):
+                self.t += self.steps[self.index][0]
+                self.timer = self.scheduler.call_at(self.t, self._run)
+                return
+        if self.done is not None:
+            self.done()
+
+    def _run(self):
+        delay,f,args = self.steps[self.index]
+        self.index += 1
+        try:
+            f(*args)
+        finally:
+            self._schedule()
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            if self.timer is not None:
+                self.timer.cancel()
+
+    def finished(self):
+        return self.cancelled or self.index == len(self.steps)
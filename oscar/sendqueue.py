@@ -0,0 +1,148 @@
+import collections
+import logging
+import threading
+from .osc import osc_size
+
+# Keep bundles below the typical ethernet MTU, so that they do not get
+# fragmented on the way to the tablet
+MAX_DATAGRAM_SIZE = 1400
+
+class LatestQueue(object):
+    # A bounded FIFO with a single consumer that takes everything queued at
+    # once. Items with a key are values of continuous controls (the key says
+    # which control of which track); once the queue is full, the oldest of
+    # them that has a newer value queued is dropped. Items without a key
+    # (discrete commands) are never dropped and neither is the latest value
+    # of any control, so the queue can exceed maxsize, but only by the
+    # discrete items and one value per control.
+    def __init__(self, name, maxsize=256):
+        self.log = logging.getLogger(__name__)
+        self.name = name
+        self.maxsize = maxsize
+        self.items = collections.deque()
+        # key -> how many values for it are queued
+        self.keys = {}
+        self.cond = threading.Condition()
+        self.closed = False
+        self.n_dropped = 0
+        self.max_depth = 0
+
+    def put(self, item, key=None):
+        self.put_many([(item, key)])
+
+    def put_many(self, items):
+        # Queues [(item, key), ...] at once, i.e. the consumer either gets all
+        # of them in one go or none of them
+        with self.cond:
+            for item,key in items:
+                if len(self.items) >= self.maxsize:
+                    self._drop_superseded(key)
+                self.items.append((item, key))
+                if key is not None:
+                    self.keys[key] = self.keys.get(key, 0) + 1
+            self.max_depth = max(self.max_depth, len(self.items))
+            self.cond.notify()
+
+    def _drop_superseded(self, new_key):
+        # Only called when the queue is full, so the scan is rare
+        for n,(item,key) in enumerate(self.items):
+            if key is not None and (key == new_key or self.keys[key] > 1):
+                del self.items[n]
+                self.keys[key] -= 1
+                if self.keys[key] == 0:
+                    del self.keys[key]
+                self.n_dropped += 1
+                if self.n_dropped == 1 or self.n_dropped % 100 == 0:
+                    self.log.warning('Queue for {} is full, dropped {} old '
+                                     'values so far'.format(self.name,
+                                                           self.n_dropped))
+                return
+
+    def get_all(self):
+        # Blocks until there is something queued; returns all queued items,
+        # or None once the queue is closed and empty
+        with self.cond:
+            while len(self.items) == 0:
+                if self.closed:
+                    return None
+                self.cond.wait()
+            items = [item for item,key in self.items]
+            self.items.clear()
+            self.keys.clear()
+            return items
+
+    def depth(self):
+        return len(self.items)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+class SendQueue(object):
+    # The outbound messages for one destination, with their own worker
+    # thread, so that a slow or unreachable destination cannot hold up
+    # anybody else --- in particular not the thread that receives and
+    # dispatches inbound messages. The worker takes everything queued at once
+    # and sends it as OSC bundles of at most max_size bytes (or message by
+    # message, without bundle); transmit(address, messages) does the sending,
+    # of one message as such or of several as one bundle.
+    def __init__(self, address, transmit, name=None, maxsize=256, bundle=True,
+                 max_size=MAX_DATAGRAM_SIZE):
+        self.log = logging.getLogger(__name__)
+        self.address = address
+        self.transmit = transmit
+        self.name = name or address.url
+        self.bundle = bundle
+        self.max_size = max_size
+        self.queue = LatestQueue(self.name, maxsize)
+        self.n_sent = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put_many(self, items):
+        # [((path, args), key), ...]
+        self.queue.put_many(items)
+
+    @property
+    def n_dropped(self):
+        return self.queue.n_dropped
+
+    def depth(self):
+        return self.queue.depth()
+
+    def run(self):
+        while True:
+            ms = self.queue.get_all()
+            if ms is None:
+                break
+            try:
+                self.send(ms)
+            except Exception:
+                self.log.exception('Could not send to {}'.format(self.name))
+
+    def send(self, ms):
+        self.n_sent += len(ms)
+        if not self.bundle or len(ms) == 1:
+            for m in ms:
+                self.transmit(self.address, [m])
+            return
+        # 16 bytes for "#bundle" and the time tag; each element is prefixed
+        # with its size
+        bundle = []
+        size = 16
+        for path,args in ms:
+            n = 4 + osc_size(path, args)
+            if len(bundle) > 0 and size + n > self.max_size:
+                self.transmit(self.address, bundle)
+                bundle = []
+                size = 16
+            bundle.append((path, args))
+            size += n
+        self.transmit(self.address, bundle)
+
+    def close(self):
+        # Send what is queued, then stop the worker
+        self.queue.close()
+        self.thread.join()
@@ -1,33 +1,140 @@
-import liblo
+import collections
 import logging
-from .zeroconf import discover_touchosc
+import threading
+import time
+from .metrics import monotonic
+from .osc import Address, AddressError
+from .zeroconf import discover_touchosc, get_zeroconf, is_touchosc, OSC_SERVICE
+from .oscsender import OscSender
+from .routemap import DEFAULT_N_TRACKS
+from .routing import RouteTable
+from .valuecache import ValueCache
+
+class TouchOSCClient(object):
+    # One tablet running TouchOSC. Every client has its own send queue, so
+    # that a slow or unreachable tablet does not hold up the others. page is
+    # the page the tablet is currently showing, as far as we can tell from
+    # the messages it sends us; last_heard is when it last sent us something
+    # (or when Zeroconf told us about it).
+    def __init__(self, address, name=None, value_cache=True):
+        self.address = address
+        self.name = name
+        self.page = None
+        self.last_heard = monotonic() if name is not None else None
+        # What the tablet's controls show, by path
+        self.values = ValueCache(value_cache)
 
 class TouchOSC(object):
-    def __init__(self, dm, ip='zeroconf', port=9000):
+    def __init__(self, dm, ip='zeroconf', port=9000, bundle=True,
+                 page_filter=False, queue_size=256, metrics=None,
+                 value_cache=True, trace=None, resync_rate=200,
+                 resync_idle=60, capture=None, transport=None, match=None):
         self.log = logging.getLogger(__name__)
         self.name = 'touchosc'
-        self.c = None
+        self.sender = OscSender(bundle, metrics=metrics, name=self.name,
+                                trace=trace, key=self.continuous_key,
+                                queue_size=queue_size, capture=capture,
+                                transport=transport)
         self.dm = dm
         self.ip = ip
         self.port = port
         self.is_ready = False
+        # With Zeroconf we use all TouchOSC on the network (or those whose
+        # name contains match, e.g. the room they are in) and follow them as
+        # they come, go, or change their address
+        self.use_zeroconf = ip=='zeroconf'
+        self.match = match
+        self.listening = False
+
+        # All clients by (resolved) ip. client_list is replaced, never modified, so that
+        # it can be iterated over without holding the lock.
+        self.clients = {}
+        self.client_list = ()
+        self.clients_lock = threading.Lock()
+        self.queue_size = queue_size
+        # With the page filter, clients only get updates for the page they
+        # are showing; when they switch pages we replay the latest values for
+        # the new page.
+        self.page_filter = page_filter
+        self.value_cache = value_cache
+
+        # A tablet that shows up (Zeroconf announces it, or it sends us its
+        # first message), or that comes back after not sending anything for
+        # resync_idle seconds, may show anything; it gets resynced with the
+        # latest values: the page it is showing right away, the others from
+        # the resync thread at most resync_rate controls per second.
+        self.resync_rate = resync_rate
+        self.resync_idle = resync_idle
+        # client -> pages still to send
+        self.resync_pending = collections.OrderedDict()
+        self.resync_cond = threading.Condition()
+        self.resync_thread = None
 
-        self.n_tracks = 12
+        self.n_tracks = DEFAULT_N_TRACKS
         self.tracks_per_page = 4
-        self.pages = ['/oscar_page_1','/oscar_page_2','/oscar_page_3']
+        self.n_sends = 1
+        self.pages = self.make_pages(self.n_tracks)
+        self.track_controls = ['vol', 'mute', 'solo', 'rec', 'pan', 'remove']
+        # Track controls that have a value (as opposed to buttons that trigger
+        # an action), including sends
+        self.value_controls = ('vol', 'mute', 'solo', 'rec', 'pan', 'send')
+        self.global_controls = ['play', 'stop', 'recordglobal', 'rewind',
+                                'forward', 'addmarker', 'undo', 'redo',
+                                'removeglobal']
+        # Every page has buttons to recall and save n_scenes scenes, which are
+        # named after their number
+        self.n_scenes = 8
+        self.scene_controls = ['scene', 'savescene']
+        self.handlers = dict((c, getattr(self, 'on_' + c)) for c in
+                             self.track_controls + self.global_controls +
+                             self.scene_controls + ['send'])
+        self.compile_routes()
 
         # We manage the state ourselves, because we do not get feedback from
         # Ardour for play, stop, and recordglobal; obviously, this only
         # works as long as the user does not use the Ardour GUI
         self.state = {'playing': False, 'recording': False, 'removing': False}
 
-    def sendosc(self, pagenumber, path, *args):
-        if self.c is None:
-            return
-        if pagenumber is None:
-            return
-        page = self.pages[pagenumber]
-        liblo.send(self.c, page + path, *args)
+    def sendosc(self, path, *args):
+        self._send_page(None, path, args)
+
+    def _send_page(self, page, path, args, control=None, exclude=None):
+        # page is None for messages that concern all pages. Values of
+        # controls are only sent to clients that do not show them already.
+        # The latest values are kept by page, for replaying and resyncing.
+        if page is not None:
+            self.page_values[page][path] = (control, args)
+        for c in self.client_list:
+            if c is exclude:
+                continue
+            if (page is not None and self.page_filter and c.page is not None and
+                c.page != page):
+                continue
+            if control is not None and c.values.unchanged(control, path, args[0]):
+                continue
+            self.sender.send(c.address, path, *args)
+
+    def sendglobal(self, control, *args):
+        # Controls like play and stop are on every page
+        for path in self.global_paths[control]:
+            self.sendosc(path, *args)
+
+    def begin_batch(self):
+        self.sender.begin()
+
+    def end_batch(self):
+        self.sender.end()
+
+    def make_pages(self, n_tracks):
+        n = max(1, (n_tracks + self.tracks_per_page - 1) // self.tracks_per_page)
+        return ['/oscar_page_{}'.format(k) for k in range(1, n+1)]
+
+    def set_routes(self, routemap):
+        # Ardour told us how many tracks there are; the layout needs one page
+        # per tracks_per_page tracks
+        self.n_tracks = routemap.n_tracks
+        self.pages = self.make_pages(self.n_tracks)
+        self.compile_routes()
 
     def pagenumber(self, tracknumber):
         i = tracknumber
@@ -35,117 +142,416 @@ class TouchOSC(object):
             return None
         return (i-1) // self.tracks_per_page
 
-    def handle_osc(self, path, args):
+    def compile_routes(self):
+        # Inbound: every path of the layout (pages x tracks x controls) maps
+        # to a route (handler, track, send). Paths that are not part of the
+        # layout are parsed on first sight by parse_path.
+        self.routes = RouteTable(self.parse_path)
+        for k,page in enumerate(self.pages):
+            for control in self.global_controls:
+                self.routes.add('{}/{}'.format(page, control),
+                                (self.handlers[control], 0, 0, k, control))
+            for control in self.scene_controls:
+                for n in range(1, self.n_scenes+1):
+                    self.routes.add('{}/{}_{}'.format(page, control, n),
+                                    (self.handlers[control], n, 0, k, control))
+        for i in range(1, self.n_tracks+1):
+            k = self.pagenumber(i)
+            page = self.pages[k]
+            for control in self.track_controls:
+                self.routes.add('{}/{}_{}'.format(page, control, i),
+                                (self.handlers[control], i, 0, k, control))
+            for j in range(1, self.n_sends+1):
+                self.routes.add('{}/send_{}_{}'.format(page, i, j),
+                                (self.handlers['send'], i, j, k, 'send'))
+
+        # Outbound: the path and page for every control and track, so that
+        # sending does not have to format paths
+        self.paths = {}
+        for control in self.track_controls:
+            self.paths[control] = dict(
+                (i, ('{}/{}_{}'.format(self.pages[self.pagenumber(i)], control, i),
+                     self.pagenumber(i)))
+                for i in range(1, self.n_tracks+1))
+        self.paths['send'] = dict(
+            ((i,j), ('{}/send_{}_{}'.format(self.pages[self.pagenumber(i)], i, j),
+                     self.pagenumber(i)))
+            for i in range(1, self.n_tracks+1) for j in range(1, self.n_sends+1))
+        self.page_values = [{} for page in self.pages]
+        self.continuous_paths = frozenset(
+            p for control in ('vol', 'pan', 'send')
+            for p,page in self.paths[control].itervalues())
+        self.global_paths = dict(
+            (control, ['{}/{}'.format(page, control) for page in self.pages])
+            for control in self.global_controls)
+
+    def continuous_key(self, path, args):
+        # The path says which control of which track a value is for
+        if path in self.continuous_paths:
+            return path
+        return None
+
+    def inbound_key(self, route, path, args):
+        # Inbound values of continuous controls may be superseded by newer
+        # ones from the same tablet control
+        if route[4] in ('vol', 'pan', 'send'):
+            return path
+        return None
+
+    def parse_path(self, path):
         if not path.startswith('/oscar_page'):
-           return
+           return None
         segments = path.strip(' /').split('/')
         if len(segments) != 2:
-            return
+            return None
 
         subsegments = segments[1].split('_')
-        if len(subsegments) < 1:
-            return
         control = subsegments[0]
         try:
             control_args = [int(s) for s in subsegments[1:]]
         except ValueError:
-            return
+            return None
+        if not self.handlers.has_key(control):
+            return None
 
         i = 0
         j = 0
-        v = 0.0
         if len(control_args)>0:
             i = control_args[0]
         if len(control_args)>1:
             j = control_args[1]
+        page = None
+        if '/' + segments[0] in self.pages:
+            page = self.pages.index('/' + segments[0])
+        return (self.handlers[control], i, j, page, control)
+
+    def handle_osc(self, path, args, src=None):
+        route = self.routes.lookup(path)
+        if route is not None:
+            self.handle_route(route, args, src)
+
+    def handle_route(self, route, args, src=None):
+        f,i,j,page,control = route
+        v = 0.0
         if len(args) > 0:
             v = float(args[0])
+        if src is not None:
+            c,resync = self.client_seen(src.hostname, page)
+            if c is not None and control in self.value_controls:
+                self.client_changed(c, control, i, j, v)
+            # After taking note of the change, so that the resync does not
+            # send the tablet the value it just changed
+            if resync:
+                self.resync(c)
+        f(i, j, v)
+
+    def client_seen(self, ip, page):
+        # Every message tells us which page the sending tablet is showing; a
+        # tablet we do not know yet gets added as a client, assuming it listens
+        # on the configured port. Returns the client and whether it needs a
+        # resync.
+        c = self.clients.get(ip)
+        if c is None:
+            c = self.add_client(ip, self.port)
+            if c is None:
+                return None, False
+        t = monotonic()
+        resync = c.last_heard is None or t - c.last_heard > self.resync_idle
+        c.last_heard = t
+        if page is not None and page != c.page:
+            c.page = page
+            if self.page_filter and not resync:
+                self.replay_page(c, page)
+        return c, resync
+
+    def client_changed(self, c, control, i, j, v):
+        # The tablet shows the value it sent us; the other tablets get it from
+        # us, since Ardour's echo of it is not passed on
+        key = (i, j) if control == 'send' else i
+        p = self.paths[control].get(key)
+        if p is None:
+            return
+        c.values.seen(control, p[0], v)
+        self._send_page(p[1], p[0], (v,), control, c)
+
+    def replay_page(self, c, page):
+        # Returns how many values were sent
+        values = self.page_values[page].items()
+        self.sender.begin()
+        try:
+            for path,(control,args) in values:
+                self.sender.send(c.address, path, *args)
+                c.values.seen(control, path, args[0])
+        finally:
+            self.sender.end()
+        return len(values)
 
-        if control == 'vol':
+    def resync(self, c):
+        # Only ever sends to c; whatever c's value cache says it shows is
+        # forgotten, since that is what we do not know
+        self.log.info('Resyncing TouchOSC at {}'.format(c.address.url))
+        c.values.clear()
+        first = c.page if c.page is not None else 0
+        self.resync_page(c, first)
+        pages = [k for k in range(len(self.pages)) if k != first]
+        if len(pages) == 0:
+            return
+        with self.resync_cond:
+            self.resync_pending[c] = pages
+            if self.resync_thread is None:
+                self.resync_thread = threading.Thread(target=self.resync_run)
+                self.resync_thread.daemon = True
+                self.resync_thread.start()
+            self.resync_cond.notify()
+
+    def resync_page(self, c, page):
+        # The latest values on page, plus the transport state
+        self.sender.begin()
+        try:
+            n = self.replay_page(c, page)
+            for control,key in (('play', 'playing'),
+                                ('recordglobal', 'recording')):
+                self.sender.send(c.address,
+                                 '{}/{}'.format(self.pages[page], control),
+                                 float(self.state[key]))
+        finally:
+            self.sender.end()
+        return n + 2
+
+    def resync_run(self):
+        # One page at a time, round robin over the clients; a client's
+        # current page goes first, should it switch pages in the meantime
+        t_next = time.time()
+        while True:
+            with self.resync_cond:
+                while len(self.resync_pending) == 0:
+                    self.resync_cond.wait()
+                    t_next = time.time()
+                c,pages = self.resync_pending.popitem(last=False)
+                page = c.page if c.page in pages else pages[0]
+                pages.remove(page)
+                if len(pages) > 0:
+                    self.resync_pending[c] = pages
+            if c not in self.client_list:
+                continue
+            try:
+                n = self.resync_page(c, page)
+            except Exception:
+                self.log.exception('Could not resync TouchOSC at '
+                                   '{}'.format(c.address.url))
+                continue
+            t_next += float(n) / self.resync_rate
+            delay = t_next - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def on_vol(self, i, j, v):
+        if self.log.isEnabledFor(logging.DEBUG):
             self.log.debug('got {} {} {:.2f}'.format('gain', i, v))
-            self.dm.vol(i, v, ignore=self.name)
-        elif control == 'mute':
+        self.dm.vol(i, v, ignore=self.name)
+
+    def on_mute(self, i, j, v):
+        if self.log.isEnabledFor(logging.DEBUG):
             self.log.debug('got {} {} {}'.format('mute', i, v))
-            self.dm.mute(i, v, ignore=self.name)
-        elif control == 'solo':
+        self.dm.mute(i, v, ignore=self.name)
+
+    def on_solo(self, i, j, v):
+        if self.log.isEnabledFor(logging.DEBUG):
             self.log.debug('got {} {} {}'.format('solo', i, v))
-            self.dm.solo(i, v, ignore=self.name)
-        elif control == 'rec':
+        self.dm.solo(i, v, ignore=self.name)
+
+    def on_rec(self, i, j, v):
+        if self.log.isEnabledFor(logging.DEBUG):
             self.log.debug('got {} {} {}'.format('rec', i, v))
-            self.dm.record(i, v, ignore=self.name)
-        elif control == 'pan':
+        self.dm.record(i, v, ignore=self.name)
+
+    def on_pan(self, i, j, v):
+        if self.log.isEnabledFor(logging.DEBUG):
             self.log.debug('got {} {} {}'.format('pan', i, v))
-            self.dm.pan(i, v, ignore=self.name)
-        elif control == 'send':
+        self.dm.pan(i, v, ignore=self.name)
+
+    def on_send(self, i, j, v):
+        if self.log.isEnabledFor(logging.DEBUG):
             self.log.debug('got {} {} {} {:.2f}'.format('send', i, j, v))
-            self.dm.send(i, j, v, ignore=self.name)
-        elif control == 'play' and v == 1.0:
-            self.log.debug('got play')
-            self.dm.play(ignore=self.name)
-            self.state['playing'] = True
-            self.sendosc('/play', 1.0)
-        elif control == 'stop' and v == 1.0:
-            self.log.debug('got stop')
-            self.dm.stop(ignore=self.name)
-            self.state['playing'] = False
-            if self.state['recording']:
-                self.state['recording'] = False
-            self.sendosc('/play', 0.0)
-            self.sendosc('/recordglobal', float(self.state['recording']))
-        elif control == 'recordglobal' and v == 1.0:
-            self.log.debug('got recordglobal')
-            self.dm.recordglobal(ignore=self.name)
-            self.state['recording'] = not self.state['recording']
-            self.sendosc('/recordglobal', float(self.state['recording']))
-        elif control == 'rewind' and v == 1.0:
-            self.log.debug('got rewind')
-            self.dm.rewind(ignore=self.name)
-        elif control == 'forward' and v == 1.0:
-            self.log.debug('got forward')
-            self.dm.forward(ignore=self.name)
-        elif control == 'addmarker' and v == 1.0:
-            self.log.debug('got addmarker')
-            self.dm.addmarker(ignore=self.name)
-        elif control == 'undo' and v == 1.0:
-            self.log.debug('got undo')
-            self.dm.undo(ignore=self.name)
-        elif control == 'redo' and v == 1.0:
-            self.log.debug('got redo')
-            self.dm.redo(ignore=self.name)
-        elif control == 'removeglobal':
+        self.dm.send(i, j, v, ignore=self.name)
+
+    def on_play(self, i, j, v):
+        if v != 1.0:
+            return
+        self.log.debug('got play')
+        self.dm.play(ignore=self.name)
+        self.state['playing'] = True
+        self.sendglobal('play', 1.0)
+
+    def on_stop(self, i, j, v):
+        if v != 1.0:
+            return
+        self.log.debug('got stop')
+        self.dm.transport_stop(ignore=self.name)
+        self.state['playing'] = False
+        if self.state['recording']:
+            self.state['recording'] = False
+        self.sendglobal('play', 0.0)
+        self.sendglobal('recordglobal', float(self.state['recording']))
+
+    def on_recordglobal(self, i, j, v):
+        if v != 1.0:
+            return
+        self.log.debug('got recordglobal')
+        self.dm.recordglobal(ignore=self.name)
+        self.state['recording'] = not self.state['recording']
+        self.sendglobal('recordglobal', float(self.state['recording']))
+
+    def on_rewind(self, i, j, v):
+        if v != 1.0:
+            return
+        self.log.debug('got rewind')
+        self.dm.rewind(ignore=self.name)
+
+    def on_forward(self, i, j, v):
+        if v != 1.0:
+            return
+        self.log.debug('got forward')
+        self.dm.forward(ignore=self.name)
+
+    def on_addmarker(self, i, j, v):
+        if v != 1.0:
+            return
+        self.log.debug('got addmarker')
+        self.dm.addmarker(ignore=self.name)
+
+    def on_undo(self, i, j, v):
+        if v != 1.0:
+            return
+        self.log.debug('got undo')
+        self.dm.undo(ignore=self.name)
+
+    def on_redo(self, i, j, v):
+        if v != 1.0:
+            return
+        self.log.debug('got redo')
+        self.dm.redo(ignore=self.name)
+
+    def on_scene(self, i, j, v):
+        if v != 1.0:
+            return
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('got {} {}'.format('scene', i))
+        self.dm.recall_scene(str(i), ignore=self.name)
+
+    def on_savescene(self, i, j, v):
+        if v != 1.0:
+            return
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('got {} {}'.format('savescene', i))
+        self.dm.save_scene(str(i), ignore=self.name)
+
+    def on_removeglobal(self, i, j, v):
+        if self.log.isEnabledFor(logging.DEBUG):
             self.log.debug('got {} {}'.format('removeglobal', v))
-            if v == 1.0:
-                self.state['removing'] = True
-            elif v == 0.0:
-                self.state['removing'] = False
-        elif control == 'remove' and v == 1.0:
+        if v == 1.0:
+            self.state['removing'] = True
+        elif v == 0.0:
+            self.state['removing'] = False
+
+    def on_remove(self, i, j, v):
+        if v != 1.0:
+            return
+        if self.log.isEnabledFor(logging.DEBUG):
             self.log.debug('got {} {}'.format('remove', i))
-            if self.state['removing']:
-                self.dm.remove_all_regions_on_track(i)
+        if self.state['removing']:
+            self.dm.remove_all_regions_on_track(i)
 
-    def start(self):
+    def start(self, timeout=10):
         self.is_ready = False
-        if self.ip=='zeroconf':
-            ip_,port_ = discover_touchosc()
-            if ip_ is not None and port_ is not None:
-                self.ip = ip_
-                self.port = port_
-            else:
+        if self.use_zeroconf:
+            found = discover_touchosc(timeout, self.match)
+            if len(found) == 0:
                 self.log.error('Could not discover TouchOSC on the network '
                                'with Zeroconf. Please make sure TouchOSC is '
                                'running. Alternatively, explicitely provide '
                                'TouchOSC\'s IP address.')
                 return
-        try:
-            self.c = liblo.Address(self.ip, self.port)
-        except liblo.AddressError, e:
-            self.log.error('Could not connect to TouchOSC.')
+            for name,ip,port in found:
+                self.add_client(ip, port, name)
+            if not self.listening:
+                get_zeroconf().browse(OSC_SERVICE, self.service_changed)
+                self.listening = True
+        elif self.add_client(self.ip, self.port) is None:
             return
-        self.is_ready = True
+        self.is_ready = len(self.clients) > 0
 
     def stop(self):
         self.is_ready = False
-        self.c = None
+        if self.listening:
+            get_zeroconf().remove_listener(OSC_SERVICE, self.service_changed)
+            self.listening = False
+        for ip in self.clients.keys():
+            self.remove_client(ip)
+
+    def add_client(self, ip, port, name=None):
+        try:
+            address = Address(ip, port)
+        except AddressError, e:
+            self.log.error('Could not connect to TouchOSC at ip {} and port '
+                           '{}.'.format(ip, port))
+            return None
+        # Clients are known by the IP address their messages come from, also
+        # when we were given a host name
+        ip = address.sockaddr[0]
+        with self.clients_lock:
+            old = self.clients.get(ip)
+            if old is not None and old.address.url == address.url:
+                old.name = name or old.name
+                return old
+            c = TouchOSCClient(address, name, self.value_cache)
+            self.sender.add_queue(address, self.queue_size,
+                                  'TouchOSC at {}'.format(address.url))
+            self.clients[ip] = c
+            self.client_list = tuple(self.clients.values())
+        if old is not None:
+            self._close_client(old)
+        self.log.info('Sending to TouchOSC at ip {} and port {}'.format(ip, port))
+        return c
+
+    def remove_client(self, ip):
+        with self.clients_lock:
+            c = self.clients.pop(ip, None)
+            self.client_list = tuple(self.clients.values())
+        if c is not None:
+            self._close_client(c)
+            self.log.info('Stopped sending to TouchOSC at ip {}'.format(ip))
+
+    def _close_client(self, c):
+        self.sender.remove_queue(c.address)
+
+    def service_changed(self, name, endpoint):
+        # Called by Zeroconf when a service appears, changes or goes away
+        if not is_touchosc(name, self.match):
+            return
+        old = [ip for ip,c in self.clients.items() if c.name == name]
+        if endpoint is None:
+            for ip in old:
+                self.remove_client(ip)
+            return
+        ip,port = endpoint
+        for ip_ in old:
+            if ip_ != ip:
+                self.log.info('TouchOSC moved to ip {} and port {}'.format(ip, port))
+                self.remove_client(ip_)
+        c = self.add_client(ip, port, name)
+        if c is not None:
+            c.last_heard = monotonic()
+            self.resync(c)
+
+    def queue_depth(self):
+        return self.sender.queue_depth()
+
+    def n_dropped(self):
+        return self.sender.n_dropped()
+
+    def n_suppressed(self):
+        return sum(c.values.n_suppressed for c in self.client_list)
 
     def ready(self):
         # For TouchOSC, is_ready only says whether we managed to open the network
@@ -156,19 +562,35 @@ class TouchOSC(object):
         return self.is_ready
 
     def vol(self, i, v):
-        self.sendosc(self.pagenumber(i), '/vol_{}'.format(i), v)
+        self._send_track('vol', i, v)
 
     def mute(self, i, v):
-        self.sendosc(self.pagenumber(i), '/mute_{}'.format(i), v)
+        self._send_track('mute', i, v)
 
     def solo(self, i, v):
-        self.sendosc(self.pagenumber(i), '/solo_{}'.format(i), v)
+        self._send_track('solo', i, v)
 
     def record(self, i, v):
-        self.sendosc(self.pagenumber(i), '/rec_{}'.format(i), v)
+        self._send_track('rec', i, v)
 
     def pan(self, i, v):
-        self.sendosc(self.pagenumber(i), '/pan_{}'.format(i), v)
+        self._send_track('pan', i, v)
 
     def send(self, i, j, v):
-        self.sendosc(self.pagenumber(i), '/send_{}_{}'.format(i, j), v)
+        self._send_track('send', (i, j), v)
+
+    def sync_state(self, state):
+        # Bring the tablets up to date with state (a MixerState); with the
+        # value cache, only what a tablet does not show already is sent
+        self.sender.begin()
+        try:
+            for i in range(1, min(state.n_tracks, self.n_tracks)+1):
+                for k,args in state.controls(i):
+                    getattr(self, k)(*args)
+        finally:
+            self.sender.end()
+
+    def _send_track(self, control, key, v):
+        p = self.paths[control].get(key)
+        if p is not None:
+            self._send_page(p[1], p[0], (v,), control)
@@ -0,0 +1,106 @@
+import itertools
+import logging
+import struct
+import threading
+import time
+
+# One record: time, origin, path, number of arguments, their types, and up
+# to MAX_ARGS arguments as doubles. Origins, paths and string arguments are
+# stored as indices into a string table.
+MAX_ARGS = 4
+RECORD = struct.Struct('<dHHB{}s{}d'.format(MAX_ARGS, MAX_ARGS))
+
+class TraceBuffer(object):
+    # A fixed-size ring buffer of the most recent messages, in and out, kept
+    # in one preallocated bytearray. Recording packs one record in place and
+    # does not take a lock: every record gets its own slot from an atomic
+    # counter (so a dump taken while messages come in may contain a record
+    # that is only half written). The buffer can be dumped as text, on demand
+    # or on error, for post-mortem traces from production.
+    def __init__(self, size=4096, max_strings=4096):
+        self.log = logging.getLogger(__name__)
+        self.size = size
+        self.buf = bytearray(RECORD.size * size)
+        self.counter = itertools.count()
+        # The next slot to be written, for dumping in order
+        self.n = 0
+        self.max_strings = max_strings
+        self.strings = ['?']
+        self.string_ids = {'?': 0}
+        self.strings_lock = threading.Lock()
+
+    def string_id(self, s):
+        try:
+            return self.string_ids[s]
+        except KeyError:
+            pass
+        with self.strings_lock:
+            k = self.string_ids.get(s)
+            if k is None:
+                if len(self.strings) >= self.max_strings:
+                    return 0
+                k = len(self.strings)
+                self.strings.append(s)
+                self.string_ids[s] = k
+            return k
+
+    def record(self, origin, path, args):
+        n = next(self.counter)
+        types = []
+        values = [0.0] * MAX_ARGS
+        for k,a in enumerate(args[:MAX_ARGS]):
+            if isinstance(a, basestring):
+                types.append('s')
+                values[k] = self.string_id(a)
+            elif isinstance(a, float):
+                types.append('f')
+                values[k] = a
+            elif isinstance(a, (int, long)):
+                types.append('i')
+                values[k] = a
+            else:
+                types.append('s')
+                values[k] = self.string_id(repr(a))
+        RECORD.pack_into(self.buf, (n % self.size) * RECORD.size, time.time(),
+                         self.string_id(origin), self.string_id(path),
+                         len(args), ''.join(types), *values)
+        self.n = n + 1
+
+    def records(self):
+        # The recorded messages, oldest first, as (time, origin, path, args);
+        # arguments beyond MAX_ARGS are not kept
+        n = self.n
+        rs = []
+        for m in range(max(0, n - self.size), n):
+            t,origin,path,nargs,types,values = self._unpack(m % self.size)
+            args = []
+            for k,c in enumerate(types[:min(nargs, MAX_ARGS)]):
+                if c == 's':
+                    args.append(self.strings[int(values[k])])
+                elif c == 'i':
+                    args.append(int(values[k]))
+                else:
+                    args.append(values[k])
+            rs.append((t, self.strings[origin], self.strings[path], args))
+        return rs
+
+    def _unpack(self, slot):
+        fs = RECORD.unpack_from(self.buf, slot * RECORD.size)
+        return fs[0], fs[1], fs[2], fs[3], fs[4], fs[5:]
+
+    def dump(self, f):
+        # One line per message: time, origin, path and arguments
+        for t,origin,path,args in self.records():
+            f.write('{:.6f} {} {} {}\n'.format(
+                t, origin, path, ' '.join(repr(a) for a in args)))
+
+    def dump_to_file(self, filename):
+        try:
+            with open(filename, 'w') as f:
+                self.dump(f)
+        except IOError:
+            self.log.exception('Could not write trace to file '
+                               '"{}"'.format(filename))
+            return
+        self.log.info('Wrote trace of the last {} messages to file '
+                      '"{}"'.format(min(self.n, self.size), filename))
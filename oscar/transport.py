@@ -0,0 +1,224 @@
+import errno
+import inspect
+import logging
+import select
+import socket
+import threading
+from .osc import Address, Encoder, decode, DecodeError
+
+# How messages get in and out. A transport receives on one UDP port and
+# dispatches every message to the methods registered with add_method(path,
+# types, f, user_data): like with liblo, a method matches if its path and
+# type tags are None or equal to the message's, the matching methods are
+# called in the order they were added with as many of (path, args, types,
+# src, user_data) as they take, and a method that returns a true value
+# passes the message on to the next matching one. send(address, messages)
+# sends one message as such and several as one bundle; it may be called from
+# any thread.
+#
+# There are two: liblo (the default), and udp, which does everything in
+# Python on a plain socket, so that we can set the socket buffer sizes and
+# send from the port we receive on. Both take the port to receive on (None
+# for a transport that only sends) and the socket receive and send buffer
+# sizes in bytes (0 for the system default).
+TRANSPORTS = ('liblo', 'udp')
+
+def make_transport(name='liblo', port=None, rcvbuf=0, sndbuf=0):
+    if name == 'liblo':
+        return LibloTransport(port, rcvbuf, sndbuf)
+    if name == 'udp':
+        return UdpTransport(port, rcvbuf, sndbuf)
+    raise ValueError('Invalid transport "{}"'.format(name))
+
+def _set_buffer_sizes(sock, rcvbuf, sndbuf, log):
+    # The kernel may cap (Linux: net.core.rmem_max and wmem_max) or double
+    # what we ask for, so log what we got
+    for opt,size,name in ((socket.SO_RCVBUF, rcvbuf, 'receive'),
+                          (socket.SO_SNDBUF, sndbuf, 'send')):
+        if size > 0:
+            sock.setsockopt(socket.SOL_SOCKET, opt, size)
+            log.info('Socket {} buffer: asked for {} bytes, got {}'.format(
+                     name, size, sock.getsockopt(socket.SOL_SOCKET, opt)))
+
+class LibloTransport(object):
+    # Receives on a liblo.ServerThread and sends with liblo.send, i.e. from a
+    # socket of liblo's rather than from the port we receive on. The receive
+    # buffer size is set on the server's socket; liblo does not let us set
+    # the send buffer size.
+    name = 'liblo'
+
+    def __init__(self, port=None, rcvbuf=0, sndbuf=0):
+        import liblo
+        self.liblo = liblo
+        self.log = logging.getLogger(__name__)
+        self.server = None
+        self.port = None
+        if port is not None:
+            self.server = liblo.ServerThread(port)
+            self.port = self.server.get_port()
+            if rcvbuf > 0:
+                # fromfd() duplicates the descriptor, the socket is the same
+                sock = socket.fromfd(self.server.fileno(), socket.AF_INET,
+                                     socket.SOCK_DGRAM)
+                _set_buffer_sizes(sock, rcvbuf, 0, self.log)
+                sock.close()
+        if sndbuf > 0:
+            self.log.warning('The liblo transport cannot set the socket send '
+                             'buffer size')
+        # url -> liblo.Address
+        self.addresses = {}
+
+    def add_method(self, path, types, f, user_data=None):
+        self.server.add_method(path, types, f, user_data)
+
+    def start(self):
+        self.server.start()
+
+    def stop(self):
+        self.server.stop()
+
+    def free(self):
+        if self.server is not None:
+            self.server.free()
+
+    def _address(self, address):
+        if isinstance(address, self.liblo.Address):
+            return address
+        a = self.addresses.get(address.url)
+        if a is None:
+            a = self.addresses[address.url] = self.liblo.Address(
+                address.hostname, address.port)
+        return a
+
+    def send(self, address, messages):
+        Message = self.liblo.Message
+        if len(messages) == 1:
+            path,args = messages[0]
+            packet = Message(path, *args)
+        else:
+            packet = self.liblo.Bundle(*[Message(path, *args)
+                                         for path,args in messages])
+        self.liblo.send(self._address(address), packet)
+
+class UdpTransport(object):
+    # One UDP socket for both directions. A thread waits for datagrams with
+    # select(), receives them into a buffer allocated once and dispatches the
+    # decoded messages; every sending thread encodes into an encoder (and its
+    # buffer) of its own. Messages are matched to methods by a dict lookup of
+    # the path, plus the methods registered for any path.
+    name = 'udp'
+
+    def __init__(self, port=None, rcvbuf=0, sndbuf=0, max_size=65536,
+                 poll_interval=0.1):
+        self.log = logging.getLogger(__name__)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        _set_buffer_sizes(self.sock, rcvbuf, sndbuf, self.log)
+        self.sock.bind(('', int(port or 0)))
+        self.port = self.sock.getsockname()[1]
+        self.buf = bytearray(max_size)
+        self.poll_interval = poll_interval
+        # path -> [(n, types, f, user_data, n_args), ...], and the same for
+        # the methods for any path; n is the order in which they were added
+        self.methods = {}
+        self.any_path = []
+        self.n_methods = 0
+        self.local = threading.local()
+        # sockaddr -> Address of the sources we heard from
+        self.sources = {}
+        self.thread = None
+        self.exit = threading.Event()
+        self.n_invalid = 0
+
+    def add_method(self, path, types, f, user_data=None):
+        # Callbacks get as many arguments as they take, like with pyliblo
+        try:
+            spec = inspect.getargspec(f)
+            n_args = len(spec.args) - (1 if inspect.ismethod(f) else 0)
+            if spec.varargs is not None:
+                n_args = 5
+        except TypeError:
+            n_args = 5
+        m = (self.n_methods, types, f, user_data, n_args)
+        self.n_methods += 1
+        if path is None:
+            self.any_path.append(m)
+        else:
+            self.methods.setdefault(path, []).append(m)
+
+    def start(self):
+        self.exit.clear()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.exit.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def free(self):
+        self.sock.close()
+
+    def run(self):
+        # The socket does not block: once select() says there is something,
+        # take everything there is before waiting again
+        self.sock.setblocking(False)
+        while not self.exit.is_set():
+            try:
+                r,w,x = select.select([self.sock], [], [], self.poll_interval)
+                while r:
+                    n,sockaddr = self.sock.recvfrom_into(self.buf)
+                    self.receive(n, sockaddr)
+            except (select.error, socket.error), e:
+                # A refused earlier send may show up here
+                if e.args[0] not in (errno.EINTR, errno.EAGAIN,
+                                     errno.EWOULDBLOCK, errno.ECONNREFUSED):
+                    self.log.error('Receiving failed: {}'.format(e))
+
+    def receive(self, n, sockaddr):
+        src = self.sources.get(sockaddr)
+        if src is None:
+            if len(self.sources) >= 1024:
+                self.sources.clear()
+            src = self.sources[sockaddr] = Address(*sockaddr)
+        try:
+            messages = decode(self.buf, 0, n)
+        except DecodeError, e:
+            self.n_invalid += 1
+            self.log.warning('Ignoring invalid packet from {}: {}'.format(
+                             src.url, e))
+            return
+        for path,types,args in messages:
+            self.dispatch(path, types, args, src)
+
+    def dispatch(self, path, types, args, src):
+        ms = self.methods.get(path)
+        if ms is None:
+            ms = self.any_path
+        elif len(self.any_path) > 0:
+            ms = sorted(ms + self.any_path)
+        for n,t,f,user_data,n_args in ms:
+            if t is not None and t != types:
+                continue
+            try:
+                r = f(*(path, args, types, src, user_data)[:n_args])
+            except Exception:
+                self.log.exception('Handling message "{}" failed'.format(path))
+                return
+            if not r:
+                return
+
+    def encoder(self):
+        e = getattr(self.local, 'encoder', None)
+        if e is None:
+            e = self.local.encoder = Encoder()
+        return e
+
+    def send(self, address, messages):
+        if len(messages) == 1:
+            path,args = messages[0]
+            data = self.encoder().message(path, args)
+        else:
+            data = self.encoder().bundle(messages)
+        self.sock.sendto(data, address.sockaddr)
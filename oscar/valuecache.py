@@ -0,0 +1,89 @@
+import logging
+import threading
+from .metrics import monotonic
+
+class ValueCache(object):
+    # The value every control of every track has on one destination, as far
+    # as we know: either because we sent it or because the destination told
+    # us. Sends that would not change the destination (within the epsilon of
+    # the control) are dropped.
+    #
+    # For destinations that echo what we send (Ardour does, as feedback), the
+    # values we sent for the echo_controls are also kept for echo_window
+    # seconds, so that the echoes can be recognized and dropped, too ---
+    # including late echoes of values that are already stale. Keys are
+    # whatever identifies a track (or track and send) for the destination.
+    epsilons = {'vol': 1e-4, 'pan': 1e-3, 'send': 1e-4}
+
+    def __init__(self, enabled=True, epsilons=None, echo_controls=(),
+                 echo_window=1.0, max_pending=64):
+        self.log = logging.getLogger(__name__)
+        self.enabled = enabled
+        if epsilons is not None:
+            self.epsilons = dict(self.epsilons, **epsilons)
+        self.echo_controls = frozenset(echo_controls)
+        self.echo_window = echo_window
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        # (control, key) -> value
+        self.values = {}
+        # (control, key) -> [(time, value), ...] sent, but not echoed yet
+        self.pending = {}
+        self.n_suppressed = 0
+        self.n_echoes = 0
+
+    def unchanged(self, control, key, v):
+        # Whether sending v would not change the destination; if it would,
+        # v is remembered as sent
+        if not self.enabled:
+            return False
+        k = (control, key)
+        with self.lock:
+            old = self.values.get(k)
+            if old is not None and abs(old - v) <= self.epsilons.get(control, 0.0):
+                self.n_suppressed += 1
+                return True
+            self.values[k] = v
+            if control in self.echo_controls:
+                t = monotonic()
+                pending = self.pending.setdefault(k, [])
+                while len(pending) > 0 and (t - pending[0][0] > self.echo_window or
+                                            len(pending) >= self.max_pending):
+                    del pending[0]
+                pending.append((t, v))
+        return False
+
+    def seen(self, control, key, v):
+        # The destination told us it has v
+        if self.enabled:
+            with self.lock:
+                self.values[(control, key)] = v
+
+    def echo(self, control, key, v):
+        # Whether v is the destination echoing one of the values we sent in
+        # the last echo_window seconds. Echoes come in the order we sent the
+        # values, so the matching value and everything before it are done
+        # with; a value that does not match means the destination moved on by
+        # itself.
+        if not self.enabled:
+            return False
+        k = (control, key)
+        with self.lock:
+            pending = self.pending.get(k)
+            if not pending:
+                return False
+            t = monotonic()
+            eps = self.epsilons.get(control, 0.0)
+            for n,(t_sent,v_sent) in enumerate(pending):
+                if t - t_sent <= self.echo_window and abs(v_sent - v) <= eps:
+                    del pending[:n+1]
+                    self.n_echoes += 1
+                    return True
+            del pending[:]
+        return False
+
+    def clear(self):
+        # Forget everything, e.g. when the destination restarted
+        with self.lock:
+            self.values = {}
+            self.pending = {}
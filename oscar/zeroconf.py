@@ -1,75 +1,545 @@
 import logging
-import subprocess
+import select
+import socket
+import struct
+import threading
 import time
 
-def discover_touchosc():
-    log = logging.getLogger(__name__)
+# A small in-process mDNS / DNS-SD implementation (RFC 6762 and 6763): enough
+# to browse for and resolve OSC services on the local network and to publish
+# our own service, without running avahi-browse or avahi-publish.
+
+OSC_SERVICE = '_osc._udp.local.'
+SERVICES = '_services._dns-sd._udp.local.'
+MDNS_GROUP = '224.0.0.251'
+MDNS_PORT = 5353
+
+_TYPE_A = 1
+_TYPE_PTR = 12
+_TYPE_TXT = 16
+_TYPE_SRV = 33
+_TYPE_ANY = 255
+_CLASS_IN = 1
+_CLASS_UNIQUE = 0x8000
+_FLAGS_RESPONSE = 0x8400
+
+# Recommended TTLs for shared (PTR) and host related (SRV, TXT, A) records
+_TTL_SHARED = 4500
+_TTL_HOST = 120
+
+def _encode_name(name):
+    s = ''
+    for label in name.rstrip('.').split('.'):
+        s += chr(len(label)) + label
+    return s + '\0'
+
+def _read_name(data, offset):
+    # Returns the name starting at offset and the offset right after it;
+    # follows compression pointers
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        n = ord(data[offset])
+        if n & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            offset = ((n & 0x3F) << 8) | ord(data[offset+1])
+            jumps += 1
+            if jumps > 32:
+                raise ValueError('Name compression loop')
+            continue
+        offset += 1
+        if n == 0:
+            break
+        labels.append(data[offset:offset+n])
+        offset += n
+    if end is None:
+        end = offset
+    return '.'.join(labels) + '.', end
+
+def _encode_rdata(rtype, value):
+    if rtype == _TYPE_A:
+        return socket.inet_aton(value)
+    elif rtype == _TYPE_PTR:
+        return _encode_name(value)
+    elif rtype == _TYPE_SRV:
+        target,port = value
+        return struct.pack('!HHH', 0, 0, port) + _encode_name(target)
+    elif rtype == _TYPE_TXT:
+        return value or '\0'
+    raise ValueError('Unsupported record type {}'.format(rtype))
+
+def make_packet(flags, questions=(), answers=(), additionals=(), id_=0):
+    # questions are (name, type) pairs; answers and additionals are records,
+    # i.e. (name, type, ttl, value) tuples
+    s = struct.pack('!6H', id_, flags, len(questions), len(answers), 0,
+                    len(additionals))
+    for name,qtype in questions:
+        s += _encode_name(name) + struct.pack('!HH', qtype, _CLASS_IN)
+    for name,rtype,ttl,value in list(answers) + list(additionals):
+        rdata = _encode_rdata(rtype, value)
+        rclass = _CLASS_IN
+        if rtype != _TYPE_PTR:
+            rclass |= _CLASS_UNIQUE
+        s += _encode_name(name)
+        s += struct.pack('!HHIH', rtype, rclass, ttl, len(rdata)) + rdata
+    return s
+
+def parse_packet(data):
+    # Returns (id, flags, questions, records); records of types we do not
+    # care about are skipped. Raises ValueError for malformed packets.
+    try:
+        id_,flags,qd,an,ns,ar = struct.unpack('!6H', data[:12])
+        offset = 12
+        questions = []
+        for k in range(qd):
+            name,offset = _read_name(data, offset)
+            qtype,qclass = struct.unpack('!HH', data[offset:offset+4])
+            offset += 4
+            questions.append((name, qtype))
+        records = []
+        for k in range(an + ns + ar):
+            name,offset = _read_name(data, offset)
+            rtype,rclass,ttl,rdlength = struct.unpack('!HHIH',
+                                                      data[offset:offset+10])
+            offset += 10
+            rdata = offset
+            offset += rdlength
+            if offset > len(data):
+                raise ValueError('Truncated record')
+            if rtype == _TYPE_A and rdlength == 4:
+                value = socket.inet_ntoa(data[rdata:rdata+4])
+            elif rtype == _TYPE_PTR:
+                value = _read_name(data, rdata)[0]
+            elif rtype == _TYPE_SRV:
+                port, = struct.unpack('!H', data[rdata+4:rdata+6])
+                value = (_read_name(data, rdata+6)[0], port)
+            elif rtype == _TYPE_TXT:
+                value = data[rdata:offset]
+            else:
+                continue
+            records.append((name, rtype, ttl, value))
+    except (IndexError, struct.error), e:
+        raise ValueError('Malformed packet: {}'.format(e))
+    return id_, flags, questions, records
+
+def _local_ip(group, port):
+    # The address of the interface we would use to reach the mDNS group
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
-        p = subprocess.Popen(['avahi-browse',
-                              '--ignore-local',
-                              '--parsable',
-                              '--resolve',
-                              '--terminate',
-                              '_osc._udp'],
-                             stdout=subprocess.PIPE)
-    except OSError:
-        log.warning('Could not execute avahi-browse: is it installed?')
-        return (None,None)
-
-    timeout = 10
-    t = 0
-    while p.poll() is None:
-        time.sleep(1)
-        t += 1
-        log.debug('Waiting for avahi-browse to finish')
-        if t>timeout:
-            log.warning('avahi-browse did not terminate within {} seconds: '
-                        'aborting'.format(timeout))
-            p.terminate()
-            p.wait()
-            return (None,None)
-    if p.poll() != 0:
-        log.warning('avahi-browse returned a non-zero exit code: aborting')
-        return (None,None)
-
-    stdout,stderr = p.communicate()
-    fs = [s.split(';') for s in stdout.splitlines()]
-    fs = filter(lambda l: l[0]=='=' and l[2]=='IPv4' and l[4]=='_osc._udp' and
-                       l[3].count('TouchOSC')==1, fs)
-    # f[7] and f[8] are ip and port
-    rs = [(f[7],f[8]) for f in fs]
+        s.connect((group, port))
+        return s.getsockname()[0]
+    except socket.error:
+        return '127.0.0.1'
+    finally:
+        s.close()
+
+class Service(object):
+    # A discovered service instance; ip and port are None until the instance
+    # has been resolved
+    def __init__(self, name, service_type):
+        self.name = name
+        self.service_type = service_type
+        self.host = None
+        self.port = None
+        self.source = None
+        self.expires = 0.0
+        self.endpoint = None
+        self.last_query = 0.0
+
+    def label(self):
+        # The instance label, e.g. "TouchOSC Bridge" for
+        # "TouchOSC Bridge._osc._udp.local."
+        return self.name[:-len(self.service_type)-1]
+
+class Zeroconf(object):
+    # Browses for and publishes DNS-SD services via multicast DNS. A single
+    # background thread receives packets, answers queries for our own
+    # services, maintains a live table of the browsed services and re-queries
+    # with exponential backoff. Listeners get called (on that thread) with
+    # the service name and its (ip, port) whenever an endpoint appears or
+    # changes, and with None when it goes away.
+    def __init__(self, group=MDNS_GROUP, port=MDNS_PORT, interface='0.0.0.0'):
+        self.log = logging.getLogger(__name__)
+        self.group = group
+        self.port = port
+        self.interface = interface
+        self.host = socket.gethostname().split('.')[0] + '.local.'
+        self.ip = None
+        self.socket = None
+        self.thread = None
+        self.exit = threading.Event()
+        # All state is protected by cond; waiting on it wakes up on changes
+        self.cond = threading.Condition()
+        # service type -> {name: Service}
+        self.services = {}
+        # service type -> [listener, ...]
+        self.listeners = {}
+        # service type -> (time of next query, current query interval)
+        self.queries = {}
+        # host name -> (ip, expiry time)
+        self.hosts = {}
+        # name -> (service type, port, time of next announcement, announcements left)
+        self.registered = {}
+
+    def start(self):
+        if self.thread is not None:
+            return True
+        try:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, 'SO_REUSEPORT'):
+                try:
+                    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                except socket.error:
+                    pass
+            s.bind(('', self.port))
+            s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                         socket.inet_aton(self.group) +
+                         socket.inet_aton(self.interface))
+            s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 255)
+            s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            if self.interface != '0.0.0.0':
+                s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                             socket.inet_aton(self.interface))
+                self.ip = self.interface
+            else:
+                self.ip = _local_ip(self.group, self.port)
+        except socket.error, e:
+            self.log.warning('Could not open the mDNS socket: {}'.format(e))
+            return False
+        self.socket = s
+        self.exit.clear()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+
+    def close(self):
+        if self.thread is None:
+            return
+        for name in self.registered.keys():
+            self.unregister(name)
+        self.exit.set()
+        self.thread.join()
+        self.thread = None
+        self.socket.close()
+        self.socket = None
+
+    def browse(self, service_type, listener=None):
+        # Start browsing for service_type (if we are not already) and return
+        # the services known so far, as {name: (ip, port)}
+        service_type = service_type.lower()
+        with self.cond:
+            new = not self.services.has_key(service_type)
+            if new:
+                self.services[service_type] = {}
+                self.listeners[service_type] = []
+                self.queries[service_type] = (0.0, 1.0)
+            if listener is not None:
+                self.listeners[service_type].append(listener)
+            endpoints = self.endpoints(service_type)
+        if new and self.thread is not None:
+            # Query right away instead of on the next tick
+            self._tick()
+        return endpoints
+
+    def remove_listener(self, service_type, listener):
+        service_type = service_type.lower()
+        with self.cond:
+            if listener in self.listeners.get(service_type, []):
+                self.listeners[service_type].remove(listener)
+
+    def endpoints(self, service_type):
+        with self.cond:
+            return dict((s.name, s.endpoint) for s in
+                        self.services.get(service_type.lower(), {}).itervalues()
+                        if s.endpoint is not None)
+
+    def wait_for(self, service_type, match, timeout):
+        # Return the endpoints of service_type whose instance label matches,
+        # waiting at most timeout seconds for the first one to show up. If we
+        # know about matching services already, this returns right away.
+        service_type = service_type.lower()
+        self.browse(service_type)
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                found = [(s.name, s.endpoint) for s in
+                         self.services[service_type].itervalues()
+                         if s.endpoint is not None and match(s.label())]
+                remaining = deadline - time.time()
+                if len(found) > 0 or remaining <= 0:
+                    return sorted(found)
+                self.cond.wait(remaining)
+
+    def register(self, label, service_type, port):
+        name = '{}.{}'.format(label, service_type)
+        with self.cond:
+            self.registered[name] = (service_type, port, 0.0, 2)
+        if self.thread is not None:
+            # Announce right away instead of on the next tick
+            self._tick()
+        return name
+
+    def unregister(self, name):
+        with self.cond:
+            r = self.registered.pop(name, None)
+        if r is not None:
+            # Send a goodbye, i.e. our records with a TTL of 0
+            service_type,port = r[:2]
+            answers = [(n, t, 0, v) for n,t,ttl,v in
+                       self._service_records(name, service_type, port)]
+            self._send(make_packet(_FLAGS_RESPONSE, answers=answers))
+
+    def run(self):
+        while not self.exit.is_set():
+            timeout = max(0.0, min(self._tick() - time.time(), 0.5))
+            try:
+                r,w,x = select.select([self.socket], [], [], timeout)
+            except select.error:
+                continue
+            if len(r) == 0:
+                continue
+            try:
+                data,address = self.socket.recvfrom(9000)
+            except socket.error:
+                continue
+            try:
+                id_,flags,questions,records = parse_packet(data)
+            except ValueError, e:
+                self.log.debug('Ignoring mDNS packet from {}: {}'.format(address[0], e))
+                continue
+            if flags & 0x8000:
+                self._handle_response(records, address)
+            else:
+                self._handle_query(id_, questions, address)
+
+    def _send(self, packet, address=None):
+        if self.socket is None:
+            return
+        if address is None:
+            address = (self.group, self.port)
+        try:
+            self.socket.sendto(packet, address)
+        except socket.error, e:
+            self.log.debug('Could not send mDNS packet: {}'.format(e))
+
+    def _tick(self):
+        # Send due queries and announcements and expire stale records; returns
+        # the time at which we want to be called again
+        t = time.time()
+        t_next = t + 1.0
+        questions = []
+        announce = []
+        notify = []
+        with self.cond:
+            for service_type,(t_query,interval) in self.queries.items():
+                if t >= t_query:
+                    questions.append((service_type, _TYPE_PTR))
+                    t_query = t + interval
+                    self.queries[service_type] = (t_query, min(2*interval, 60.0))
+                t_next = min(t_next, t_query)
+            for name,(service_type,port,t_announce,n) in self.registered.items():
+                if n > 0 and t >= t_announce:
+                    announce.append((name, service_type, port))
+                    self.registered[name] = (service_type, port, t + 1.0, n - 1)
+            for service_type,services in self.services.iteritems():
+                for name,s in services.items():
+                    if s.expires < t:
+                        del services[name]
+                        if s.endpoint is not None:
+                            notify.append((service_type, s.name, None))
+                    elif s.endpoint is None and t - s.last_query > 1.0:
+                        # Ask for whatever is still missing to resolve it
+                        s.last_query = t
+                        questions.append((s.name, _TYPE_SRV))
+                        if s.host is not None:
+                            questions.append((s.host, _TYPE_A))
+            for host,(ip,expires) in self.hosts.items():
+                if expires < t:
+                    del self.hosts[host]
+            if len(notify) > 0:
+                self.cond.notify_all()
+        if len(questions) > 0:
+            self._send(make_packet(0, questions=questions))
+        for name,service_type,port in announce:
+            self._send(make_packet(_FLAGS_RESPONSE,
+                answers=self._service_records(name, service_type, port)))
+        self._notify(notify)
+        return t_next
+
+    def _service_records(self, name, service_type, port):
+        return [(service_type, _TYPE_PTR, _TTL_SHARED, name),
+                (name, _TYPE_SRV, _TTL_HOST, (self.host, int(port))),
+                (name, _TYPE_TXT, _TTL_SHARED, ''),
+                (self.host, _TYPE_A, _TTL_HOST, self.ip)]
+
+    def _handle_query(self, id_, questions, address):
+        answers = []
+        with self.cond:
+            registered = self.registered.items()
+        for qname,qtype in questions:
+            qname = qname.lower()
+            for name,(service_type,port,t,n) in registered:
+                rs = self._service_records(name, service_type, port)
+                if qname == SERVICES.lower() and qtype in (_TYPE_PTR, _TYPE_ANY):
+                    answers.append((SERVICES, _TYPE_PTR, _TTL_SHARED, service_type))
+                elif qname == service_type.lower() and qtype in (_TYPE_PTR, _TYPE_ANY):
+                    answers += rs
+                elif qname == name.lower() and qtype in (_TYPE_SRV, _TYPE_TXT, _TYPE_ANY):
+                    answers += rs[1:]
+                elif qname == self.host.lower() and qtype in (_TYPE_A, _TYPE_ANY):
+                    answers.append(rs[3])
+        if len(answers) == 0:
+            return
+        answers = list(set(answers))
+        if address[1] != self.port:
+            # Legacy unicast query (RFC 6762, section 6.7): reply directly,
+            # echoing the query id and questions
+            self._send(make_packet(_FLAGS_RESPONSE, questions=questions,
+                                   answers=answers, id_=id_), address)
+        else:
+            self._send(make_packet(_FLAGS_RESPONSE, answers=answers))
+
+    def _handle_response(self, records, address):
+        t = time.time()
+        notify = []
+        with self.cond:
+            # Host addresses first, so that services resolve in one go
+            for name,rtype,ttl,value in records:
+                if rtype == _TYPE_A:
+                    self.hosts[name.lower()] = (value, t + ttl)
+            touched = []
+            for name,rtype,ttl,value in records:
+                if rtype == _TYPE_PTR:
+                    services = self.services.get(name.lower())
+                    if services is None or self.registered.has_key(value):
+                        continue
+                    s = services.get(value.lower())
+                    if s is None:
+                        s = services[value.lower()] = Service(value, name.lower())
+                    s.expires = t + ttl
+                    s.source = address[0]
+                    touched.append(s)
+                elif rtype == _TYPE_SRV:
+                    s = self._find_service(name)
+                    if s is None:
+                        continue
+                    if ttl == 0:
+                        s.expires = t
+                    s.host = value[0].lower()
+                    s.port = value[1]
+                    s.source = address[0]
+                    touched.append(s)
+            # Any service whose host changed address needs updating as well
+            for services in self.services.itervalues():
+                for s in services.itervalues():
+                    if s not in touched and s.host is not None:
+                        touched.append(s)
+            for s in touched:
+                endpoint = self._resolve(s)
+                if s.expires <= t:
+                    # Goodbye; gets removed on the next tick
+                    s.expires = t
+                    endpoint = None
+                if endpoint != s.endpoint:
+                    s.endpoint = endpoint
+                    notify.append((s.service_type, s.name, endpoint))
+            if len(notify) > 0:
+                self.cond.notify_all()
+        self._notify(notify)
+
+    def _find_service(self, name):
+        for services in self.services.itervalues():
+            s = services.get(name.lower())
+            if s is not None:
+                return s
+        return None
+
+    def _resolve(self, s):
+        if s.port is None:
+            return None
+        h = self.hosts.get(s.host)
+        if h is not None:
+            return (h[0], s.port)
+        # Responders answer from the address of the service, so that is a
+        # reasonable guess if we did not get an address record
+        return (s.source, s.port)
+
+    def _notify(self, notify):
+        for service_type,name,endpoint in notify:
+            if endpoint is None:
+                self.log.info('Service "{}" went away'.format(name))
+            else:
+                self.log.info('Found service "{}" with ip {} and port '
+                              '{}'.format(name, *endpoint))
+            with self.cond:
+                listeners = list(self.listeners.get(service_type, []))
+            for f in listeners:
+                f(name, endpoint)
+
+_zeroconf = None
+_zeroconf_lock = threading.Lock()
+
+def get_zeroconf():
+    # The shared Zeroconf instance, started on first use; returns None if the
+    # mDNS socket cannot be opened
+    global _zeroconf
+    with _zeroconf_lock:
+        if _zeroconf is None:
+            zc = Zeroconf()
+            if not zc.start():
+                return None
+            _zeroconf = zc
+        return _zeroconf
+
+def is_touchosc(label, match=None):
+    # With match, only the TouchOSC whose name contains it
+    return (label.count('TouchOSC') == 1 and
+            (match is None or match in label))
+
+def discover_touchosc(timeout=10, match=None):
+    # Returns a list of (name, ip, port) of all TouchOSC found on the network
+    # (see is_touchosc for match). Answers right away once the browser knows
+    # about a TouchOSC, otherwise waits up to timeout seconds for the first
+    # one.
+    log = logging.getLogger(__name__)
+    zc = get_zeroconf()
+    if zc is None:
+        log.warning('Zeroconf is not available')
+        return []
+    rs = zc.wait_for(OSC_SERVICE, lambda label: is_touchosc(label, match),
+                     timeout)
     if len(rs)==0:
         log.info('Could not find TouchOSC on the network via Zeroconf')
-        return (None,None)
-    if len(rs)>1:
-        log.info('Found multiple TouchOSC on the network, will only use the '
-                 'first one')
-    log.info('Found TouchOSC on the network with ip {} and port '
-             '{}'.format(*rs[0]))
-    return rs[0]
+        return []
+    for name,(ip,port) in rs:
+        log.info('Found TouchOSC on the network with ip {} and port '
+                 '{}'.format(ip, port))
+    return [(name, ip, port) for name,(ip,port) in rs]
 
 class OscarService(object):
-    def __init__(self, port=8000):
+    def __init__(self, port=8000, label='oscar'):
         self.log = logging.getLogger(__name__)
         self.port = port
-        self.process = None
+        self.label = label
+        self.name = None
 
     def __del__(self):
         self.unpublish()
 
     def publish(self):
-        try:
-            self.process = subprocess.Popen(['avahi-publish',
-                                             '--service',
-                                             'oscar',
-                                             '_osc._udp',
-                                             str(self.port)])
-            self.log.info('Announcing oscar via Zerconf on the network')
-        except OSError:
-            self.log.warning('Could not execute avahi-publish: is it installed?')
+        zc = get_zeroconf()
+        if zc is None:
+            self.log.warning('Could not announce oscar via Zeroconf')
+            return
+        self.name = zc.register(self.label, OSC_SERVICE, self.port)
+        self.log.info('Announcing {} via Zerconf on the network'.format(
+                      self.label))
 
     def unpublish(self):
-        if self.process is not None and self.process.poll() is None:
-            self.process.terminate()
-            self.process.wait()
-        self.process = None
+        if self.name is not None and _zeroconf is not None:
+            _zeroconf.unregister(self.name)
+        self.name = None